@@ -0,0 +1,182 @@
+"""Downloading many small files, one DOWNLOAD each vs. DOWNLOAD_BATCH.
+
+    python benchmarks/bench_batch_download.py [--files 5000] [--file-size 4096] [--rtt-ms 0,5]
+
+Starts a headless server in a scratch directory holding ``--files`` random
+files and downloads all of them over one framed connection:
+
+- ``one by one``: a DOWNLOAD and its reply per file, as the client did
+- ``batched``: DOWNLOAD_BATCH for 1,000 names at a time, the bodies streamed
+  back to back behind the manifest
+
+Each run goes through a relay on 127.0.0.1 that delays every chunk by half
+of ``--rtt-ms`` in each direction without limiting throughput, to show what
+the round trips cost on a real network.
+"""
+import argparse
+import hashlib
+import heapq
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+
+from protocol import Channel, recv_exact  # noqa: E402
+from store import MetadataStore  # noqa: E402
+
+BATCH_FILES = 1000
+
+
+def populate(workdir, files, file_size):
+    os.makedirs(os.path.join(workdir, 'server_files'))
+    rows = []
+    for i in range(files):
+        name = f"small_{i:06d}.bin"
+        data = os.urandom(file_size)
+        with open(os.path.join(workdir, 'server_files', name), 'wb') as f:
+            f.write(data)
+        rows.append((name, 'bench', 0, file_size, 'blake2b:' + hashlib.blake2b(data).hexdigest()))
+    store = MetadataStore(os.path.join(workdir, 'file_transfer.db'))
+    store.add_user('bench', 'bench')
+    store.put_files(rows)
+    store.close()
+    return [name for name, *_ in rows]
+
+
+def start_server(workdir):
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(os.path.join(ROOT, 'server')))
+    proc = subprocess.Popen([sys.executable, '-m', 'headless', '--port', '0'],
+                            cwd=workdir, env=env, stderr=subprocess.PIPE, text=True)
+    for line in proc.stderr:
+        if 'Server started' in line:
+            port = int(line.split(':')[-1].split()[0])
+            break
+    threading.Thread(target=lambda: proc.stderr.read(), daemon=True).start()
+    return proc, port
+
+
+def delay_pipe(source, sink, delay):
+    """Forward ``source`` to ``sink``, each chunk ``delay`` seconds after it arrived."""
+    pending, ready = [], threading.Condition()
+    sequence = 0
+
+    def read():
+        nonlocal sequence
+        while True:
+            data = source.recv(256 * 1024)
+            with ready:
+                heapq.heappush(pending, (time.perf_counter() + delay, sequence, data))
+                sequence += 1
+                ready.notify()
+            if not data:
+                return
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        with ready:
+            while not pending:
+                ready.wait()
+            due, _, data = pending[0]
+            wait = due - time.perf_counter()
+            if wait > 0:
+                ready.wait(wait)
+                continue
+            heapq.heappop(pending)
+        if not data:
+            sink.shutdown(socket.SHUT_WR)
+            return
+        sink.sendall(data)
+
+
+def start_relay(port, rtt):
+    """A listening port on 127.0.0.1 that relays one connection to ``port`` with ``rtt`` seconds of latency."""
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def relay():
+        client, _ = listener.accept()
+        listener.close()
+        server = socket.create_connection(('127.0.0.1', port))
+        for sock in (client, server):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=delay_pipe, args=(client, server, rtt / 2), daemon=True).start()
+        threading.Thread(target=delay_pipe, args=(server, client, rtt / 2), daemon=True).start()
+
+    threading.Thread(target=relay, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def connect(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    channel = Channel(sock)
+    channel.negotiate()
+    channel.request("LOGIN:bench:bench:VERSION")
+    channel.recv_reply()
+    return channel
+
+
+def one_by_one(channel, names, client_dir):
+    for name in names:
+        channel.send_command(f"DOWNLOAD:{name}")
+        header, _ = channel.recv_file_header()
+        size = int(header.split(':')[1])
+        channel.recv_data_header(size)
+        with open(os.path.join(client_dir, name), 'wb') as f:
+            f.write(recv_exact(channel.sock, size))
+
+
+def batched(channel, names, client_dir):
+    for start in range(0, len(names), BATCH_FILES):
+        manifest = channel.request(f"DOWNLOAD_BATCH:{1 << 30}:" + '\n'.join(names[start:start + BATCH_FILES]))
+        for line in manifest.split('\n')[1:]:
+            kind, size, _, _, name = line.split(':', 4)
+            size = int(size)
+            channel.recv_data_header(size)
+            with open(os.path.join(client_dir, name), 'wb') as f:
+                f.write(recv_exact(channel.sock, size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--file-size', type=int, default=4096)
+    parser.add_argument('--rtt-ms', default='0,5')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    proc = None
+    try:
+        server_dir = os.path.join(workdir, 'server')
+        names = populate(server_dir, args.files, args.file_size)
+        proc, port = start_server(server_dir)
+        print(f"{args.files:,} files of {args.file_size:,} bytes\n")
+        print(f"{'RTT':>6}{'one by one':>14}{'batched':>12}{'speedup':>10}")
+        for rtt in (float(value) / 1000 for value in args.rtt_ms.split(',')):
+            times = []
+            for download in (one_by_one, batched):
+                client_dir = os.path.join(workdir, 'client')
+                os.makedirs(client_dir)
+                channel = connect(start_relay(port, rtt))
+                start = time.perf_counter()
+                download(channel, names, client_dir)
+                times.append(time.perf_counter() - start)
+                channel.sock.close()
+                shutil.rmtree(client_dir)
+            print(f"{rtt * 1000:>4.0f}ms{times[0] * 1000:>12.0f}ms{times[1] * 1000:>10.0f}ms{times[0] / times[1]:>9.1f}x")
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
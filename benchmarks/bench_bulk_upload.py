@@ -0,0 +1,144 @@
+"""Uploading many small files, one at a time vs. packed into UPLOAD_BATCH streams.
+
+    python benchmarks/bench_bulk_upload.py [--files 50000] [--file-size 4096]
+
+Writes ``--files`` random files to a scratch folder and uploads all of them
+to a fresh headless server over one framed connection, three ways:
+
+- ``UPLOAD``: an UPLOAD, its reply and the listing version per file
+- ``client, one by one``: what the client did for each synced file: hash it,
+  offer the checksum with UPLOAD_LINK, then UPLOAD_INIT, UPLOAD_CHUNK and
+  UPLOAD_COMMIT
+- ``UPLOAD_BATCH``: the files packed 10,000 to a stream, as the client now
+  sends a burst of synced files
+
+Times include the server storing and recording every file, which is done
+once it has sent the last reply.
+"""
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+
+from protocol import Channel  # noqa: E402
+from checksum import file_checksum  # noqa: E402
+from folder_stream import ENTRY_FILE, send_stream, stream_size  # noqa: E402
+from store import MetadataStore  # noqa: E402
+from transport import apply_profile, send_file  # noqa: E402
+
+BATCH_FILES = 10000
+
+
+def start_server(workdir):
+    os.makedirs(workdir)
+    store = MetadataStore(os.path.join(workdir, 'file_transfer.db'))
+    store.add_user('bench', 'bench')
+    store.close()
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(os.path.join(ROOT, 'server')))
+    proc = subprocess.Popen([sys.executable, '-m', 'headless', '--port', '0'],
+                            cwd=workdir, env=env, stderr=subprocess.PIPE, text=True)
+    for line in proc.stderr:
+        if 'Server started' in line:
+            port = int(line.split(':')[-1].split()[0])
+            break
+    threading.Thread(target=lambda: proc.stderr.read(), daemon=True).start()
+    return proc, port
+
+
+def connect(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    apply_profile(sock, '127.0.0.1')  # TCP_NODELAY, as the client sets it
+    channel = Channel(sock)
+    channel.negotiate()
+    channel.request("LOGIN:bench:bench:VERSION")
+    channel.recv_reply()
+    return channel
+
+
+def upload(channel, paths):
+    for path in paths:
+        size = os.path.getsize(path)
+        channel.send_command(f"UPLOAD:{os.path.basename(path)}:{size}:1:0")
+        channel.send_data_header(size)
+        with open(path, 'rb') as f:
+            send_file(channel.sock, f, 0, size)
+        channel.recv_reply()
+        channel.recv_reply()
+
+
+def client_one_by_one(channel, paths):
+    for path in paths:
+        name, size = os.path.basename(path), os.path.getsize(path)
+        checksum = file_checksum(path)
+        if channel.request(f"UPLOAD_LINK:{name}:1:{checksum}") != "MISSING":
+            channel.recv_reply()
+            continue
+        upload_id = channel.request(f"UPLOAD_INIT:{name}:{size}:1:0").split(':')[1]
+        channel.send_command(f"UPLOAD_CHUNK:{upload_id}:0:{size}")
+        channel.send_data_header(size)
+        with open(path, 'rb') as f:
+            send_file(channel.sock, f, 0, size)
+        channel.recv_reply()
+        channel.request(f"UPLOAD_COMMIT:{upload_id}:{checksum}")
+        channel.recv_reply()
+
+
+def upload_batch(channel, paths):
+    for start in range(0, len(paths), BATCH_FILES):
+        manifest = [(ENTRY_FILE, os.path.basename(path), os.path.getsize(path), path)
+                    for path in paths[start:start + BATCH_FILES]]
+        length = stream_size(manifest)
+        channel.request(f"UPLOAD_BATCH:{length}:1")
+        channel.send_data_header(length)
+        send_stream(channel.sock, manifest)
+        channel.recv_reply()
+        channel.recv_reply()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--file-size', type=int, default=4096)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, 'source')
+        os.makedirs(source)
+        paths = []
+        for i in range(args.files):
+            paths.append(os.path.join(source, f"small_{i:06d}.bin"))
+            with open(paths[-1], 'wb') as f:
+                f.write(os.urandom(args.file_size))
+        print(f"{args.files:,} files of {args.file_size:,} bytes\n")
+        print(f"{'upload':<22}{'total':>10}{'per file':>12}{'files/s':>10}")
+        for label, send in (('UPLOAD', upload), ('client, one by one', client_one_by_one),
+                            ('UPLOAD_BATCH', upload_batch)):
+            server_dir = os.path.join(workdir, 'server')
+            proc, port = start_server(server_dir)
+            try:
+                channel = connect(port)
+                start = time.perf_counter()
+                send(channel, paths)
+                elapsed = time.perf_counter() - start
+                channel.sock.close()
+            finally:
+                proc.terminate()
+                proc.wait()
+                shutil.rmtree(server_dir)
+            print(f"{label:<22}{elapsed:>9.1f}s{elapsed / args.files * 1000:>10.2f}ms{args.files / elapsed:>10,.0f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Time to first byte and peak extra disk for folder transfers, zip vs. stream.
+
+    python benchmarks/bench_folder_stream.py [--files 200] [--file-size 1048576]
+
+Starts a headless server in a scratch directory and moves one folder of
+random (incompressible) files each way, once through the zip path
+(UPLOAD/DOWNLOAD) and once as a folder stream (UPLOAD_STREAM/DOWNLOAD_STREAM).
+The zip download runs twice; the second is served from the server's archive
+cache.
+A sampler thread sums the bytes under the server and client directories
+every few milliseconds; "peak extra disk" is the highest total seen minus the
+bytes of the folder itself on both sides.
+"""
+import argparse
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+
+from protocol import Channel, recv_exact  # noqa: E402
+from folder_stream import build_manifest, stream_size, send_stream, extract_stream  # noqa: E402
+
+
+def tree_bytes(*roots):
+    total = 0
+    for root in roots:
+        for dirpath, _, files in os.walk(root):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+    return total
+
+
+class DiskSampler(threading.Thread):
+    def __init__(self, *roots):
+        super().__init__(daemon=True)
+        self.roots = roots
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, tree_bytes(*self.roots))
+            time.sleep(0.005)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.peak = max(self.peak, tree_bytes(*self.roots))
+        return self.peak
+
+
+def start_server(workdir):
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(os.path.join(ROOT, 'server')))
+    proc = subprocess.Popen([sys.executable, '-m', 'headless', '--port', '0'],
+                            cwd=workdir, env=env, stderr=subprocess.PIPE, text=True)
+    for line in proc.stderr:
+        if 'Server started' in line:
+            port = int(line.split(':')[-1].split()[0])
+            break
+    threading.Thread(target=lambda: proc.stderr.read(), daemon=True).start()
+    with sqlite3.connect(os.path.join(workdir, 'file_transfer.db')) as conn:
+        conn.execute("INSERT INTO users (username, password) VALUES ('bench', 'bench')")
+    return proc, port
+
+
+def connect(port):
+    channel = Channel(socket.create_connection(('127.0.0.1', port)))
+    channel.negotiate()
+    channel.request("LOGIN:bench:bench")
+    channel.recv_reply()
+    return channel
+
+
+def upload_zip(channel, folder, name):
+    start = time.perf_counter()
+    archive = shutil.make_archive(folder + '.bench', 'zip', folder)
+    size = os.path.getsize(archive)
+    channel.send_command(f"UPLOAD:{name}:{size}:0:1")
+    channel.send_data_header(size)
+    first = None
+    with open(archive, 'rb') as f:
+        while True:
+            data = f.read(64 * 1024)
+            if not data:
+                break
+            channel.sock.sendall(data)
+            first = first or time.perf_counter()
+    channel.recv_reply()
+    channel.recv_reply()
+    os.remove(archive)
+    return first - start, time.perf_counter() - start
+
+
+def upload_stream(channel, folder, name):
+    start = time.perf_counter()
+    manifest = build_manifest(folder)
+    length = stream_size(manifest)
+    channel.request(f"UPLOAD_STREAM:{name}:{length}:0")
+    channel.send_data_header(length)
+    first = time.perf_counter()
+    send_stream(channel.sock, manifest)
+    channel.recv_reply()
+    channel.recv_reply()
+    return first - start, time.perf_counter() - start
+
+
+def download(channel, command, name, client_dir):
+    start = time.perf_counter()
+    channel.send_command(f"{command}:{name}")
+    header, _ = channel.recv_file_header()
+    parts = header.split(':')
+    size = int(parts[1])
+    channel.recv_data_header(size)
+    if parts[2] == 'STREAM':
+        # extract_stream writes the first file as its body starts arriving
+        first_byte = recv_exact(channel.sock, 1)
+        first = time.perf_counter()
+        replay = _Prefixed(first_byte, channel.sock)
+        extract_stream(replay, os.path.join(client_dir, name), size)
+    else:
+        archive = os.path.join(client_dir, name + '.zip')
+        with open(archive, 'wb') as f:
+            f.write(recv_exact(channel.sock, 1))
+            first = time.perf_counter()
+            remaining = size - 1
+            while remaining:
+                data = channel.sock.recv(min(64 * 1024, remaining))
+                f.write(data)
+                remaining -= len(data)
+        shutil.unpack_archive(archive, os.path.join(client_dir, name), 'zip')
+        os.remove(archive)
+    return first - start, time.perf_counter() - start
+
+
+class _Prefixed:
+    """A socket stand-in that first replays bytes already read."""
+
+    def __init__(self, prefix, sock):
+        self.prefix = prefix
+        self.sock = sock
+
+    def recv_into(self, view, size):
+        if self.prefix:
+            n = min(size, len(self.prefix))
+            view[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        return self.sock.recv_into(view, size)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--file-size', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    server_dir = os.path.join(workdir, 'server')
+    client_dir = os.path.join(workdir, 'client')
+    folder = os.path.join(client_dir, 'dataset')
+    os.makedirs(server_dir)
+    for i in range(args.files):
+        sub = os.path.join(folder, f"part{i % 10}")
+        os.makedirs(sub, exist_ok=True)
+        with open(os.path.join(sub, f"file{i:05d}.bin"), 'wb') as f:
+            f.write(os.urandom(args.file_size))
+    folder_bytes = tree_bytes(folder)
+    print(f"folder: {args.files} files, {folder_bytes / 2**20:.0f} MiB\n")
+
+    proc, port = start_server(server_dir)
+    try:
+        channel = connect(port)
+        print(f"{'transfer':<22}{'first byte':>12}{'total':>10}{'peak extra disk':>18}")
+        for label, run, name in [
+            ("upload, zip", lambda n: upload_zip(channel, folder, n), 'up_zip'),
+            ("upload, stream", lambda n: upload_stream(channel, folder, n), 'up_stream'),
+            ("download, zip", lambda n: download(channel, 'DOWNLOAD', 'up_zip', client_dir), 'up_zip'),
+            ("download, zip again", lambda n: download(channel, 'DOWNLOAD', 'up_zip', client_dir), 'up_zip'),
+            ("download, stream", lambda n: download(channel, 'DOWNLOAD_STREAM', 'up_stream', client_dir),
+             'up_stream'),
+        ]:
+            baseline = tree_bytes(server_dir, client_dir)
+            sampler = DiskSampler(server_dir, client_dir)
+            sampler.start()
+            first, total = run(name)
+            peak = sampler.stop()
+            extra = peak - baseline - folder_bytes  # the copy that is the point of the transfer
+            print(f"{label:<22}{first * 1000:10.1f}ms{total * 1000:8.0f}ms{max(extra, 0) / 2**20:14.1f} MiB")
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""CPU cost of progress reporting per GiB transferred, per chunk vs. throttled.
+
+    python benchmarks/bench_progress.py [--gib 1] [--chunk-sizes 4096,65536] [--rate-mib 200]
+
+No data is moved: a loop advances a byte counter chunk by chunk, at
+``--rate-mib`` MiB/s of simulated wall clock, and reports progress the way
+the client does. "per chunk" is the old client: a speed from the last two
+samples and a signal for every chunk. "throttled" is progress.ProgressReporter.
+A signal is stood in for by a put on a queue that a second thread drains, the
+way a queued Qt connection hands work to the GUI thread. CPU time is the
+process total, so it includes the draining thread; "none" is the loop alone.
+"""
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src', 'common'))
+
+from progress import ProgressReporter  # noqa: E402
+
+GIB = 1024 ** 3
+
+
+class FakeClock:
+    """Simulated wall clock, so throttling sees a realistic rate without moving data."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Signal:
+    """A cross-thread signal: emit() queues the arguments, a receiver thread takes them off."""
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.received = 0
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def emit(self, *args):
+        self.queue.put(args)
+
+    def drain(self):
+        while self.queue.get() is not None:
+            self.received += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def no_progress(total, chunk_size, clock, signal):
+    done = 0
+    step = chunk_size / clock.rate
+    while done < total:
+        clock.now += step
+        done += chunk_size
+
+
+def per_chunk(total, chunk_size, clock, signal):
+    last_time = 0
+    last_bytes = 0
+    speed = 0.0
+    done = 0
+    step = chunk_size / clock.rate
+    while done < total:
+        clock.now += step
+        done += chunk_size
+        # FileTransferThread.calculate_speed() before throttling
+        now = clock()
+        if last_time > 0:
+            elapsed = now - last_time
+            if elapsed > 0:
+                speed = ((done - last_bytes) / (1024 * 1024)) / elapsed
+        last_time, last_bytes = now, done
+        signal.emit('file', done, total, speed)
+
+
+def throttled(total, chunk_size, clock, signal):
+    progress = ProgressReporter(total, lambda *args: signal.emit('file', *args), clock=clock)
+    done = 0
+    step = chunk_size / clock.rate
+    while done < total:
+        clock.now += step
+        done += chunk_size
+        progress.update(done)
+
+
+def measure(method, total, chunk_size, rate):
+    clock = FakeClock()
+    clock.rate = rate
+    signal = Signal()
+    cpu = time.process_time()
+    method(total, chunk_size, clock, signal)
+    signal.close()
+    return time.process_time() - cpu, signal.received, clock.now
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--gib', type=float, default=1.0)
+    parser.add_argument('--chunk-sizes', default='4096,65536')
+    parser.add_argument('--rate-mib', type=float, default=200.0)
+    args = parser.parse_args()
+    total = int(args.gib * GIB)
+    rate = args.rate_mib * 1024 * 1024
+
+    print(f"{'chunk':>8}{'method':>12}{'signals':>12}{'CPU s/GiB':>12}{'signals/s':>12}")
+    for chunk_size in (int(size) for size in args.chunk_sizes.split(',')):
+        for label, method in (('none', no_progress), ('per chunk', per_chunk), ('throttled', throttled)):
+            cpu, signals, seconds = measure(method, total, chunk_size, rate)
+            print(f"{chunk_size:>8}{label:>12}{signals:>12,}{cpu / args.gib:>12.3f}{signals / seconds:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
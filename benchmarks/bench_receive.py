@@ -0,0 +1,149 @@
+"""Python allocation and throughput of the receive loops, recv() vs. recv_into() vs. splice().
+
+    python benchmarks/bench_receive.py [--mib 256] [--runs 3]
+
+A sender thread pushes a payload over a TCP connection on 127.0.0.1 and the
+receiver writes it to a scratch file. The three receive loops are:
+
+- ``recv 4 KiB``: the old loop, a new bytes object from recv() per chunk
+- ``recv_into``: transport.receive_into() writing to a wrapper without a
+  fileno(), which forces the reusable buffer (as when hashing on arrival)
+- ``splice``: transport.receive_into() on the plain file (Linux only)
+
+With tracemalloc running, the peak of traced memory above the level at the
+start of each chunk is recorded and reset after every chunk: the Python
+memory one chunk allocates on its way to the file. "median" is the typical
+chunk; "max" includes the chunks where a ReceiveBuffer grows. "peak" is the
+highest level over the whole body, buffers included. Throughput is measured
+in separate runs without tracemalloc.
+"""
+import argparse
+import array
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src', 'common'))
+
+import transport  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+class Writer:
+    """A file wrapper without fileno(), like HashingWriter."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        return self.f.write(data)
+
+
+def receive_recv(sock, f, length, on_progress):
+    received = 0
+    while received < length:
+        data = sock.recv(min(4096, length - received))
+        if not data:
+            break
+        f.write(data)
+        received += len(data)
+        on_progress(received)
+    return received
+
+
+def receive_buffered(sock, f, length, on_progress):
+    return transport.receive_into(sock, Writer(f), length, on_progress)
+
+
+def receive_splice(sock, f, length, on_progress):
+    return transport.receive_into(sock, f, length, on_progress)
+
+
+class ChunkPeaks:
+    """An on_progress callback that records each chunk's tracemalloc peak.
+
+    The records go into an array allocated up front, so keeping them
+    allocates nothing that would be counted against the next chunk.
+    """
+
+    def __init__(self, max_chunks):
+        self.peaks = array.array('q', bytes(8 * max_chunks))
+        self.count = 0
+        self.high = 0
+        self.base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    def __call__(self, received):
+        current, peak = tracemalloc.get_traced_memory()
+        self.peaks[self.count] = peak - self.base
+        self.count += 1
+        self.high = max(self.high, peak)
+        self.base = current
+        tracemalloc.reset_peak()
+
+    def chunk_peaks(self):
+        return self.peaks[:self.count]
+
+
+def run_once(payload, receive, path, trace):
+    server = socket.create_server(('127.0.0.1', 0))
+    sender_sock = socket.create_connection(server.getsockname())
+    receiver_sock, _ = server.accept()
+    server.close()
+    sender = threading.Thread(target=sender_sock.sendall, args=(payload,))
+    with open(path, 'wb') as f:
+        if trace:
+            tracemalloc.start()
+            callback = ChunkPeaks(len(payload) // 256)
+            start_level = tracemalloc.get_traced_memory()[0]
+        else:
+            callback = lambda received: None  # noqa: E731
+        sender.start()
+        start = time.perf_counter()
+        received = receive(receiver_sock, f, len(payload), callback)
+        elapsed = time.perf_counter() - start
+        if trace:
+            peaks = callback.chunk_peaks()
+            overall_peak = callback.high - start_level
+            tracemalloc.stop()
+    sender.join()
+    sender_sock.close()
+    receiver_sock.close()
+    assert received == len(payload), f"received {received} of {len(payload)} bytes"
+    if trace:
+        return peaks, overall_peak
+    return len(payload) / MIB / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mib', type=int, default=256)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    payload = os.urandom(args.mib * MIB)
+
+    cases = [('recv 4 KiB', receive_recv), ('recv_into', receive_buffered)]
+    if transport.SPLICE:
+        cases.append(('splice', receive_splice))
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        print(f"{args.mib} MiB over loopback into {path}\n")
+        print(f"{'loop':<12}{'chunks':>10}{'median':>12}{'max':>14}{'peak':>14}{'MiB/s':>10}")
+        for label, receive in cases:
+            peaks, peak = run_once(payload, receive, path, trace=True)
+            rate = statistics.median(run_once(payload, receive, path, trace=False) for _ in range(args.runs))
+            print(f"{label:<12}{len(peaks):>10,}{statistics.median(peaks):>10,.0f} B{max(peaks) / 1024:>10,.0f} KiB"
+                  f"{peak / 1024:>10,.0f} KiB{rate:>10,.0f}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Query plans and latencies of the hot metadata queries before/after indexing.
+
+    python benchmarks/bench_schema.py [--downloads 1000000] [--files 20000] [--runs 5]
+
+Builds a scratch database at schema version 1 (the original tables, no
+secondary indexes), times LIST, SEARCH and the statistics queries, then runs
+the remaining migrations in place and times them again. The EXPLAIN QUERY
+PLAN of each query is printed for both versions. Statistics at version 1
+are the original aggregates over the raw tables and SEARCH is the original
+LIKE scan; at the latest version they come from the rollup tables and the
+trigram search index.
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src', 'server'))
+
+from store import MetadataStore, SCHEMA_VERSION  # noqa: E402
+
+
+def populate(store, users, files, shares, downloads):
+    rng = random.Random(1253)
+    now = datetime.now()
+    user_names = [f"user{i}" for i in range(users)]
+    with store.transaction() as conn:
+        conn.executemany("INSERT INTO users (username, password) VALUES (?, 'pw')",
+                         [(u,) for u in user_names])
+        conn.executemany("""INSERT INTO files (file_name, upload_date, user_id, is_private, size, checksum)
+                            VALUES (?, ?, ?, ?, ?, '')""",
+                         [(f"file{i:06d}.bin", now, rng.choice(user_names), int(rng.random() < 0.5),
+                           rng.randint(1, 1 << 24)) for i in range(files)])
+        conn.executemany("INSERT OR IGNORE INTO file_shares VALUES (?, ?)",
+                         [(f"file{rng.randrange(files):06d}.bin", rng.choice(user_names))
+                          for _ in range(shares)])
+        batch = []
+        for i in range(downloads):
+            batch.append((f"file{rng.randrange(files):06d}.bin", "('127.0.0.1', 5000)",
+                          now - timedelta(seconds=rng.randrange(365 * 86400)),
+                          rng.choice(user_names), rng.random() * 100))
+            if len(batch) == 50000:
+                conn.executemany("""INSERT INTO downloads (file_name, client_address, timestamp, user_id, speed)
+                                    VALUES (?, ?, ?, ?, ?)""", batch)
+                batch.clear()
+        if batch:
+            conn.executemany("""INSERT INTO downloads (file_name, client_address, timestamp, user_id, speed)
+                                VALUES (?, ?, ?, ?, ?)""", batch)
+
+
+def raw_stats(store, start_date):
+    """The statistics as computed before the rollup tables existed."""
+    stats = {}
+    stats['downloads'] = store.query_one("SELECT COUNT(*) FROM downloads WHERE timestamp >= ?", (start_date,))[0]
+    stats['total_days_with_downloads'] = store.query_one("SELECT COUNT(DISTINCT DATE(timestamp)) FROM downloads")[0]
+    stats['files'] = store.query_one("SELECT COUNT(*), SUM(size) FROM files")
+    stats['files_per_user'] = dict(store.query("SELECT user_id, COUNT(*) FROM files GROUP BY user_id"))
+    stats['downloads_per_user'] = dict(store.query(
+        "SELECT user_id, COUNT(*) FROM downloads WHERE timestamp >= ? GROUP BY user_id", (start_date,)))
+    stats['average_speed'] = store.query_one("SELECT AVG(speed) FROM downloads WHERE timestamp >= ?", (start_date,))[0]
+    return stats
+
+
+def raw_search(store, user_id, query):
+    """SEARCH as it was before the trigram index: an unranked LIKE scan."""
+    return store.query("""
+        SELECT file_name, is_private = 1 AND user_id IS ? FROM files
+        WHERE (is_private = 0 OR user_id = ? OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?))
+        AND file_name LIKE ? COLLATE NOCASE
+    """, (user_id, user_id, user_id, f"%{query}%"))
+
+
+def workloads(store, rollups):
+    stats = store.stats_since if rollups else lambda start_date: raw_stats(store, start_date)
+    search = store.search_files if rollups else lambda user_id, query: raw_search(store, user_id, query)
+    year = datetime.now() - timedelta(days=365)
+    day = datetime.now() - timedelta(days=1)
+    month = datetime.now() - timedelta(days=30)
+    return [
+        ("LIST", "SELECT file_name FROM files WHERE is_private = 0 OR user_id = ? "
+                 "OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?)",
+         ('user7', 'user7'), lambda: store.visible_files('user7')),
+        ("SEARCH", None, None, lambda: search('user7', 'file0012')),
+        ("shared with me", "SELECT file_name FROM file_shares WHERE shared_with_user = ?",
+         ('user7',), lambda: store.public_and_private_files('user7')),
+        ("downloads last day", "SELECT COUNT(*) FROM downloads WHERE timestamp >= ?",
+         (day,), lambda: store.query_one("SELECT COUNT(*) FROM downloads WHERE timestamp >= ?", (day,))),
+        ("per-user last month", "SELECT user_id, COUNT(*) FROM downloads WHERE timestamp >= ? GROUP BY user_id",
+         (month,), lambda: store.query("SELECT user_id, COUNT(*) FROM downloads WHERE timestamp >= ? "
+                                       "GROUP BY user_id", (month,))),
+        ("stats (day)", None, None, lambda: stats(day)),
+        ("stats (month)", None, None, lambda: stats(month)),
+        ("stats (year)", None, None, lambda: stats(year)),
+    ]
+
+
+def measure(store, runs, show_plans, rollups):
+    results = {}
+    for label, sql, params, call in workloads(store, rollups):
+        if show_plans and sql:
+            print(f"  {label}:")
+            for row in store.query("EXPLAIN QUERY PLAN " + sql, params):
+                print(f"      {row[3]}")
+        call()  # warm the page cache
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            call()
+            samples.append(time.perf_counter() - start)
+        results[label] = statistics.median(samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--downloads', type=int, default=1_000_000)
+    parser.add_argument('--files', type=int, default=20_000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--shares', type=int, default=50_000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'file_transfer.db')
+        store = MetadataStore(path, migrate=False)
+        store.migrate(target=1)
+
+        start = time.perf_counter()
+        populate(store, args.users, args.files, args.shares, args.downloads)
+        print(f"populated {args.downloads:,} downloads, {args.files:,} files in "
+              f"{time.perf_counter() - start:.1f} s\n")
+
+        print("schema v1 plans:")
+        before = measure(store, args.runs, True, rollups=False)
+
+        start = time.perf_counter()
+        store.migrate()
+        print(f"\nmigrated v1 -> v{SCHEMA_VERSION} in place in {time.perf_counter() - start:.1f} s\n")
+
+        print(f"schema v{SCHEMA_VERSION} plans:")
+        after = measure(store, args.runs, True, rollups=True)
+
+        print(f"\n{'query':<22}{'v1 median':>12}{'v' + str(SCHEMA_VERSION) + ' median':>12}{'speedup':>10}")
+        for label in before:
+            print(f"{label:<22}{before[label] * 1000:10.2f}ms{after[label] * 1000:10.2f}ms"
+                  f"{before[label] / after[label]:9.1f}x")
+        store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""SEARCH latency with the trigram index vs. the original LIKE scan.
+
+    python benchmarks/bench_search.py [--files 2000000] [--runs 5]
+
+Builds a scratch database at the latest schema version with ``--files``
+names made of a few words from a small vocabulary, a sequence number and an
+extension, a quarter of them private. For queries from very selective to
+matching a large share of the table it times:
+
+- ``LIKE scan``: the original query, every visible match, unranked
+- ``ranked page``: MetadataStore.search_files(), the first page of matches
+
+Times are medians of ``--runs`` after one warm-up call.
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src', 'server'))
+
+from store import MetadataStore  # noqa: E402
+
+WORDS = ['report', 'invoice', 'holiday', 'photo', 'backup', 'draft', 'final', 'budget', 'notes', 'scan',
+         'project', 'meeting', 'summary', 'design', 'contract', 'video', 'music', 'thesis', 'slides', 'data']
+EXTENSIONS = ['pdf', 'jpg', 'docx', 'zip', 'mp4', 'txt', 'csv', 'png']
+QUERIES = ['report_final_1234567', '1234', 'thesis_draft', 'invoice', '.csv', 'zz', 'no such file']
+
+
+def populate(store, files, users):
+    rng = random.Random(2103)
+    now = datetime.now()
+    user_names = [f"user{i}" for i in range(users)]
+    batch = []
+    with store.transaction() as conn:
+        for i in range(files):
+            words = '_'.join(rng.sample(WORDS, rng.randint(1, 3)))
+            batch.append((f"{words}_{i}.{rng.choice(EXTENSIONS)}", now, rng.choice(user_names),
+                          int(rng.random() < 0.25), rng.randint(1, 1 << 24)))
+            if len(batch) == 50000:
+                conn.executemany("""INSERT INTO files (file_name, upload_date, user_id, is_private, size, checksum)
+                                    VALUES (?, ?, ?, ?, ?, '')""", batch)
+                batch.clear()
+        conn.executemany("""INSERT INTO files (file_name, upload_date, user_id, is_private, size, checksum)
+                            VALUES (?, ?, ?, ?, ?, '')""", batch)
+        conn.execute("INSERT INTO files (file_name, upload_date, user_id, is_private, size, checksum) "
+                     "VALUES ('report_final_1234567.pdf', ?, 'user7', 0, 1, '')", (now,))
+
+
+def like_scan(store, user_id, query):
+    return store.query("""
+        SELECT file_name, is_private = 1 AND user_id IS ? FROM files
+        WHERE (is_private = 0 OR user_id = ? OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?))
+        AND file_name LIKE ? COLLATE NOCASE
+    """, (user_id, user_id, user_id, f"%{query}%"))
+
+
+def median_time(call, runs):
+    call()
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=2_000_000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        store = MetadataStore(os.path.join(workdir, 'file_transfer.db'))
+        start = time.perf_counter()
+        populate(store, args.files, args.users)
+        print(f"populated {args.files:,} files, index included, in {time.perf_counter() - start:.1f} s\n")
+
+        print(f"{'query':<24}{'matches':>10}{'LIKE scan':>12}{'ranked page':>14}{'speedup':>10}  best match")
+        for query in QUERIES:
+            matches = like_scan(store, 'user7', query)
+            scan = median_time(lambda: like_scan(store, 'user7', query), args.runs)
+            ranked = median_time(lambda: store.search_files('user7', query), args.runs)
+            (page, _) = store.search_files('user7', query)
+            best = page[0][0] if page else '-'
+            print(f"{query!r:<24}{len(matches):>10,}{scan * 1000:>10.1f}ms{ranked * 1000:>12.1f}ms"
+                  f"{scan / ranked:>9.1f}x  {best}")
+        store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Startup time and resident memory of the headless server vs. the Qt one.
+
+    python benchmarks/bench_startup.py [--runs 5]
+
+Each run starts ``python -m headless --port 0`` in a scratch directory,
+waits for the "Server started" log line and reads VmRSS from /proc. The Qt
+side only measures importing server.py (no display needed), which is the
+floor of what the GUI build pays before showing a window.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src', 'server')
+
+
+def rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_headless():
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(SERVER_DIR))
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-m', 'headless', '--port', '0'],
+                            cwd=workdir, env=env, stderr=subprocess.PIPE, text=True)
+    try:
+        for line in proc.stderr:
+            if 'Server started' in line:
+                break
+        elapsed = time.perf_counter() - start
+        return elapsed, rss_kb(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_qt_import():
+    workdir = tempfile.mkdtemp()
+    code = ("import sys, time; sys.path.insert(0, %r); t = time.perf_counter(); import server; "
+            "print(time.perf_counter() - t); print(open('/proc/self/status').read().split('VmRSS:')[1].split()[0])"
+            % os.path.abspath(SERVER_DIR))
+    try:
+        out = subprocess.run([sys.executable, '-c', code], cwd=workdir, capture_output=True, text=True)
+        if out.returncode != 0:
+            return None
+        elapsed, rss = out.stdout.split()
+        return float(elapsed), int(rss)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report(label, samples):
+    times = [t for t, _ in samples]
+    rss = [r for _, r in samples if r]
+    line = f"{label:<22} startup median {statistics.median(times) * 1000:7.1f} ms"
+    if rss:
+        line += f"   RSS median {statistics.median(rss) / 1024:6.1f} MiB"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    report("headless daemon", [run_headless() for _ in range(args.runs)])
+    qt = [run_qt_import() for _ in range(args.runs)]
+    if all(qt):
+        report("import server (Qt)", qt)
+    else:
+        print("import server (Qt)     skipped: PyQt5 is not importable here")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Loopback throughput by I/O chunk size, fixed vs. adaptive, per socket profile.
+
+    python benchmarks/bench_transport.py [--mib 512] [--sizes 1024,4096,65536,1048576,4194304] [--runs 3]
+
+A sender thread reads a payload from memory and sends it over a TCP
+connection on 127.0.0.1; the receiver writes what arrives to /dev/null.
+"fixed N" is the old loop, f.read(N) + sendall() on one side and recv(N) +
+write() on the other, with a fresh bytes object per chunk. "adaptive" is
+transport.read_chunks() and transport.ReceiveBuffer. Each row is run under
+both socket profiles; the median of ``--runs`` is shown. Loopback has no
+latency to hide, so the profiles differ little here; on a real WAN link the
+larger buffers are what matters.
+"""
+import argparse
+import io
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src', 'common'))
+
+from transport import ReceiveBuffer, apply_profile, read_chunks  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+def connected_pair(profile):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    apply_profile(client, '127.0.0.1', profile)
+    client.connect(server.getsockname())
+    accepted, _ = server.accept()
+    apply_profile(accepted, '127.0.0.1', profile)
+    server.close()
+    return client, accepted
+
+
+def send_fixed(sock, source, size, chunk_size):
+    while True:
+        data = source.read(chunk_size)
+        if not data:
+            break
+        sock.sendall(data)
+
+
+def send_adaptive(sock, source, size, chunk_size):
+    for data in read_chunks(source, size):
+        sock.sendall(data)
+
+
+def receive_fixed(sock, sink, size, chunk_size):
+    received = 0
+    while received < size:
+        data = sock.recv(min(chunk_size, size - received))
+        if not data:
+            break
+        sink.write(data)
+        received += len(data)
+    return received
+
+
+def receive_adaptive(sock, sink, size, chunk_size):
+    buffer = ReceiveBuffer()
+    received = 0
+    while received < size:
+        data = buffer.recv(sock, size - received)
+        if not data:
+            break
+        sink.write(data)
+        received += len(data)
+    return received
+
+
+def run_once(payload, profile, send, receive, chunk_size):
+    sender_sock, receiver_sock = connected_pair(profile)
+    size = len(payload)
+    sender = threading.Thread(target=send, args=(sender_sock, io.BytesIO(payload), size, chunk_size))
+    with open(os.devnull, 'wb', buffering=0) as sink:
+        start = time.perf_counter()
+        sender.start()
+        received = receive(receiver_sock, sink, size, chunk_size)
+        elapsed = time.perf_counter() - start
+    sender.join()
+    sender_sock.close()
+    receiver_sock.close()
+    assert received == size, f"received {received} of {size} bytes"
+    return size / MIB / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mib', type=int, default=512)
+    parser.add_argument('--sizes', default='1024,4096,65536,1048576,4194304')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    payload = os.urandom(args.mib * MIB)
+
+    cases = [(f"fixed {int(size) // 1024} KiB", send_fixed, receive_fixed, int(size))
+             for size in args.sizes.split(',')]
+    cases.append(("adaptive", send_adaptive, receive_adaptive, 0))
+    print(f"{args.mib} MiB over loopback, median of {args.runs}\n")
+    print(f"{'chunks':<18}{'lan MiB/s':>12}{'wan MiB/s':>12}")
+    for label, send, receive, chunk_size in cases:
+        rates = [statistics.median(run_once(payload, profile, send, receive, chunk_size) for _ in range(args.runs))
+                 for profile in ('lan', 'wan')]
+        print(f"{label:<18}{rates[0]:>12,.0f}{rates[1]:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import shutil
 import threading
 import queue
 import hashlib
+from concurrent.futures import CancelledError, Future
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
@@ -17,49 +18,198 @@ from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer, QSize, QPoint, QProper
 from PyQt5.QtGui import QPalette, QColor, QFont, QIcon, QCursor
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from protocol import MAX_MESSAGE_SIZE, Channel, ProtocolError
+from parallel_download import (ParallelDownloader, RangeUnsupported, header_checksum, open_logged_in_channel,
+                               request_range, verify_blocks)
+from folder_stream import ENTRY_FILE, build_manifest, stream_size, send_stream, extract_stream
+from checksum import (ChecksumMismatch, HashingWriter, RunningChecksum, file_checksum, format_checksum, new_hash,
+                      parse_checksum)
+from chunking import ChunkReader, file_chunks, format_manifest, parse_manifest
+from progress import ProgressReporter, format_duration
+from transport import ReceiveBuffer, apply_profile, receive_into, send_file
+
+# Uploads to servers with upload sessions go in chunks of this size; after a
+# dropped connection the thread reconnects and continues from the server's
+# committed offset, giving up after UPLOAD_RETRIES consecutive failures.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_RETRIES = 5
+# Files of at least DELTA_MIN_SIZE are compared by content-defined chunks:
+# uploads send only the chunks the server lacks, and downloads over an older
+# local copy fetch only the chunks that changed.
+DELTA_MIN_SIZE = int(os.environ.get('FT_DELTA_MIN_MB', '8')) * 1024 * 1024
+# Uploads and downloads run on this many worker threads, each over its own
+# logged-in connection, so they overlap with each other and with commands.
+TRANSFER_WORKERS = int(os.environ.get('FT_TRANSFER_WORKERS', '3'))
+TRANSFER_ACTIONS = ('upload', 'download')
+# Several files are downloaded DOWNLOAD_BATCH_FILES at a time with one
+# DOWNLOAD_BATCH round trip each. Folders and files of DELTA_MIN_SIZE or more
+# still come one by one, so they can use delta and parallel downloads.
+DOWNLOAD_BATCH_FILES = 1000
+# Several files under UPLOAD_BATCH_MAX_FILE_SIZE are packed into one
+# UPLOAD_BATCH stream, up to UPLOAD_BATCH_FILES files or UPLOAD_BATCH_BYTES
+# bytes each; larger files go one by one through upload sessions.
+UPLOAD_BATCH_MAX_FILE_SIZE = 1024 * 1024
+UPLOAD_BATCH_FILES = 10000
+UPLOAD_BATCH_BYTES = 64 * 1024 * 1024
+# Changes in a synced folder are gathered for this many seconds after the
+# first one and uploaded together
+SYNC_BATCH_DELAY = 0.5
+# Names per LIST_PAGE/LIST_CHANGES reply; the server may send fewer
+LIST_PAGE_SIZE = 2000
+# Seconds before resubscribing to change events after the connection drops
+EVENT_RECONNECT_DELAY = 2.0
+
+
+def parse_listing(reply):
+    """The fields of a listing reply, ``PUBLIC:a,b|PRIVATE:c|...``, as {name: value}.
+
+    PUBLIC, PRIVATE and REMOVED become lists of names; a field without a
+    value, such as NEXT in a LIST_CHANGES reply, maps to ''.
+    """
+    fields = {}
+    for part in reply.split('|'):
+        key, _, value = part.partition(':')
+        fields[key] = [name for name in value.split(',') if name] if key in ('PUBLIC', 'PRIVATE', 'REMOVED') else value
+    return fields
+
+
+class OperationCancelled(BaseException):
+    """Raised inside a running operation once it has been asked to stop.
+
+    A BaseException, like asyncio.CancelledError, so the handlers' broad
+    ``except Exception`` blocks report errors without swallowing it.
+    """
+
+
+class Operation(Future):
+    """A queued client action and the Future for its outcome."""
+
+    def __init__(self, action, params):
+        super().__init__()
+        self.action = action
+        self.params = params
+        self.stop_requested = threading.Event()
+
+    def cancel(self):
+        """Cancel if still queued; a running transfer stops at its next chunk."""
+        if super().cancel():
+            return True
+        if not self.done():
+            self.stop_requested.set()
+        return False
+
+
+class PerThread:
+    """An attribute with a separate value in every thread, such as each worker's connection."""
+
+    def __init__(self, default=None):
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        return getattr(obj.local, self.name, self.default)
+
+    def __set__(self, obj, value):
+        setattr(obj.local, self.name, value)
+
+
 class FileTransferThread(QThread):
     update_status = pyqtSignal(str)
     update_file_list = pyqtSignal(list, list)  # public_files, private_files
+    file_list_changed = pyqtSignal(list, list, list)  # public_files, private_files, removed_files: changed names only
+    search_results = pyqtSignal(list, list)  # public_files, private_files
     error_occurred = pyqtSignal(str)
     login_status = pyqtSignal(bool)
-    transfer_progress = pyqtSignal(str, int, int, float)  # filename, current, total, speed
+    transfer_progress = pyqtSignal(str, int, int, float, float)  # filename, current, total, MB/s, seconds left (-1: unknown)
     notify = pyqtSignal(str)  # For notifications
     display_name_received = pyqtSignal(str)
 
+    # The QThread and every transfer worker talk over their own connection
+    channel = PerThread()
+    client_socket = PerThread()
+    channel_credentials = PerThread()
+    operation = PerThread()
+
+    # action -> (handler, whether it needs a logged-in session). Handlers get
+    # the keyword arguments given to queue_action().
+    ACTIONS = {
+        'list': ('handle_list_request', True),
+        'login': ('handle_login', False),
+        'logout': ('handle_logout', False),
+        'download': ('handle_download', True),
+        'upload': ('handle_upload', True),
+        'share': ('handle_share', True),
+        'change_password': ('handle_password_change', True),
+        'delete_account': ('handle_delete_account', True),
+        'search': ('handle_search', True),
+        'delete_file': ('handle_delete_file', True),
+        'get_display_name': ('handle_get_display_name', True),
+        'update_display_name': ('handle_update_display_name', True),
+    }
+
     def __init__(self):
         super().__init__()
-        self.client_socket = None
+        self.local = threading.local()
         self.running = False
-        self.action = None
-        self.file_names = []
-        self.file_paths = []
-        self.is_private = False
+        self.commands = queue.Queue()  # every Operation, in order; None stops the thread
+        self.transfers = queue.Queue()  # uploads and downloads handed on to the workers
+        self.operations = set()  # queued or running, for cancel_all()
+        self.operations_lock = threading.Lock()
         self.username = None
         self.password = None
-        self.new_password = None
         self.display_name = None
         self.download_dir = 'downloads'
         self.host = None
         self.port = 1253  # Default port
         self.is_logged_in = False
-        self.current_file_size = 0
+        self.credentials = None  # kept for the extra connections of parallel downloads
         self.enable_notifications = True
         self.download_tasks = {}  # {filename: (file, offset, total)}
         self.paused_downloads = set()
-        self.last_transfer_update = 0
-        self.last_bytes_transferred = 0
-        self.transfer_speed = 0.0
-
-    def set_action(self, action, file_names=None, file_paths=None, username=None, password=None, 
-                  is_private=False, new_password=None, display_name=None):
-        self.action = action
-        self.file_names = file_names if file_names else []
-        self.file_paths = file_paths if file_paths else []
-        self.username = username
-        self.password = password
-        self.is_private = is_private
-        self.new_password = new_password
-        self.display_name = display_name
+        self.checksum_cache = {}  # (path, size, mtime_ns) -> checksum of files uploaded this session
+        # The listing as of catalog_version, kept current with LIST_CHANGES on
+        # servers that have it; None means the server sends whole listings
+        self.catalog = {}  # file name -> (public, private)
+        self.catalog_version = None
+        self.catalog_lock = threading.Lock()
+        self.events_channel = None  # the SUBSCRIBE connection change events arrive on
+        self.events_stopped = None  # set to end the listener reading them
+
+    def queue_action(self, action, **params):
+        """Queue an action for the thread; returns its Operation, a Future.
+
+        Commands run one at a time in the order queued. Uploads and downloads
+        are passed on to the transfer workers and run concurrently.
+        """
+        operation = Operation(action, params)
+        with self.operations_lock:
+            self.operations.add(operation)
+        operation.add_done_callback(self.forget_operation)
+        self.commands.put(operation)
+        return operation
+
+    def forget_operation(self, operation):
+        with self.operations_lock:
+            self.operations.discard(operation)
+
+    def cancel_all(self):
+        with self.operations_lock:
+            operations = list(self.operations)
+        for operation in operations:
+            operation.cancel()
+
+    def cancelled(self):
+        """Whether the operation running in the calling thread has been asked to stop."""
+        return self.operation is not None and self.operation.stop_requested.is_set()
+
+    def check_cancelled(self, what):
+        if self.cancelled():
+            raise OperationCancelled(f"{what} cancelled")
 
     def set_notifications(self, enabled):
         self.enable_notifications = enabled
@@ -67,68 +217,49 @@ class FileTransferThread(QThread):
     def connect_to_server(self):
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            apply_profile(self.client_socket, self.host)
             self.client_socket.connect((self.host, self.port))
-            self.running = True
-            self.update_status.emit("Connected to server.")
+            self.channel = Channel(self.client_socket)
             
-            # Test connection
-            self.client_socket.settimeout(2.0)
-            try:
-                self.client_socket.recv(1024)
-            except socket.timeout:
-                pass
+            # Negotiating the protocol also tests the connection
+            self.client_socket.settimeout(5.0)
+            self.channel.negotiate()
             self.client_socket.settimeout(None)
+            self.running = True
+            self.update_status.emit(f"Connected to server (protocol v{self.channel.version}).")
             return True
         except Exception as e:
             self.error_occurred.emit(f"Connection error: {str(e)}")
             return False
 
-    def calculate_speed(self, bytes_transferred):
-        now = time.time()
-        if self.last_transfer_update > 0:
-            time_diff = now - self.last_transfer_update
-            if time_diff > 0:
-                bytes_diff = bytes_transferred - self.last_bytes_transferred
-                self.transfer_speed = (bytes_diff / (1024 * 1024)) / time_diff  # MB/s
-        self.last_transfer_update = now
-        self.last_bytes_transferred = bytes_transferred
-        return self.transfer_speed
+    def progress_reporter(self, name, total, initial=0, pbar=None):
+        """A ProgressReporter that emits transfer_progress for ``name`` about ten times a second."""
+        def emit(done, total, bytes_per_second, seconds_left):
+            if pbar is not None:
+                pbar.update(done - pbar.n)
+            self.transfer_progress.emit(name, done, total, bytes_per_second / (1024 * 1024),
+                                        -1.0 if seconds_left is None else seconds_left)
+        return ProgressReporter(total, emit, initial)
 
     def run(self):
         if not self.connect_to_server():
             return
+        workers = [threading.Thread(target=self.transfer_worker, daemon=True) for _ in range(TRANSFER_WORKERS)]
+        for worker in workers:
+            worker.start()
             
         while self.running:
+            operation = self.commands.get()
+            if operation is None:
+                break
+            # Older servers take one connection per user, so transfers stay on ours
+            if operation.action in TRANSFER_ACTIONS and self.channel.framed and self.credentials:
+                self.transfers.put(operation)
+                continue
+            if not operation.set_running_or_notify_cancel():
+                continue
             try:
-                if self.action == 'list' and self.is_logged_in:
-                    self.handle_list_request()
-                elif self.action == 'login':
-                    self.handle_login()
-                elif self.action == 'logout':
-                    self.handle_logout()
-                elif self.action == 'download' and self.is_logged_in and self.file_names:
-                    self.handle_download()
-                elif self.action == 'upload' and self.is_logged_in and self.file_paths:
-                    self.handle_upload()
-                elif self.action == 'share' and self.is_logged_in:
-                    self.handle_share()
-                elif self.action == 'change_password' and self.is_logged_in:
-                    self.handle_password_change()
-                elif self.action == 'delete_account' and self.is_logged_in:
-                    self.handle_delete_account()
-                elif self.action == 'search' and self.is_logged_in:
-                    self.handle_search()
-                elif self.action == 'delete_file' and self.is_logged_in:
-                    self.handle_delete_file()
-                elif self.action == 'get_display_name' and self.is_logged_in:
-                    self.handle_get_display_name()
-                elif self.action == 'update_display_name' and self.is_logged_in:
-                    self.handle_update_display_name()
-                
-                self.action = None
-                while self.running and not self.action:
-                    QThread.msleep(50)
-                    
+                self.perform(operation)
             except ConnectionResetError as e:
                 self.error_occurred.emit(f"Connection lost: {str(e)}")
                 self.running = False
@@ -136,15 +267,225 @@ class FileTransferThread(QThread):
                 self.error_occurred.emit(f"Unexpected error: {str(e)}")
                 self.running = False
 
+        self.cancel_all()
+        for _ in workers:
+            self.transfers.put(None)
+        for worker in workers:
+            worker.join()
         self.cleanup_connection()
 
+    def perform(self, operation):
+        """Run an operation in the calling thread and settle its Future.
+
+        Exceptions from the handler are re-raised after being recorded on
+        the Future; a cancellation is only recorded.
+        """
+        handler, needs_login = self.ACTIONS.get(operation.action, (None, False))
+        if handler is None:
+            operation.set_exception(ValueError(f"Unknown action '{operation.action}'"))
+            return
+        if needs_login and not self.is_logged_in:
+            operation.set_exception(PermissionError(f"'{operation.action}' needs a logged-in session"))
+            return
+        self.operation = operation
+        try:
+            result = getattr(self, handler)(**operation.params)
+        except OperationCancelled as e:
+            operation.set_exception(CancelledError(str(e)))
+            return
+        except Exception as e:
+            operation.set_exception(e)
+            raise
+        finally:
+            self.operation = None
+        if operation.stop_requested.is_set():
+            operation.set_exception(CancelledError(f"'{operation.action}' stopped before it finished"))
+        else:
+            operation.set_result(result)
+
+    def transfer_worker(self):
+        """Run queued uploads and downloads over this worker's own connection."""
+        while True:
+            operation = self.transfers.get()
+            if operation is None:
+                break
+            if not operation.set_running_or_notify_cancel():
+                continue
+            try:
+                if self.channel_credentials != self.credentials:
+                    self.close_worker_channel()
+                    self.channel = open_logged_in_channel(self.host, self.port, *self.credentials)
+                    self.client_socket = self.channel.sock
+                    self.channel_credentials = self.credentials
+                self.perform(operation)
+            except Exception as e:
+                if not operation.done():
+                    operation.set_exception(e)
+                self.error_occurred.emit(f"Error: {str(e)}")
+                self.close_worker_channel()
+            if operation.cancelled() or operation.stop_requested.is_set():
+                # It may have stopped between frames; start over on a fresh connection
+                self.close_worker_channel()
+        self.close_worker_channel()
+
+    def close_worker_channel(self):
+        if self.client_socket:
+            try:
+                self.client_socket.close()
+            except OSError:
+                pass
+        self.channel = self.client_socket = self.channel_credentials = None
+
     def handle_list_request(self):
-        self.client_socket.send("LIST:".encode('utf-8'))
-        received_data = self.client_socket.recv(4096).decode('utf-8')
-        
+        if self.channel.framed and self.sync_catalog():
+            return
+        self.emit_file_lists(self.channel.request("LIST:"))
+
+    def sync_catalog(self, version=None):
+        """Bring the listing up to date and emit it; returns False if the server lacks LIST_PAGE.
+
+        Only the changes since the last sync are fetched, unless the server's
+        change log no longer reaches back that far. ``version``, from a
+        ``VERSION:<n>`` reply, skips the round trip if nothing changed, and
+        emits only what changed; without it the whole listing is emitted.
+        """
+        with self.catalog_lock:
+            if version is not None and self.catalog_version is not None and version <= self.catalog_version:
+                return True  # already seen, perhaps pushed as an event
+            changed = self.fetch_changes() if self.catalog_version is not None else None
+            if changed is None:
+                if not self.fetch_catalog():
+                    return False
+                version = None  # a new catalog: redraw the lists
+            changes = self.catalog_changes(changed) if version is not None else None
+            public_files = sorted(name for name, (public, _) in self.catalog.items() if public)
+            private_files = sorted(name for name, (_, private) in self.catalog.items() if private)
+        if changes is None:
+            self.update_file_list.emit(public_files, private_files)
+        elif changed:
+            self.file_list_changed.emit(*changes)
+        return True
+
+    def fetch_catalog(self):
+        """Page through the whole listing, then catch up on what changed meanwhile."""
+        catalog = {}
+        version = None
+        after = ''
+        while True:
+            reply = self.channel.request(f"LIST_PAGE:{LIST_PAGE_SIZE}:{after}")
+            if not reply.startswith("VERSION:"):
+                return False
+            fields = parse_listing(reply)
+            if version is None:
+                version = int(fields['VERSION'])
+            self.apply_listing(catalog, fields)
+            if 'NEXT' not in fields:
+                break
+            after = fields['NEXT']
+        self.catalog, self.catalog_version = catalog, version
+        self.fetch_changes()
+        return True
+
+    def fetch_changes(self):
+        """Apply LIST_CHANGES since catalog_version; returns the names changed, or None if the server wants a full listing."""
+        since = self.catalog_version
+        changed = set()
+        while True:
+            reply = self.channel.request(f"LIST_CHANGES:{since}:{LIST_PAGE_SIZE}")
+            if not reply.startswith("VERSION:"):
+                return None  # RESET
+            fields = parse_listing(reply)
+            changed |= self.apply_changes(self.catalog, fields)
+            since = int(fields['VERSION'])
+            if 'NEXT' not in fields:
+                break
+        self.catalog_version = since
+        return changed
+
+    def catalog_changes(self, names):
+        """(public, private, removed) for ``names``, as the catalog now has them."""
+        public = sorted(name for name in names if self.catalog.get(name, (False, False))[0])
+        private = sorted(name for name in names if self.catalog.get(name, (False, False))[1])
+        removed = sorted(name for name in names if name not in self.catalog)
+        return public, private, removed
+
+    @classmethod
+    def apply_changes(cls, catalog, fields):
+        """Apply a LIST_CHANGES reply or change event to ``catalog``; returns the names it touched."""
+        for name in fields['REMOVED']:
+            catalog.pop(name, None)
+        cls.apply_listing(catalog, fields)
+        return set(fields['REMOVED']) | set(fields['PUBLIC']) | set(fields['PRIVATE'])
+
+    @staticmethod
+    def apply_listing(catalog, fields):
+        public, private = set(fields['PUBLIC']), set(fields['PRIVATE'])
+        for name in public | private:
+            catalog[name] = (name in public, name in private)
+
+    def start_change_listener(self):
+        """Have the server push catalog changes, over a connection of their own, if it can."""
+        self.stop_change_listener()
+        self.events_stopped = threading.Event()
+        threading.Thread(target=self.listen_for_changes, args=(self.events_stopped,), daemon=True).start()
+
+    def stop_change_listener(self):
+        if self.events_stopped:
+            self.events_stopped.set()
+        events_channel, self.events_channel = self.events_channel, None
+        if events_channel:
+            try:
+                events_channel.sock.shutdown(socket.SHUT_RDWR)  # wakes the listener's recv
+            except OSError:
+                pass
+
+    def listen_for_changes(self, stopped):
+        """SUBSCRIBE and apply each change event until stopped; resubscribes if the server drops us."""
+        while self.running and not stopped.is_set() and self.credentials:
+            try:
+                channel = open_logged_in_channel(self.host, self.port, *self.credentials)
+            except (ConnectionError, OSError, ProtocolError):
+                return
+            try:
+                with self.catalog_lock:
+                    since = self.catalog_version
+                if since is None or not channel.request(f"SUBSCRIBE:{since}").startswith("SUBSCRIBED:"):
+                    return  # the server has no change events; listings come on request
+                self.events_channel = channel
+                if stopped.is_set():
+                    return  # logged out meanwhile
+                while True:
+                    self.apply_event(channel.recv_event())
+            except (ConnectionError, OSError, ProtocolError):
+                pass  # closed by logout, or the server dropped a subscriber that fell behind
+            finally:
+                channel.sock.close()
+            stopped.wait(EVENT_RECONNECT_DELAY)
+
+    def apply_event(self, event):
+        if event == "RESET":
+            # Too far behind for the change log: start again from a full listing
+            with self.catalog_lock:
+                self.catalog_version = None
+            self.queue_action('list')
+            return
+        fields = parse_listing(event)
+        with self.catalog_lock:
+            version = int(fields['VERSION'])
+            if self.catalog_version is None or version <= self.catalog_version:
+                return  # a sync has already fetched it
+            changes = self.catalog_changes(self.apply_changes(self.catalog, fields))
+            self.catalog_version = version
+        self.file_list_changed.emit(*changes)
+
+    def emit_file_lists(self, received_data):
         public_files = []
         private_files = []
         
+        if received_data.startswith("VERSION:"):
+            # A server that knows we keep the listing only says how current it is
+            self.sync_catalog(int(received_data[len("VERSION:"):]))
+            return
         if not received_data.startswith("Error:"):
             parts = received_data.split('|')
             for part in parts:
@@ -157,30 +498,48 @@ class FileTransferThread(QThread):
         
         self.update_file_list.emit(public_files, private_files)
 
-    def handle_login(self):
-        self.client_socket.send(f"LOGIN:{self.username}:{self.password}".encode('utf-8'))
-        response = self.client_socket.recv(1024).decode('utf-8')
+    def handle_login(self, username, password):
+        self.username, self.password = username, password
+        with self.catalog_lock:
+            self.catalog, self.catalog_version = {}, None
+        if self.channel.framed:
+            # ":VERSION" asks for the catalog version instead of the whole listing
+            response = self.channel.request(f"LOGIN:{username}:{password}:VERSION")
+            if response.startswith("Error: Invalid format"):  # older servers
+                response = self.channel.request(f"LOGIN:{username}:{password}")
+        else:
+            response = self.channel.request(f"LOGIN:{username}:{password}", 1024)
         
         if response == "Login successful.":
             self.is_logged_in = True
+            self.credentials = (self.username, self.password)
             self.login_status.emit(True)
             self.update_status.emit(response)
-            self.handle_list_request()
+            if self.channel.framed:
+                # The server sends the listing right behind the login reply
+                self.emit_file_lists(self.channel.recv_reply())
+                if self.catalog_version is not None:
+                    self.start_change_listener()
+            else:
+                self.handle_list_request()
             self.handle_get_display_name()  # Get display name after login
         else:
             self.error_occurred.emit(response)
             self.login_status.emit(False)
 
     def handle_logout(self):
-        self.client_socket.send("LOGOUT:".encode('utf-8'))
-        response = self.client_socket.recv(1024).decode('utf-8')
+        response = self.channel.request("LOGOUT:", 1024)
         self.is_logged_in = False
+        self.stop_change_listener()
         self.update_status.emit(response)
         self.login_status.emit(False)
         self.running = False
 
-    def handle_download(self):
-        for file_name in self.file_names:
+    def handle_download(self, file_names):
+        if self.channel.framed and len(file_names) > 1:
+            file_names = self.download_batches(file_names)
+        for file_name in file_names:
+            self.check_cancelled("Download")
             if file_name in self.paused_downloads:
                 self.resume_download(file_name)
             else:
@@ -190,45 +549,40 @@ class FileTransferThread(QThread):
         if file_name in self.download_tasks:
             return
 
-        self.client_socket.send(f"DOWNLOAD:{file_name}".encode('utf-8'))
+        # An older copy already downloaded only needs the chunks that changed
+        if self.channel.framed and self.start_delta_download(file_name):
+            return
 
-        # Flush buffer carefully until we find the correct header
-        header = b""
-        while b"\n" not in header:
-            chunk = self.client_socket.recv(1024)
-            if not chunk:
-                self.error_occurred.emit("Error: Server closed connection unexpectedly")
-                return
-            header += chunk
+        # Files go over parallel range requests where the server supports them;
+        # folders and older servers fall through to a single DOWNLOAD stream.
+        if self.channel.framed and self.start_parallel_download(file_name):
+            return
 
+        # Ask for folders as a stream we can unpack while it arrives; servers
+        # without DOWNLOAD_STREAM answer "Unknown command" and we fall back.
+        command = "DOWNLOAD_STREAM" if self.channel.framed else "DOWNLOAD"
         try:
-            header_line, remaining_data = header.split(b"\n", 1)
-            header_str = header_line.decode('utf-8').strip()
-        except Exception as e:
-            self.error_occurred.emit(f"Header decode failed: {str(e)}")
+            self.channel.send_command(f"{command}:{file_name}")
+            header_str, remaining_data = self.channel.recv_file_header()
+            if command == "DOWNLOAD_STREAM" and header_str.startswith("Unknown command"):
+                self.channel.send_command(f"DOWNLOAD:{file_name}")
+                header_str, remaining_data = self.channel.recv_file_header()
+        except ConnectionError as e:
+            self.error_occurred.emit(f"Error: {str(e)}")
             return
 
-        # Validate header
         if not header_str.startswith("FILE_SIZE:"):
-            # Scan for valid header inside corrupted buffer
-            index = header.find(b"FILE_SIZE:")
-            if index != -1:
-                try:
-                    header = header[index:]
-                    header_line, remaining_data = header.split(b"\n", 1)
-                    header_str = header_line.decode('utf-8').strip()
-                except Exception as e:
-                    self.error_occurred.emit(f"Recovered header failed: {str(e)}")
-                    return
-            else:
-                self.error_occurred.emit(f"Error: Invalid header format - {header_str}")
-                return
+            self.error_occurred.emit(header_str if header_str.startswith("Error:") else f"Error: Invalid header format - {header_str}")
+            return
 
         # Parse file size and zip flag
         parts = header_str.split(':')
         try:
             file_size = int(parts[1])
             is_zip = len(parts) > 2 and parts[2] == "ZIP"
+            is_stream = len(parts) > 2 and parts[2] == "STREAM"
+            checksum = header_checksum(header_str)
+            self.channel.recv_data_header(file_size - len(remaining_data))
         except Exception as e:
             self.error_occurred.emit(f"Error parsing header: {header_str}")
             return
@@ -237,34 +591,45 @@ class FileTransferThread(QThread):
         if not os.path.exists(self.download_dir):
             os.makedirs(self.download_dir)
 
+        if is_stream:
+            self.receive_folder_stream(file_name, file_size)
+            return
+
         file_path = os.path.join(self.download_dir, file_name + ('.zip' if is_zip else ''))
         received_size = len(remaining_data)
+        file_hash = new_hash(parse_checksum(checksum)[0]) if checksum else None
 
         try:
             with open(file_path, 'wb') as f:
                 f.write(remaining_data)
+                if file_hash:
+                    file_hash.update(remaining_data)
                 with tqdm(total=file_size, unit='B', unit_scale=True, desc=file_name, initial=received_size) as pbar:
-                    self.last_transfer_update = time.time()
-                    self.last_bytes_transferred = received_size
-
+                    progress = self.progress_reporter(file_name, file_size, received_size, pbar)
+                    buffer = ReceiveBuffer()
                     while received_size < file_size:
-                        if file_name in self.paused_downloads:
+                        if file_name in self.paused_downloads or self.cancelled():
                             self.download_tasks[file_name] = (f, received_size, file_size)
                             return
 
-                        data = self.client_socket.recv(min(4096, file_size - received_size))
+                        data = buffer.recv(self.client_socket, file_size - received_size)
                         if not data:
                             break
 
                         f.write(data)
+                        if file_hash:
+                            file_hash.update(data)
                         received_size += len(data)
-                        pbar.update(len(data))
-                        speed = self.calculate_speed(received_size)
-                        self.transfer_progress.emit(file_name, received_size, file_size, speed)
+                        progress.update(received_size)
 
             if file_name in self.download_tasks:
                 del self.download_tasks[file_name]
 
+            # The server sends the checksum normalized, so the strings compare directly
+            if file_hash and received_size == file_size and format_checksum(file_hash) != checksum:
+                repaired = verify_blocks(self.channel, file_name, file_path, file_size)
+                self.update_status.emit(f"'{file_name}' arrived corrupted; re-fetched {repaired} damaged block(s)")
+
             if is_zip:
                 extract_dir = os.path.join(self.download_dir, file_name)
                 shutil.unpack_archive(file_path, extract_dir, 'zip')
@@ -281,17 +646,221 @@ class FileTransferThread(QThread):
 
 
 
+    def download_batches(self, file_names):
+        """Fetch what DOWNLOAD_BATCH can of ``file_names``; returns the names left to download one by one."""
+        batched = [name for name in file_names if name not in self.paused_downloads and name not in self.download_tasks]
+        left = [name for name in file_names if name not in batched]
+        for start in range(0, len(batched), DOWNLOAD_BATCH_FILES):
+            self.check_cancelled("Download")
+            names = batched[start:start + DOWNLOAD_BATCH_FILES]
+            reply = self.channel.request(f"DOWNLOAD_BATCH:{DELTA_MIN_SIZE - 1}:" + '\n'.join(names))
+            if not reply.startswith("BATCH:"):
+                return left + batched[start:]  # older server
+            left += self.receive_batch(reply)
+        return left
+
+    def receive_batch(self, manifest):
+        """Write the files of a DOWNLOAD_BATCH as they arrive; returns the names the server skipped.
+
+        The whole batch is read even if the download is cancelled meanwhile,
+        since the connection is only usable again after its last file.
+        """
+        lines = manifest.split('\n')
+        total = int(lines[0].split(':')[2])
+        if not os.path.exists(self.download_dir):
+            os.makedirs(self.download_dir)
+        progress = self.progress_reporter(f"{lines[0].split(':')[1]} files", total)
+        buffer = ReceiveBuffer()
+        received = 0
+        skipped, corrupted, downloaded = [], [], 0
+        for line in lines[1:]:
+            kind, _, entry = line.partition(':')
+            if kind == "SKIP":
+                skipped.append(entry.split(':', 1)[1])
+                continue
+            if kind != "FILE":
+                message, _, file_name = entry.partition(':')
+                self.error_occurred.emit(f"Error: {message} for file '{file_name}'")
+                continue
+            size, algorithm, digest, file_name = entry.split(':', 3)
+            size = int(size)
+            file_hash = new_hash(algorithm) if algorithm else None
+            file_path = os.path.join(self.download_dir, file_name)
+            self.channel.recv_data_header(size)
+            with open(file_path, 'wb') as f:
+                writer = HashingWriter(f, file_hash) if file_hash else f
+                if receive_into(self.client_socket, writer, size, buffer=buffer,
+                                on_progress=lambda done: progress.update(received + done)) < size:
+                    raise ConnectionError("Server closed connection unexpectedly")
+            received += size
+            downloaded += 1
+            if file_hash and format_checksum(file_hash) != f"{algorithm}:{digest}":
+                corrupted.append((file_name, file_path, size))
+
+        # Repairs need the connection, so they wait until the batch is in
+        for file_name, file_path, size in corrupted:
+            try:
+                repaired = verify_blocks(self.channel, file_name, file_path, size)
+                self.update_status.emit(f"'{file_name}' arrived corrupted; re-fetched {repaired} damaged block(s)")
+            except Exception as e:
+                self.error_occurred.emit(f"Error saving file: {str(e)}")
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+        if downloaded:
+            self.update_status.emit(f"Downloaded {downloaded} files to '{self.download_dir}'")
+            if self.enable_notifications:
+                self.notify.emit(f"Download complete: {downloaded} files")
+        return skipped
+
+    def receive_folder_stream(self, file_name, stream_length):
+        target_dir = os.path.join(self.download_dir, file_name)
+        progress = self.progress_reporter(file_name, stream_length)
+        try:
+            files = extract_stream(self.client_socket, target_dir, stream_length,
+                                   on_progress=lambda received, total: progress.update(received))
+        except Exception as e:
+            self.error_occurred.emit(f"Error saving folder: {str(e)}")
+            return
+        self.update_status.emit(f"Downloaded folder '{file_name}' ({len(files)} files) to '{self.download_dir}'")
+        if self.enable_notifications:
+            self.notify.emit(f"Download complete: {file_name}")
+
+    def start_parallel_download(self, file_name):
+        """Download over several connections; returns False if the server declined ranges."""
+        if not os.path.exists(self.download_dir):
+            os.makedirs(self.download_dir)
+        file_path = os.path.join(self.download_dir, file_name)
+
+        def open_channel():
+            return open_logged_in_channel(self.host, self.port, *self.credentials)
+
+        progress = None
+
+        def report(received, total, bytes_per_second, streams):
+            nonlocal progress
+            if progress is None:
+                progress = self.progress_reporter(file_name, total)
+            progress.update(received)
+
+        downloader = ParallelDownloader(self.channel, open_channel, file_name, file_path, on_progress=report,
+                                        is_cancelled=lambda: file_name in self.paused_downloads or self.cancelled())
+        try:
+            received = downloader.run()
+        except RangeUnsupported:
+            return False
+        except Exception as e:
+            self.error_occurred.emit(f"Error saving file: {str(e)}")
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            return True
+
+        if received < downloader.file_size:
+            self.update_status.emit(f"Paused '{file_name}' at {received} of {downloader.file_size} bytes")
+            return True
+        if downloader.repaired:
+            self.update_status.emit(f"'{file_name}' arrived corrupted; re-fetched {downloader.repaired} damaged block(s)")
+
+        self.update_status.emit(f"Downloaded '{file_name}' to '{self.download_dir}' "
+                                f"({len(downloader.workers)} stream{'s' if len(downloader.workers) > 1 else ''})")
+        if self.enable_notifications:
+            self.notify.emit(f"Download complete: {file_name}")
+        return True
+
+    def start_delta_download(self, file_name):
+        """Update an older local copy by fetching only changed chunks; returns False if not done.
+
+        The local copy is chunked the same way as the server's manifest.
+        Chunks found locally are copied, runs of the others come over
+        DOWNLOAD_RANGE, and the copy is replaced only once the rebuilt file
+        matches the server's checksum.
+        """
+        file_path = os.path.join(self.download_dir, file_name)
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) < DELTA_MIN_SIZE:
+            return False
+        reply = self.channel.request(f"CHUNKS:{file_name}")
+        if not reply.startswith("CHUNKS:"):
+            return False  # no CHUNKS on this server, or an error the regular download reports
+        head, _, manifest = reply.partition('\n')
+        checksum = head[len("CHUNKS:"):]
+        chunks = parse_manifest(manifest)
+        file_size = sum(size for _, size, _ in chunks)
+        local_checksum, local_chunks = file_chunks(file_path, parse_checksum(checksum)[0])
+        if local_checksum == checksum:
+            self.update_status.emit(f"'{file_name}' in '{self.download_dir}' is already up to date")
+            return True
+        local = {chunk: offset for offset, _, chunk in local_chunks}
+        if not any(chunk in local for _, _, chunk in chunks):
+            return False
+
+        temp_path = file_path + '.delta'
+        file_hash = new_hash(parse_checksum(checksum)[0])
+        progress = self.progress_reporter(file_name, file_size)
+        buffer = ReceiveBuffer()
+        fetched = 0
+        try:
+            with open(file_path, 'rb') as old, open(temp_path, 'wb') as out:
+                sink = HashingWriter(out, file_hash)
+                index = 0
+                while index < len(chunks):
+                    self.check_cancelled(f"Download of '{file_name}'")
+                    start, size, chunk = chunks[index]
+                    if chunk in local:
+                        old.seek(local[chunk])
+                        sink.write(old.read(size))
+                        index += 1
+                    else:
+                        end = start
+                        while index < len(chunks) and chunks[index][2] not in local:
+                            end += chunks[index][1]
+                            index += 1
+                        _, length, served = request_range(self.channel, file_name, start, end)
+                        while length:
+                            data = buffer.recv(self.client_socket, length)
+                            if not data:
+                                raise ConnectionError(f"Connection closed while downloading '{file_name}'")
+                            sink.write(data)
+                            fetched += len(data)
+                            length -= len(data)
+                        if served != checksum:
+                            raise ChecksumMismatch(f"'{file_name}' changed on the server during the download")
+                    progress.update(out.tell())
+            if format_checksum(file_hash) != checksum:
+                raise ChecksumMismatch(f"'{file_name}' rebuilt from the local copy does not match the server")
+            os.replace(temp_path, file_path)
+        except (ChecksumMismatch, RangeUnsupported):
+            os.remove(temp_path)
+            return False  # download it whole instead
+        except OperationCancelled:
+            os.remove(temp_path)
+            raise
+        except Exception as e:
+            self.error_occurred.emit(f"Error saving file: {str(e)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return True
+
+        self.update_status.emit(f"Updated '{file_name}' in '{self.download_dir}' "
+                                f"({fetched} of {file_size} bytes downloaded)")
+        if self.enable_notifications:
+            self.notify.emit(f"Download complete: {file_name}")
+        return True
+
     def pause_download(self, file_name):
         self.paused_downloads.add(file_name)
         if file_name in self.download_tasks:
             del self.download_tasks[file_name]
 
-    def handle_upload(self):
-        for file_path in self.file_paths:
+    def handle_upload(self, file_paths, is_private=False):
+        if self.channel.framed and len(file_paths) > 1:
+            file_paths = self.upload_batches(file_paths, is_private)
+        for file_path in file_paths:
+            self.check_cancelled("Upload")
             is_folder = os.path.isdir(file_path)
             file_name = os.path.basename(file_path)
             
             try:
+                if is_folder and self.channel.framed and self.upload_folder_stream(file_path, file_name, is_private):
+                    continue
                 if is_folder:
                     # Create temp zip file
                     temp_zip = file_path + '.temp.zip'
@@ -304,29 +873,43 @@ class FileTransferThread(QThread):
                         continue
                     file_size = os.path.getsize(file_path)
                 
-                self.current_file_size = file_size
-                is_private = 1 if self.is_private else 0
+                is_private_flag = 1 if is_private else 0
                 is_folder_flag = 1 if is_folder else 0
                 
+                if self.channel.framed:
+                    source_path = temp_zip if is_folder else file_path
+                    try:
+                        # Content the server already holds is only named, not sent;
+                        # of a large file, only the chunks the server lacks are sent
+                        chunks = None
+                        if is_folder:
+                            checksum = None
+                        elif file_size >= DELTA_MIN_SIZE:
+                            checksum, chunks = file_chunks(file_path)
+                        else:
+                            checksum = self.content_checksum(file_path)
+                        handled = (checksum and self.upload_by_checksum(file_name, checksum, is_private_flag)) or \
+                            (chunks and self.upload_delta(file_name, file_path, file_size, is_private_flag, checksum, chunks)) or \
+                            self.upload_resumable(file_name, source_path, file_size, is_private_flag, is_folder_flag, checksum)
+                    except Exception as e:
+                        self.error_occurred.emit(f"Error uploading file: {str(e)}")
+                        handled = True
+                    if handled:
+                        if is_folder and os.path.exists(temp_zip):
+                            os.remove(temp_zip)
+                        continue
+                
                 # Send metadata first
-                self.client_socket.send(f"UPLOAD:{file_name}:{file_size}:{is_private}:{is_folder_flag}".encode('utf-8'))
+                self.channel.send_command(f"UPLOAD:{file_name}:{file_size}:{is_private_flag}:{is_folder_flag}")
+                self.channel.send_data_header(file_size)
                 
                 try:
                     source_path = temp_zip if is_folder else file_path
                     start_time = time.time()
-                    self.last_transfer_update = start_time
-                    self.last_bytes_transferred = 0
+                    progress = self.progress_reporter(file_name, file_size)
                     
                     with open(source_path, 'rb') as f:
-                        bytes_sent = 0
-                        while bytes_sent < file_size:
-                            chunk = f.read(min(4096, file_size - bytes_sent))
-                            if not chunk:
-                                break
-                            self.client_socket.sendall(chunk)
-                            bytes_sent += len(chunk)
-                            speed = self.calculate_speed(bytes_sent)
-                            self.transfer_progress.emit(file_name, bytes_sent, file_size, speed)
+                        bytes_sent = send_file(self.client_socket, f, 0, file_size, on_progress=progress.update)
                     
                     # Verify complete transfer
                     if bytes_sent != file_size:
@@ -340,12 +923,16 @@ class FileTransferThread(QThread):
                         os.remove(temp_zip)
                     
                     # Get server response
-                    response = self.client_socket.recv(1024).decode('utf-8')
+                    response = self.channel.recv_reply(1024)
                     self.update_status.emit(f"{response} (Speed: {speed:.2f} MB/s)")
                     if self.enable_notifications:
                         self.notify.emit(f"Upload complete: {file_name}")
                     
-                    self.handle_list_request()
+                    if self.channel.framed:
+                        # The server follows every upload with a fresh listing
+                        self.emit_file_lists(self.channel.recv_reply())
+                    else:
+                        self.handle_list_request()
                 except Exception as e:
                     self.error_occurred.emit(f"Error uploading file: {str(e)}")
                     # Clean up temp files on error
@@ -354,72 +941,287 @@ class FileTransferThread(QThread):
             except Exception as e:
                 self.error_occurred.emit(f"Error preparing upload: {str(e)}")
 
-    def handle_share(self):
-        file_name, target_user = self.file_names
-        self.client_socket.send(f"SHARE:{file_name}:{target_user}".encode('utf-8'))
-        response = self.client_socket.recv(1024).decode('utf-8')
+    def upload_batches(self, file_paths, is_private=False):
+        """Send the small files among ``file_paths`` in UPLOAD_BATCH streams; returns the paths left to upload one by one."""
+        batched, left = {}, []
+        for file_path in file_paths:
+            if os.path.isfile(file_path) and os.path.getsize(file_path) < UPLOAD_BATCH_MAX_FILE_SIZE:
+                batched[os.path.basename(file_path)] = file_path  # the last of two with the same name wins, as one by one
+            else:
+                left.append(file_path)
+        batches, batch, batch_bytes = [], [], 0
+        for file_name, file_path in batched.items():
+            size = os.path.getsize(file_path)
+            if batch and (len(batch) == UPLOAD_BATCH_FILES or batch_bytes + size > UPLOAD_BATCH_BYTES):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append((ENTRY_FILE, file_name, size, file_path))
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        for index, manifest in enumerate(batches):
+            if not self.upload_batch(manifest, is_private):
+                return left + [entry[3] for manifest in batches[index:] for entry in manifest]  # older server
+        return left
+
+    def upload_batch(self, manifest, is_private=False):
+        """Send one UPLOAD_BATCH, a folder stream of top-level files; returns False if the server can't take one."""
+        self.check_cancelled("Upload")
+        length = stream_size(manifest)
+        reply = self.channel.request(f"UPLOAD_BATCH:{length}:{int(is_private)}")
+        if reply != "READY":
+            if reply.startswith("Unknown command"):
+                return False
+            self.error_occurred.emit(reply)
+            return True
+
+        start_time = time.time()
+        progress = self.progress_reporter(f"{len(manifest)} files", length)
+        self.channel.send_data_header(length)
+        send_stream(self.client_socket, manifest, on_progress=progress.update)
+        transfer_time = time.time() - start_time
+        speed = (length / (1024 * 1024)) / transfer_time if transfer_time > 0 else 0  # MB/s
+        progress.update(length)
+
+        response = self.channel.recv_reply()
+        if response.startswith("Error:"):
+            self.error_occurred.emit(response)
+        else:
+            self.update_status.emit(f"{response} (Speed: {speed:.2f} MB/s)")
+            if self.enable_notifications:
+                self.notify.emit(f"Upload complete: {len(manifest)} files")
+        self.emit_file_lists(self.channel.recv_reply())
+        return True
+
+    def upload_folder_stream(self, folder_path, folder_name, is_private=False):
+        """Send a folder as a stream read straight from disk; returns False if the server can't take one."""
+        manifest = build_manifest(folder_path)
+        length = stream_size(manifest)
+        reply = self.channel.request(f"UPLOAD_STREAM:{folder_name}:{length}:{int(is_private)}")
+        if reply != "READY":
+            if reply.startswith("Unknown command"):
+                return False
+            self.error_occurred.emit(reply)
+            return True
+
+        start_time = time.time()
+        progress = self.progress_reporter(folder_name, length)
+        self.channel.send_data_header(length)
+        send_stream(self.client_socket, manifest, on_progress=progress.update)
+        transfer_time = time.time() - start_time
+        speed = (length / (1024 * 1024)) / transfer_time if transfer_time > 0 else 0  # MB/s
+        progress.update(length)
+
+        response = self.channel.recv_reply()
+        if response.startswith("Error:"):
+            self.error_occurred.emit(response)
+        else:
+            self.update_status.emit(f"{response} (Speed: {speed:.2f} MB/s)")
+            if self.enable_notifications:
+                self.notify.emit(f"Upload complete: {folder_name}")
+        self.emit_file_lists(self.channel.recv_reply())
+        return True
+
+    def reconnect(self):
+        """Replace a dropped connection with a freshly logged-in one."""
+        try:
+            self.client_socket.close()
+        except OSError:
+            pass
+        self.channel = open_logged_in_channel(self.host, self.port, *self.credentials)
+        self.client_socket = self.channel.sock
+        self.update_status.emit("Reconnected to server.")
+
+    def content_checksum(self, path):
+        """Checksum of a local file, remembered while its size and mtime stay the same."""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.checksum_cache:
+            self.checksum_cache[key] = file_checksum(path)
+        return self.checksum_cache[key]
+
+    def upload_by_checksum(self, file_name, checksum, is_private):
+        """Ask the server to store ``file_name`` from content it already has; returns False if it has none."""
+        reply = self.channel.request(f"UPLOAD_LINK:{file_name}:{is_private}:{checksum}")
+        if reply == "MISSING" or reply.startswith("Unknown command"):
+            return False
+        if reply.startswith("Error:"):
+            raise Exception(reply)
+        self.update_status.emit(reply)
+        if self.enable_notifications:
+            self.notify.emit(f"Upload complete: {file_name}")
+        self.emit_file_lists(self.channel.recv_reply())
+        return True
+
+    def upload_delta(self, file_name, file_path, file_size, is_private, checksum, chunks):
+        """Upload only the chunks of ``file_path`` the server lacks; returns False if it takes no deltas.
+
+        ``chunks`` come from file_chunks(). The server names the ones it holds
+        nowhere the user can read, typically those an edit touched, and
+        rebuilds the file from them and what it already has.
+        """
+        command = f"UPLOAD_DELTA:{file_name}:{file_size}:{is_private}:{checksum}\n{format_manifest(chunks)}"
+        if len(command.encode('utf-8')) > MAX_MESSAGE_SIZE:
+            return False
+        reply = self.channel.request(command)
+        if not reply.startswith("DELTA:"):
+            if reply.startswith("Unknown command"):
+                return False
+            raise Exception(reply)
+        _, upload_id, offset, needed = reply.split(':')
+        missing = [chunks[int(index)][:2] for index in needed.split(',')] if needed else []
+        length = sum(size for _, size in missing)
+        offset = int(offset)
+        self.update_status.emit(f"Sending {len(missing)} of {len(chunks)} chunks of '{file_name}' "
+                                f"({length} of {file_size} bytes)")
+
+        with open(file_path, 'rb') as f:
+            response, listing = self.send_upload_session(ChunkReader(f, missing), file_name, upload_id,
+                                                         offset, length, checksum)
+        self.update_status.emit(response)
+        if self.enable_notifications:
+            self.notify.emit(f"Upload complete: {file_name}")
+        self.emit_file_lists(listing)
+        return True
+
+    def upload_resumable(self, file_name, source_path, file_size, is_private, is_folder, checksum=None):
+        """Upload through a server upload session; returns False if the server has none.
+
+        Unless ``checksum`` is given, the file is hashed as it is sent; the
+        commit carries the checksum for the server to verify.
+        """
+        stat = os.stat(source_path)
+        fingerprint = f"{stat.st_size}-{stat.st_mtime_ns}"
+        reply = self.channel.request(f"UPLOAD_INIT:{file_name}:{file_size}:{is_private}:{is_folder}:{fingerprint}")
+        if not reply.startswith("UPLOAD_ID:"):
+            if reply.startswith("Unknown command"):
+                return False
+            raise Exception(reply)
+        _, upload_id, offset = reply.split(':')
+        offset = int(offset)
+        if offset:
+            self.update_status.emit(f"Resuming upload of '{file_name}' at {offset} of {file_size} bytes")
+
+        start_time = time.time()
+        start_offset = offset
+        running = None if checksum else RunningChecksum()
+        with open(source_path, 'rb') as f:
+            response, listing = self.send_upload_session(f, file_name, upload_id, offset, file_size, checksum, running)
+
+        transfer_time = time.time() - start_time
+        speed = ((file_size - start_offset) / (1024 * 1024)) / transfer_time if transfer_time > 0 else 0  # MB/s
+        self.update_status.emit(f"{response} (Speed: {speed:.2f} MB/s)")
+        if self.enable_notifications:
+            self.notify.emit(f"Upload complete: {file_name}")
+        self.emit_file_lists(listing)
+        return True
+
+    def send_upload_session(self, f, file_name, upload_id, offset, file_size, checksum=None, running=None):
+        """Send ``f`` from ``offset`` into an upload session and commit it; returns (result, listing).
+
+        A connection lost mid-upload is re-established and sending picks up
+        at the offset the server committed. Without ``checksum``, ``running``
+        (a RunningChecksum) supplies it for the commit.
+        """
+        failures = 0
+        progress = self.progress_reporter(file_name, file_size, offset)
+        while True:
+            self.check_cancelled(f"Upload of '{file_name}'")
+            try:
+                if offset < file_size:
+                    offset = self.send_upload_chunk(f, file_name, upload_id, offset, file_size, running, progress)
+                    failures = 0
+                    continue
+                checksum = checksum or running.checksum(f, file_size)
+                response = self.channel.request(f"UPLOAD_COMMIT:{upload_id}:{checksum}")
+                if response.startswith("Error:"):
+                    raise Exception(response)
+                return response, self.channel.recv_reply()
+            except (ConnectionError, OSError, ProtocolError) as e:
+                failures += 1
+                if failures > UPLOAD_RETRIES:
+                    raise Exception(f"Upload of '{file_name}' failed after {UPLOAD_RETRIES} retries: {str(e)}")
+                self.update_status.emit(f"Connection lost during upload of '{file_name}', retrying...")
+                time.sleep(min(2 ** (failures - 1), 10))
+                try:
+                    self.reconnect()
+                    offset = self.upload_offset(upload_id)
+                except (ConnectionError, OSError, ProtocolError):
+                    continue
+
+    def upload_offset(self, upload_id):
+        reply = self.channel.request(f"UPLOAD_STATUS:{upload_id}")
+        if not reply.startswith("OFFSET:"):
+            raise Exception(reply)
+        return int(reply.split(':')[1])
+
+    def send_upload_chunk(self, f, file_name, upload_id, offset, file_size, running=None, progress=None):
+        """Send one chunk from ``offset``; returns the server's new committed offset."""
+        length = min(UPLOAD_CHUNK_SIZE, file_size - offset)
+        self.channel.send_command(f"UPLOAD_CHUNK:{upload_id}:{offset}:{length}")
+        self.channel.send_data_header(length)
+        # Only folder zips we made ourselves are hashed on the way, so mapping them is safe
+        sent = send_file(self.client_socket, f, offset, length, on_data=running.update if running else None,
+                         on_progress=(lambda done: progress.update(offset + done)) if progress else None)
+        if sent < length:
+            raise Exception(f"'{file_name}' shrank while uploading")
+        reply = self.channel.recv_reply()
+        if not reply.startswith("OFFSET:"):
+            # Most likely our offset went stale; ask where the server is
+            self.update_status.emit(reply)
+            return self.upload_offset(upload_id)
+        return int(reply.split(':')[1])
+
+    def handle_share(self, file_name, target_user):
+        response = self.channel.request(f"SHARE:{file_name}:{target_user}", 1024)
         self.update_status.emit(response)
         if self.enable_notifications:
             self.notify.emit(response)
 
-    def handle_password_change(self):
-        self.client_socket.send(f"CHANGE_PASSWORD:{self.new_password}".encode('utf-8'))
-        response = self.client_socket.recv(1024).decode('utf-8')
+    def handle_password_change(self, new_password):
+        response = self.channel.request(f"CHANGE_PASSWORD:{new_password}", 1024)
         if response == "Password updated successfully.":
-            self.password = self.new_password
+            self.password = new_password
+            self.credentials = (self.username, new_password)
         self.update_status.emit(response)
 
     def handle_delete_account(self):
-        self.client_socket.send(f"DELETE_ACCOUNT:{self.username}".encode('utf-8'))
-        response = self.client_socket.recv(1024).decode('utf-8')
+        response = self.channel.request(f"DELETE_ACCOUNT:{self.username}", 1024)
         if response == "Account deleted successfully.":
             self.is_logged_in = False
             self.login_status.emit(False)
             self.running = False
         self.update_status.emit(response)
 
-    def handle_search(self):
-        search_query = ':'.join(self.file_names)  # Assuming file_names contains the search term
-        self.client_socket.send(f"SEARCH:{search_query}".encode('utf-8'))
-        received_data = self.client_socket.recv(4096).decode('utf-8')
-        
-        public_files = []
-        private_files = []
-        
-        if not received_data.startswith("Error:"):
-            parts = received_data.split('|')
-            for part in parts:
-                if part.startswith("PUBLIC:"):
-                    public_files = part.replace("PUBLIC:", "").split(',')
-                elif part.startswith("PRIVATE:"):
-                    private_files = part.replace("PRIVATE:", "").split(',')
-            public_files = [f for f in public_files if f]
-            private_files = [f for f in private_files if f]
-        
-        self.update_file_list.emit(public_files, private_files)
+    def handle_search(self, query):
+        # The server answers with its best matches; NEXT means there are more
+        response = self.channel.request(f"SEARCH:{query}")
+        fields = parse_listing(response) if not response.startswith("Error:") else {}
+        self.search_results.emit(fields.get('PUBLIC', []), fields.get('PRIVATE', []))
+        if "|NEXT:" in response:
+            shown = response.rsplit("|NEXT:", 1)[1]
+            self.update_status.emit(f"Showing the best {shown} matches for '{query}'. Refine the search to see others.")
 
-    def handle_delete_file(self):
-        for file_name in self.file_names:
-            self.client_socket.send(f"DELETE_FILE:{file_name}".encode('utf-8'))
-            response = self.client_socket.recv(1024).decode('utf-8')
+    def handle_delete_file(self, file_names):
+        for file_name in file_names:
+            response = self.channel.request(f"DELETE_FILE:{file_name}", 1024)
             self.update_status.emit(response)
             if response == f"File '{file_name}' deleted successfully.":
                 self.handle_list_request()
 
     def handle_get_display_name(self):
-        self.client_socket.send(f"GET_DISPLAY_NAME:{self.username}".encode('utf-8'))
-        response = self.client_socket.recv(1024).decode('utf-8')
+        response = self.channel.request(f"GET_DISPLAY_NAME:{self.username}", 1024)
         self.display_name = response
         self.display_name_received.emit(response)
 
-    def handle_update_display_name(self):
-        self.client_socket.send(f"UPDATE_DISPLAY_NAME:{self.display_name}".encode('utf-8'))
-        response = self.client_socket.recv(1024).decode('utf-8')
+    def handle_update_display_name(self, display_name):
+        response = self.channel.request(f"UPDATE_DISPLAY_NAME:{display_name}", 1024)
         self.update_status.emit(response)
         if response == "Display name updated successfully.":
             self.handle_get_display_name()
 
     def cleanup_connection(self):
+        self.stop_change_listener()
         if self.client_socket:
             try:
                 self.client_socket.close()
@@ -428,8 +1230,11 @@ class FileTransferThread(QThread):
         self.update_status.emit("Disconnected from server.")
 
     def stop(self):
+        """End the thread once the operation in progress returns; queued ones are cancelled."""
         self.running = False
-        self.action = None
+        self.stop_change_listener()
+        self.cancel_all()
+        self.commands.put(None)
 
 class SyncHandler(FileSystemEventHandler):
     def __init__(self, queue):
@@ -644,6 +1449,7 @@ class ClientGUI(QMainWindow):
         self.sync_queue = queue.Queue()
         self.sync_folder = None
         self.dark_mode = False
+        self.showing_search = False  # the lists hold search results, not the catalog
         self.init_ui()
 
     def init_ui(self):
@@ -745,7 +1551,7 @@ class ClientGUI(QMainWindow):
                 try:
                     port = int(server_port)  # Convert port to integer
                     self.start_transfer_thread(server_ip, port)
-                    self.thread.set_action('login', username=username, password=password)
+                    self.thread.queue_action('login', username=username, password=password)
                 except ValueError:
                     QMessageBox.warning(self, "Error", "Invalid port number")
                     self.show_login_screen()
@@ -1018,7 +1824,7 @@ class ClientGUI(QMainWindow):
             self.progress_label.setVisible(True)
             self.speed_label.setVisible(True)
             self.progress_bar.setValue(0)
-            self.thread.set_action('upload', file_paths=files, is_private=is_private)
+            self.thread.queue_action('upload', file_paths=files, is_private=is_private)
 
     def show_settings_dialog(self):
         dialog = SettingsDialog(self, dark_mode=self.dark_mode)
@@ -1029,14 +1835,14 @@ class ClientGUI(QMainWindow):
             if settings['password'] or settings['display_name']:
                 self.start_transfer_thread()
                 if settings['password']:
-                    self.thread.set_action('change_password', new_password=settings['password'])
+                    self.thread.queue_action('change_password', new_password=settings['password'])
                 if settings['display_name']:
-                    self.thread.set_action('update_display_name', display_name=settings['display_name'])
+                    self.thread.queue_action('update_display_name', display_name=settings['display_name'])
             if settings['sync_folder']:
                 self.start_folder_sync(settings['sync_folder'])
             if settings['delete_account']:
                 self.start_transfer_thread()
-                self.thread.set_action('delete_account')
+                self.thread.queue_action('delete_account')
             if self.thread:
                 self.thread.set_notifications(settings['notifications'])
 
@@ -1061,10 +1867,22 @@ class ClientGUI(QMainWindow):
         while self.is_logged_in:
             try:
                 action, path = self.sync_queue.get(timeout=1)
-                if action == 'upload' and self.thread and self.thread.isRunning():
-                    self.thread.set_action('upload', file_paths=[path], is_private=True)
             except queue.Empty:
                 continue
+            # Gather the rest of a burst, such as many files copied in at
+            # once, so they go up as one batch; repeated events for a file
+            # collapse into one upload
+            paths = {path} if action == 'upload' else set()
+            deadline = time.monotonic() + SYNC_BATCH_DELAY
+            while True:
+                try:
+                    action, path = self.sync_queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if action == 'upload':
+                    paths.add(path)
+            if paths and self.thread and self.thread.isRunning():
+                self.thread.queue_action('upload', file_paths=sorted(paths), is_private=True)
 
     def start_transfer_thread(self, server_ip=None, port=1253):
         if not self.thread or not self.thread.isRunning():
@@ -1077,6 +1895,8 @@ class ClientGUI(QMainWindow):
             self.thread.error_occurred.connect(self.show_error)
             self.thread.login_status.connect(self.handle_login_status)
             self.thread.update_file_list.connect(self.update_file_list)
+            self.thread.file_list_changed.connect(self.apply_file_list_changes)
+            self.thread.search_results.connect(self.show_search_results)
             self.thread.transfer_progress.connect(self.update_progress)
             self.thread.notify.connect(self.show_notification)
             self.thread.display_name_received.connect(self.update_display_name)
@@ -1110,7 +1930,7 @@ class ClientGUI(QMainWindow):
 
     def logout(self):
         if self.thread and self.thread.isRunning():
-            self.thread.set_action('logout')
+            self.thread.queue_action('logout')
             self.is_logged_in = False
             self.username = None
             self.display_name = None
@@ -1135,9 +1955,39 @@ class ClientGUI(QMainWindow):
 
     def refresh_file_list(self):
         if self.thread and self.thread.isRunning():
-            self.thread.set_action('list')
+            self.thread.queue_action('list')
 
     def update_file_list(self, public_files, private_files):
+        self.showing_search = False
+        self.show_file_lists(public_files, private_files)
+
+    def show_search_results(self, public_files, private_files):
+        self.showing_search = True
+        self.show_file_lists(public_files, private_files)
+
+    def apply_file_list_changes(self, public_files, private_files, removed_files):
+        """Update the lists in place for the names that changed, keeping the selection."""
+        if self.showing_search:
+            return  # Refresh brings the catalog back, changes included
+        for file_list, names, placeholder in ((self.public_file_list, public_files, "No public files available"),
+                                              (self.private_file_list, private_files, "No private files available")):
+            items = {file_list.item(row).text(): row for row in range(file_list.count())}
+            present = set(names)
+            changed = set(public_files) | set(private_files) | set(removed_files)
+            for row in sorted((items[name] for name in changed - present if name in items), reverse=True):
+                file_list.takeItem(row)
+            for name in names:
+                if name not in items:
+                    file_list.addItem(name)
+            placeholders = file_list.findItems(placeholder, Qt.MatchExactly)
+            if file_list.count() > len(placeholders):
+                for item in placeholders:
+                    file_list.takeItem(file_list.row(item))
+            elif not placeholders:
+                file_list.addItem(placeholder)
+            file_list.sortItems()
+
+    def show_file_lists(self, public_files, private_files):
         self.public_file_list.clear()
         self.private_file_list.clear()
         
@@ -1154,7 +2004,7 @@ class ClientGUI(QMainWindow):
     def search_files(self):
         search_query = self.search_input.text().strip()
         if search_query and self.thread and self.thread.isRunning():
-            self.thread.set_action('search', file_names=[search_query])
+            self.thread.queue_action('search', query=search_query)
 
     def download_files(self):
         selected_public = self.public_file_list.selectedItems()
@@ -1171,7 +2021,7 @@ class ClientGUI(QMainWindow):
             self.progress_label.setVisible(True)
             self.speed_label.setVisible(True)
             self.progress_bar.setValue(0)
-            self.thread.set_action('download', file_names=file_names)
+            self.thread.queue_action('download', file_names=file_names)
 
     def pause_download(self):
         selected_public = self.public_file_list.selectedItems()
@@ -1202,7 +2052,7 @@ class ClientGUI(QMainWindow):
                         self.progress_label.setVisible(True)
                         self.speed_label.setVisible(True)
                         self.progress_bar.setValue(0)
-                        self.thread.set_action('upload', file_paths=file_paths, is_private=is_private)
+                        self.thread.queue_action('upload', file_paths=file_paths, is_private=is_private)
 
     def delete_files(self):
         selected_public = self.public_file_list.selectedItems()
@@ -1218,7 +2068,7 @@ class ClientGUI(QMainWindow):
             reply = QMessageBox.question(self, "Confirm", f"Are you sure you want to delete {len(file_names)} file(s)?",
                                        QMessageBox.Yes | QMessageBox.No)
             if reply == QMessageBox.Yes:
-                self.thread.set_action('delete_file', file_names=file_names)
+                self.thread.queue_action('delete_file', file_names=file_names)
 
     def share_file(self):
         selected = self.private_file_list.selectedItems()
@@ -1229,17 +2079,18 @@ class ClientGUI(QMainWindow):
         target_user, ok = QInputDialog.getText(self, "Share File", "Enter username to share with:")
         if ok and target_user:
             if self.thread and self.thread.isRunning():
-                self.thread.set_action('share', file_names=[file_name, target_user])
+                self.thread.queue_action('share', file_name=file_name, target_user=target_user)
 
     def update_status(self, message):
         if self.status_label:
             self.status_label.setText(f"Status: {message}")
 
-    def update_progress(self, filename, current, total, speed):
+    def update_progress(self, filename, current, total, speed, seconds_left):
         if total > 0:
             progress = int((current / total) * 100)
             self.progress_label.setText(f"Transfer Progress: {filename} ({current:,}/{total:,} bytes)")
-            self.speed_label.setText(f"Speed: {speed:.2f} MB/s")
+            eta = format_duration(seconds_left if seconds_left >= 0 else None)
+            self.speed_label.setText(f"Speed: {speed:.2f} MB/s, ETA {eta}")
             self.progress_bar.setValue(progress)
             if progress >= 100:
                 self.progress_bar.setVisible(False)
@@ -1258,7 +2109,7 @@ class ClientGUI(QMainWindow):
     def closeEvent(self, event):
         if self.thread and self.thread.isRunning():
             if self.is_logged_in:
-                self.thread.set_action('logout')
+                self.thread.queue_action('logout')
             else:
                 self.thread.stop()
             self.thread.wait()
@@ -1,7 +1,19 @@
 import socket
+import sys
 import time
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from progress import ProgressReporter, format_progress
+from transport import apply_profile, receive_into, send_file
+
+def progress_line(name, total):
+    """A ProgressReporter that redraws one terminal line for ``name``."""
+    def show(done, total, bytes_per_second, seconds_left):
+        end = '\n' if done >= total else ''
+        print(f"\r{name}: {format_progress(done, total, bytes_per_second, seconds_left)}", end=end, flush=True)
+    return ProgressReporter(total, show)
+
 def start_client():
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     host = socket.gethostname()
@@ -11,6 +23,7 @@ def start_client():
     username = None
 
     try:
+        apply_profile(client_socket, host)
         client_socket.connect((host, port))
         print(f"Connected to server at {host}:{port}")
 
@@ -58,26 +71,26 @@ def start_client():
                 if not file_names:
                     print("No files specified.")
                     continue
-                client_socket.send(f"DOWNLOAD:{','.join(file_names)}".encode('utf-8'))
+                # DOWNLOAD takes one name; batches need protocol v2, which this client doesn't speak
                 for file_name in file_names:
-                    response = client_socket.recv(1024).decode('utf-8')
-                    if response.startswith("Error:"):
-                        print(response)
+                    client_socket.send(f"DOWNLOAD:{file_name}".encode('utf-8'))
+                    response = client_socket.recv(1024)
+                    if response.startswith(b"Error:"):
+                        print(response.decode('utf-8', errors='ignore'))
                         continue
-                    if response.startswith("FILE_SIZE:"):
-                        file_size = int(response[10:])
+                    if response.startswith(b"FILE_SIZE:"):
+                        # The start of the body may have come in the same recv as the header
+                        header, _, body = response.partition(b'\n')
+                        file_size = int(header[10:])
                         if not os.path.exists(download_dir):
                             os.makedirs(download_dir)
                         file_path = os.path.join(download_dir, file_name)
-                        received_size = 0
+                        progress = progress_line(file_name, file_size)
 
                         with open(file_path, 'wb') as f:
-                            while received_size < file_size:
-                                data = client_socket.recv(1024)
-                                if not data:
-                                    break
-                                f.write(data)
-                                received_size += len(data)
+                            f.write(body)
+                            receive_into(client_socket, f, file_size - len(body),
+                                         on_progress=lambda received: progress.update(len(body) + received))
                         print(f"File '{file_name}' downloaded to '{download_dir}'.")
 
             elif action == 'upload':
@@ -90,12 +103,9 @@ def start_client():
                     file_name = os.path.basename(file_path)
                     file_size = os.path.getsize(file_path)
                     client_socket.send(f"UPLOAD:{file_name}:{file_size}".encode('utf-8'))
+                    progress = progress_line(file_name, file_size)
                     with open(file_path, 'rb') as f:
-                        while True:
-                            data = f.read(1024)
-                            if not data:
-                                break
-                            client_socket.sendall(data)
+                        send_file(client_socket, f, 0, file_size, on_progress=progress.update)
                     response = client_socket.recv(1024).decode('utf-8')
                     print(response)
                     client_socket.send("LIST:".encode('utf-8'))
@@ -0,0 +1,131 @@
+"""File checksums, computed while bytes move instead of in a second pass.
+
+Checksums are stored and exchanged as ``<algorithm>:<hex digest>``. Rows
+recorded before the algorithm was part of the value hold a bare MD5 digest.
+"""
+import hashlib
+
+ALGORITHMS = ('blake2b', 'sha256', 'md5')
+DEFAULT_ALGORITHM = 'blake2b'
+
+READ_SIZE = 1024 * 1024
+# Granularity of per-block checksums, so a bad download can be repaired by
+# fetching only the blocks that differ. Download pieces are multiples of it.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def new_hash(algorithm):
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unsupported checksum algorithm '{algorithm}'")
+    return hashlib.new(algorithm)
+
+
+def format_checksum(hash_):
+    return f"{hash_.name}:{hash_.hexdigest()}"
+
+
+def parse_checksum(value):
+    """Split a checksum into (algorithm, hex digest)."""
+    algorithm, sep, digest = value.rpartition(':')
+    return (algorithm if sep else 'md5'), digest.lower()
+
+
+def file_checksum(path, algorithm=DEFAULT_ALGORITHM):
+    hash_ = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            hash_.update(chunk)
+    return format_checksum(hash_)
+
+
+def file_block_checksums(path, algorithm=DEFAULT_ALGORITHM, block_size=BLOCK_SIZE):
+    blocks = BlockChecksums(algorithm, block_size)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            blocks.update(chunk)
+    return blocks
+
+
+class ChecksumMismatch(Exception):
+    """Received bytes do not match the checksum they were sent with."""
+
+
+class HashingWriter:
+    """Wraps a writable file and feeds everything written through it to ``hashes``."""
+
+    def __init__(self, f, *hashes):
+        self.f = f
+        self.hashes = hashes
+
+    def write(self, data):
+        written = self.f.write(data)
+        for hash_ in self.hashes:
+            hash_.update(data)
+        return written
+
+
+class BlockChecksums:
+    """Checksums of consecutive ``block_size`` blocks, fed through update() like a hash."""
+
+    def __init__(self, algorithm=DEFAULT_ALGORITHM, block_size=BLOCK_SIZE):
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.blocks = []
+        self.hash = new_hash(algorithm)
+        self.filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.block_size - self.filled)
+            self.hash.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.block_size:
+                self.blocks.append(self.hash.hexdigest())
+                self.hash = new_hash(self.algorithm)
+                self.filled = 0
+
+    def hexdigests(self):
+        return self.blocks + ([self.hash.hexdigest()] if self.filled else [])
+
+
+def block_checksum(f, index, block_size, algorithm):
+    """Hex checksum of block ``index`` of an open file."""
+    hash_ = new_hash(algorithm)
+    f.seek(index * block_size)
+    remaining = block_size
+    while remaining:
+        data = f.read(min(READ_SIZE, remaining))
+        if not data:
+            break
+        hash_.update(data)
+        remaining -= len(data)
+    return hash_.hexdigest()
+
+
+class RunningChecksum:
+    """Checksum of a file that is sent in order, possibly with pieces re-sent or skipped.
+
+    update() only hashes bytes that extend the prefix hashed so far; if a
+    resume skipped ahead, checksum() reads the missing bytes back from the file.
+    """
+
+    def __init__(self, algorithm=DEFAULT_ALGORITHM):
+        self.hash = new_hash(algorithm)
+        self.position = 0
+
+    def update(self, position, data):
+        if position <= self.position < position + len(data):
+            self.hash.update(data[self.position - position:])
+            self.position = position + len(data)
+
+    def checksum(self, f, size):
+        f.seek(self.position)
+        while self.position < size:
+            data = f.read(min(READ_SIZE, size - self.position))
+            if not data:
+                break
+            self.hash.update(data)
+            self.position += len(data)
+        return format_checksum(self.hash)
@@ -0,0 +1,157 @@
+"""Content-defined chunking, so an edited file shares most chunks with the old version.
+
+A chunk boundary depends only on the few bytes just before it, so inserting or
+deleting bytes moves the cuts next to the edit and leaves every other cut
+where it was; a fixed-size split would shift every block after the edit.
+
+Every byte value belongs to one of two classes, and a cut falls after the
+first RUN_BEFORE_AVERAGE + 1 bytes whose classes alternate once a chunk is
+MIN_SIZE long, or the first RUN_AFTER_AVERAGE + 1 once it passes
+AVERAGE_SIZE, so sizes bunch up around the average (FastCDC's normalized
+chunking). A run of one repeated byte never alternates, so zero-filled
+regions fall back to MAX_SIZE chunks instead of MIN_SIZE ones. The scan is
+bytes.translate(), one big-int XOR and bytes.find() per window, all in C; a
+rolling hash stepped byte by byte in Python manages only a few MB/s.
+
+Manifests list a file's chunks in order, one ``<size> <checksum>`` per line.
+Chunk checksums always use CHUNK_ALGORITHM, so indexes built by different
+clients and servers agree.
+"""
+import random
+from bisect import bisect_right
+from itertools import accumulate
+
+from checksum import DEFAULT_ALGORITHM, format_checksum, new_hash
+
+CHUNK_ALGORITHM = 'blake2b'
+MIN_SIZE = 256 * 1024
+AVERAGE_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+RUN_BEFORE_AVERAGE = 20
+RUN_AFTER_AVERAGE = 17
+READ_SIZE = 4 * MAX_SIZE
+SCAN_SIZE = 256 * 1024
+
+
+def _class_table(seed):
+    """256 bytes, half of them 1 and half 0, the same on every machine."""
+    ones = set(random.Random(seed).sample(range(256), 128))
+    return bytes(int(value in ones) for value in range(256))
+
+# Fixed forever: a different table or size moves every boundary, and no chunk
+# of a file indexed before the change would match again
+_CLASSES = _class_table(0x6364632d636c7373)
+
+
+def _find_run(data, start, end, run):
+    """End offset of the first ``run + 1`` bytes of alternating class within data[start:end], or -1."""
+    target = b'\x01' * run
+    while end - start > run:
+        stop = min(start + SCAN_SIZE, end)
+        classes = data[start:stop].translate(_CLASSES)
+        # changes[i] is 1 where byte i + 1 of the window is in the other class from byte i.
+        # Searching this for a run of one value is far faster than searching
+        # ``classes`` for an alternating pattern.
+        changes = (int.from_bytes(classes[1:], 'little') ^ int.from_bytes(classes[:-1], 'little')).to_bytes(
+            len(classes) - 1, 'little')
+        found = changes.find(target)
+        if found >= 0:
+            return start + found + run + 1
+        # The next window starts early enough to catch a run across the seam
+        start = stop - run
+    return -1
+
+
+def cut_point(data, start, end):
+    """Length of the chunk that begins at ``data[start]``, given bytes up to ``end``.
+
+    ``end`` must reach MAX_SIZE past ``start`` unless it is the end of the file.
+    """
+    if end - start <= MIN_SIZE:
+        return end - start
+    average = min(start + AVERAGE_SIZE, end)
+    limit = min(start + MAX_SIZE, end)
+    cut = _find_run(data, start + MIN_SIZE, average, RUN_BEFORE_AVERAGE)
+    if cut < 0:
+        cut = _find_run(data, average, limit, RUN_AFTER_AVERAGE)
+    return (limit if cut < 0 else cut) - start
+
+
+def iter_chunks(f):
+    """Yield (offset, bytes) for each chunk of an open binary file, in order."""
+    data = b''
+    position = 0
+    offset = 0
+    eof = False
+    while True:
+        if not eof and len(data) - position < MAX_SIZE:
+            more = f.read(READ_SIZE)
+            eof = not more
+            data = data[position:] + more
+            position = 0
+        if position == len(data):
+            return
+        size = cut_point(data, position, len(data))
+        yield offset, data[position:position + size]
+        position += size
+        offset += size
+
+
+def file_chunks(path, algorithm=DEFAULT_ALGORITHM):
+    """Chunk a file; returns (whole-file checksum in ``algorithm``, [(offset, size, checksum), ...])."""
+    file_hash = new_hash(algorithm)
+    chunks = []
+    with open(path, 'rb') as f:
+        for offset, data in iter_chunks(f):
+            file_hash.update(data)
+            chunk_hash = new_hash(CHUNK_ALGORITHM)
+            chunk_hash.update(data)
+            chunks.append((offset, len(data), format_checksum(chunk_hash)))
+    return format_checksum(file_hash), chunks
+
+
+def format_manifest(chunks):
+    return ''.join(f"{size} {checksum}\n" for _, size, checksum in chunks)
+
+
+def parse_manifest(text):
+    """[(offset, size, checksum), ...] from a manifest; raises ValueError if malformed."""
+    chunks = []
+    offset = 0
+    for line in text.splitlines():
+        size, checksum = line.split(' ')
+        size = int(size)
+        if size <= 0 or size > MAX_SIZE:
+            raise ValueError(f"Invalid chunk size {size}")
+        chunks.append((offset, size, checksum))
+        offset += size
+    return chunks
+
+
+class ChunkReader:
+    """Reads some (offset, size) chunks of an open file back to back, as if they were one file."""
+
+    def __init__(self, f, chunks):
+        self.f = f
+        self.chunks = chunks
+        self.ends = list(accumulate(size for _, size in chunks))
+        self.position = 0
+
+    def seek(self, position):
+        self.position = position
+
+    def read(self, size):
+        index = bisect_right(self.ends, self.position)
+        if index == len(self.chunks):
+            return b''
+        offset, length = self.chunks[index]
+        within = self.position - (self.ends[index] - length)
+        self.f.seek(offset + within)
+        data = self.f.read(min(size, length - within))
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
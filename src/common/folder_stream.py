@@ -0,0 +1,176 @@
+"""Folders as a stream of entries, generated and unpacked on the fly.
+
+A folder travels as a sequence of entries, each an ENTRY_HEADER (kind,
+path length, body size), the UTF-8 relative path with '/' separators, and
+for files the file body. An ENTRY_END header closes the stream. The sender
+walks the folder once up front (stat only) so the total length is known
+before the first byte; the receiver writes every file as soon as its body
+arrives. Neither side builds an archive on disk.
+"""
+import os
+import struct
+
+from protocol import ProtocolError
+from checksum import DEFAULT_ALGORITHM, HashingWriter, format_checksum, new_hash
+
+ENTRY_HEADER = struct.Struct('!BHQ')
+
+ENTRY_END = 0
+ENTRY_FILE = 1
+ENTRY_DIR = 2
+
+CHUNK_SIZE = 64 * 1024
+# Files of up to CHUNK_SIZE are read whole and sent along with the entries
+# around them, up to this many bytes per send
+SEND_BATCH_SIZE = 256 * 1024
+
+
+def build_manifest(root):
+    """List (kind, relative path, size, absolute path) entries for ``root`` in a stable order."""
+    manifest = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, root)
+        if rel_dir != os.curdir:
+            manifest.append((ENTRY_DIR, rel_dir.replace(os.sep, '/'), 0, dirpath))
+        for name in sorted(filenames):
+            full_path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(full_path, root).replace(os.sep, '/')
+            manifest.append((ENTRY_FILE, rel_path, os.path.getsize(full_path), full_path))
+    return manifest
+
+
+def stream_size(manifest):
+    size = ENTRY_HEADER.size  # the end marker
+    for _, rel_path, body_size, _ in manifest:
+        size += ENTRY_HEADER.size + len(rel_path.encode('utf-8')) + body_size
+    return size
+
+
+def entry_header(kind, rel_path, size):
+    path = rel_path.encode('utf-8')
+    return ENTRY_HEADER.pack(kind, len(path), size) + path
+
+
+def send_stream(sock, manifest, use_sendfile=True, on_progress=None):
+    """Write the stream for ``manifest`` to ``sock``; returns bytes sent.
+
+    Exactly stream_size(manifest) bytes go out even if a file changed size
+    after the walk: a grown file is cut short and a shrunk one zero-padded.
+    """
+    sent = 0
+    pending = bytearray()  # headers and small bodies, sent several entries at a time
+    for kind, rel_path, size, full_path in manifest:
+        header = entry_header(kind, rel_path, size)
+        pending += header
+        sent += len(header)
+        if kind != ENTRY_FILE or not size:
+            continue
+        if size <= CHUNK_SIZE:
+            with open(full_path, 'rb') as f:
+                pending += f.read(size).ljust(size, b'\0')
+            if len(pending) >= SEND_BATCH_SIZE:
+                sock.sendall(pending)
+                pending.clear()
+        else:
+            sock.sendall(pending)
+            pending.clear()
+            with open(full_path, 'rb') as f:
+                body_sent = 0
+                if use_sendfile:
+                    try:
+                        body_sent = sock.sendfile(f, 0, size)
+                    except OSError:
+                        if f.tell() != 0:
+                            raise
+                f.seek(body_sent)
+                while body_sent < size:
+                    data = f.read(min(CHUNK_SIZE, size - body_sent)) or bytes(min(CHUNK_SIZE, size - body_sent))
+                    sock.sendall(data)
+                    body_sent += len(data)
+        sent += size
+        if on_progress:
+            on_progress(sent)
+    sock.sendall(pending + ENTRY_HEADER.pack(ENTRY_END, 0, 0))
+    return sent + ENTRY_HEADER.size
+
+
+def safe_join(root, rel_path):
+    """Resolve a stream path under ``root``, refusing anything that escapes it."""
+    parts = rel_path.split('/')
+    if not rel_path or rel_path.startswith('/') or any(part in ('', '.', '..') for part in parts) \
+            or any(':' in part or '\\' in part for part in parts):
+        raise ProtocolError(f"Unsafe path in folder stream: {rel_path!r}")
+    return os.path.join(root, *parts)
+
+
+def extract_stream(sock, root, length, on_progress=None, checksums=None, algorithm=DEFAULT_ALGORITHM):
+    """Read a ``length``-byte stream from ``sock`` and unpack it under ``root``.
+
+    Returns the relative paths of the files written, in stream order. If a
+    ``checksums`` dict is passed, each file's checksum is stored in it under
+    its relative path, computed as the body is written.
+    """
+    os.makedirs(root, exist_ok=True)
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    pending = view[:0]  # received but not yet unpacked; many small entries arrive in one recv
+    received = consumed = 0
+    files = []
+    made_dirs = {root}
+
+    def take(size, inside):
+        """Up to ``size`` bytes of the stream, receiving more only once ``pending`` is used up."""
+        nonlocal pending, received, consumed
+        if not pending:
+            n = sock.recv_into(view, min(CHUNK_SIZE, length - received))
+            if not n:
+                raise ConnectionError(f"Connection closed {inside}")
+            received += n
+            pending = view[:n]
+        data, pending = pending[:size], pending[size:]
+        consumed += len(data)
+        return data
+
+    def read_exact(size):
+        data = bytearray()
+        while len(data) < size:
+            data += take(size - len(data), f"{length - consumed} bytes before the end of the folder")
+        return bytes(data)
+
+    while True:
+        if consumed + ENTRY_HEADER.size > length:
+            raise ProtocolError("Folder stream ended without an end marker")
+        kind, path_length, size = ENTRY_HEADER.unpack(read_exact(ENTRY_HEADER.size))
+        if kind == ENTRY_END:
+            break
+        if consumed + path_length + size > length:
+            raise ProtocolError("Folder stream entry runs past the announced length")
+        rel_path = read_exact(path_length).decode('utf-8')
+        target = safe_join(root, rel_path)
+        if kind == ENTRY_DIR:
+            os.makedirs(target, exist_ok=True)
+            made_dirs.add(target)
+        elif kind == ENTRY_FILE:
+            if os.path.dirname(target) not in made_dirs:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                made_dirs.add(os.path.dirname(target))
+            hash_ = new_hash(algorithm) if checksums is not None else None
+            with open(target, 'wb') as out:
+                f = HashingWriter(out, hash_) if hash_ else out
+                remaining = size
+                while remaining:
+                    data = take(remaining, f"inside '{rel_path}'")
+                    f.write(data)
+                    remaining -= len(data)
+                    if on_progress:
+                        on_progress(consumed, length)
+            files.append(rel_path)
+            if hash_:
+                checksums[rel_path] = format_checksum(hash_)
+        else:
+            raise ProtocolError(f"Unknown folder stream entry type {kind}")
+
+    if consumed != length:
+        raise ProtocolError(f"Folder stream was {consumed} bytes, expected {length}")
+    return files
@@ -0,0 +1,330 @@
+"""Segmented downloads of one file over several connections at once.
+
+The file is requested in fixed-size pieces with DOWNLOAD_RANGE. The first
+piece goes over the caller's own connection and tells us the file size; the
+destination is then preallocated and every piece is written at its offset,
+so pieces may land in any order. Extra connections are opened one at a time
+for as long as each new stream still adds a worthwhile share of the
+throughput a single stream achieves.
+
+When the server sends a checksum with the file, every block a worker
+receives whole is hashed on the way to disk. The finished file is checked
+against the server's block checksums, and only blocks that differ are
+fetched again.
+"""
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from protocol import Channel, ProtocolError
+from checksum import BLOCK_SIZE, ChecksumMismatch, block_checksum, new_hash, parse_checksum
+from transport import ReceiveBuffer, apply_profile
+
+PIECE_SIZE = 16 * 1024 * 1024  # a multiple of BLOCK_SIZE, so pieces cover whole blocks
+MAX_STREAMS = int(os.environ.get('FT_MAX_STREAMS', '8'))
+RECV_BUFFER_SIZE = 256 * 1024
+
+# Progress is reported every TICK seconds; the stream count is reconsidered
+# every ADAPT_INTERVAL seconds. A stream that was just added has one
+# interval to ramp up before it is judged.
+TICK = 0.25
+ADAPT_INTERVAL = 1.0
+# Keep adding streams while the newest one lifts total throughput by at
+# least this fraction of the average per-stream throughput before it.
+MIN_MARGINAL_GAIN = 0.5
+# Rounds of re-fetching blocks whose checksum differs before giving up
+VERIFY_RETRIES = 3
+
+
+class RangeUnsupported(Exception):
+    """The server answered the first range request with something else."""
+
+
+def open_logged_in_channel(host, port, username, password, timeout=10.0):
+    """Open an extra framed connection and log it in; returns the Channel."""
+    sock = socket.create_connection((host, port), timeout)
+    apply_profile(sock, host)
+    try:
+        channel = Channel(sock)
+        if not channel.framed and channel.negotiate() < 2:
+            raise ProtocolError("Server does not speak protocol v2")
+        # Only the catalog version behind the login reply, not the whole listing
+        reply = channel.request(f"LOGIN:{username}:{password}:VERSION")
+        if reply.startswith("Error: Invalid format"):  # older servers
+            reply = channel.request(f"LOGIN:{username}:{password}")
+        if reply != "Login successful.":
+            raise ConnectionError(reply)
+        channel.recv_reply()  # the listing, or its version, pushed behind the login reply
+        sock.settimeout(None)
+        return channel
+    except Exception:
+        sock.close()
+        raise
+
+
+def header_checksum(header):
+    """The whole-file checksum in a ``FILE_SIZE:<n>:RAW:<algorithm>:<hex>`` header, or None."""
+    parts = header.split(':')
+    return ':'.join(parts[3:5]) if len(parts) >= 5 and parts[2] == "RAW" else None
+
+
+def request_range(channel, file_name, start, end):
+    """Ask for bytes [start, end) and read the header; returns (file_size, body_length, checksum)."""
+    channel.send_command(f"DOWNLOAD_RANGE:{file_name}:{start}:{end}")
+    header, _ = channel.recv_file_header()
+    if not header.startswith("FILE_SIZE:"):
+        raise RangeUnsupported(header)
+    file_size = int(header.split(':')[1])
+    length = max(min(end, file_size) - start, 0)
+    channel.recv_data_header(length)
+    return file_size, length, header_checksum(header)
+
+
+def request_block_checksums(channel, file_name):
+    """Returns (algorithm, block_size, [hex, ...]) or None if the server has no CHECKSUMS."""
+    reply = channel.request(f"CHECKSUMS:{file_name}")
+    if not reply.startswith("CHECKSUMS:"):
+        if reply.startswith("Unknown command"):
+            return None
+        raise ConnectionError(reply)
+    _, block_size, algorithm, digests = reply.split(':', 3)
+    return algorithm, int(block_size), digests.split(',') if digests else []
+
+
+def verify_blocks(channel, file_name, path, file_size, known=None):
+    """Check a downloaded file against the server's block checksums, re-fetching blocks that differ.
+
+    ``known`` maps block index to the checksum computed while that block
+    arrived; other blocks are read back from disk. Returns how many blocks
+    were fetched again; raises ChecksumMismatch if some still differ after
+    VERIFY_RETRIES rounds, or if the server cannot say which blocks are bad.
+    """
+    expected = request_block_checksums(channel, file_name)
+    if expected is None:
+        raise ChecksumMismatch(f"'{file_name}' is corrupt and the server cannot send block checksums")
+    algorithm, block_size, digests = expected
+    if len(digests) != -(-file_size // block_size):
+        raise ChecksumMismatch(f"'{file_name}' changed on the server during the download")
+    known = dict(known or {}) if block_size == BLOCK_SIZE else {}
+    refetched = 0
+    with open(path, 'r+b') as f:
+        for attempt in range(VERIFY_RETRIES + 1):
+            bad = [index for index, digest in enumerate(digests)
+                   if (known.pop(index, None) or block_checksum(f, index, block_size, algorithm)) != digest]
+            if not bad:
+                return refetched
+            if attempt == VERIFY_RETRIES:
+                raise ChecksumMismatch(f"{len(bad)} block(s) of '{file_name}' still differ after "
+                                       f"{VERIFY_RETRIES} re-fetches")
+            buffer = ReceiveBuffer()
+            for index in bad:
+                start = index * block_size
+                _, length, _ = request_range(channel, file_name, start, start + block_size)
+                hash_ = new_hash(algorithm)
+                f.seek(start)
+                while length:
+                    data = buffer.recv(channel.sock, length)
+                    if not data:
+                        raise ConnectionError(f"Connection closed while re-fetching block {index} of '{file_name}'")
+                    f.write(data)
+                    hash_.update(data)
+                    length -= len(data)
+                known[index] = hash_.hexdigest()
+                refetched += 1
+
+
+def preallocate(path, size):
+    with open(path, 'wb') as f:
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                pass
+        f.truncate(size)
+
+
+def write_at(fd, data, position):
+    while data:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, data, position)
+        else:
+            os.lseek(fd, position, os.SEEK_SET)
+            written = os.write(fd, data)
+        data = data[written:]
+        position += written
+
+
+class ParallelDownloader:
+    def __init__(self, channel, open_channel, file_name, path, piece_size=PIECE_SIZE,
+                 max_streams=MAX_STREAMS, on_progress=None, is_cancelled=None):
+        self.channel = channel
+        self.open_channel = open_channel
+        self.file_name = file_name
+        self.path = path
+        self.piece_size = piece_size
+        self.max_streams = max(1, max_streams)
+        self.on_progress = on_progress
+        self.is_cancelled = is_cancelled or (lambda: False)
+        self.file_size = 0
+        self.checksum = None
+        self.block_digests = {}  # block index -> checksum of a block received whole
+        self.repaired = 0  # blocks fetched again after failing verification
+        self.pieces = deque()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.received = []  # one counter per worker, summed by the controller
+        self.positions = []  # where each worker will write next
+        self.error = None
+
+    @property
+    def streams(self):
+        return sum(1 for worker in self.workers if worker.is_alive())
+
+    def run(self):
+        """Download the file; returns the number of bytes written.
+
+        Raises RangeUnsupported (with the connection still usable) if the
+        server refuses ranges, so the caller can fall back to DOWNLOAD.
+        Returns less than ``file_size`` when cancelled part-way. Raises
+        ChecksumMismatch if the file cannot be made to match its checksums.
+        """
+        self.file_size, first_length, self.checksum = request_range(self.channel, self.file_name, 0,
+                                                                    self.piece_size)
+        preallocate(self.path, self.file_size)
+        for start in range(first_length, self.file_size, self.piece_size):
+            self.pieces.append((start, min(start + self.piece_size, self.file_size)))
+
+        self.start_worker(self.channel, first=(0, first_length))
+        self.control()
+        for worker in self.workers:
+            worker.join()
+
+        received = sum(self.received)
+        if received < self.file_size and not self.is_cancelled():
+            raise self.error or ConnectionError(f"Download stopped after {received} of {self.file_size} bytes")
+        if received == self.file_size and self.checksum:
+            self.repaired = verify_blocks(self.channel, self.file_name, self.path, self.file_size,
+                                          self.block_digests)
+        return received
+
+    def start_worker(self, channel, first=None):
+        index = len(self.received)
+        self.received.append(0)
+        self.positions.append(0)
+        worker = threading.Thread(target=self.work, args=(channel, index, first, channel is not self.channel),
+                                  daemon=True, name=f"ft-range-{index}")
+        self.workers.append(worker)
+        worker.start()
+
+    def add_stream(self):
+        try:
+            channel = self.open_channel()
+        except Exception as e:
+            self.error = self.error or e
+            return False
+        self.start_worker(channel)
+        return True
+
+    def next_piece(self):
+        with self.lock:
+            if self.is_cancelled() or not self.pieces:
+                return None
+            return self.pieces.popleft()
+
+    def work(self, channel, index, first, owns_channel):
+        fd = os.open(self.path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        buffer = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(buffer)
+        piece = first
+        try:
+            while piece or (piece := self.next_piece()):
+                self.positions[index] = piece[0]
+                if piece is not first:
+                    request_range(channel, self.file_name, *piece)
+                self.receive(channel.sock, fd, view, index, *piece)
+                piece = None
+        except Exception as e:
+            with self.lock:
+                self.error = self.error or e
+                if piece is not None:
+                    # Hand back whatever of this piece did not arrive
+                    self.pieces.appendleft((self.positions[index], piece[1]))
+        finally:
+            os.close(fd)
+            if owns_channel:
+                try:
+                    channel.sock.close()
+                except OSError:
+                    pass
+
+    def receive(self, sock, fd, view, index, start, end):
+        algorithm = parse_checksum(self.checksum)[0] if self.checksum else None
+        block_hash = None  # only set while inside a block this range covers from its first byte
+        position = start
+        while position < end:
+            n = sock.recv_into(view, min(len(view), end - position))
+            if not n:
+                raise ConnectionError(f"Connection closed at byte {position} of range {start}-{end}")
+            write_at(fd, view[:n], position)
+            if algorithm:
+                block_hash = self.hash_blocks(view[:n], position, block_hash, algorithm)
+            position += n
+            self.positions[index] = position
+            self.received[index] += n
+
+    def hash_blocks(self, data, position, block_hash, algorithm):
+        """Feed ``data`` at ``position`` to the current block's hash; returns the hash to continue with."""
+        while data:
+            if position % BLOCK_SIZE == 0:
+                block_hash = new_hash(algorithm)
+            take = min(len(data), BLOCK_SIZE - position % BLOCK_SIZE)
+            if block_hash is not None:
+                block_hash.update(data[:take])
+            data = data[take:]
+            position += take
+            if position % BLOCK_SIZE == 0 or position == self.file_size:
+                if block_hash is not None:
+                    self.block_digests[(position - 1) // BLOCK_SIZE] = block_hash.hexdigest()
+                block_hash = None
+        return block_hash
+
+    def control(self):
+        last_time = time.monotonic()
+        last_bytes = 0
+        last_adapt = last_time
+        adapt_bytes = 0
+        growing = True
+        rate_before = None  # throughput before the newest stream was added
+        settling = False
+        while any(worker.is_alive() for worker in self.workers):
+            time.sleep(TICK)
+            now = time.monotonic()
+            received = sum(self.received)
+            if self.on_progress:
+                rate = (received - last_bytes) / (now - last_time) if now > last_time else 0.0
+                self.on_progress(received, self.file_size, rate, self.streams)
+            last_time, last_bytes = now, received
+
+            if now - last_adapt < ADAPT_INTERVAL:
+                continue
+            rate = (received - adapt_bytes) / (now - last_adapt)
+            last_adapt, adapt_bytes = now, received
+            if not growing or not self.pieces or self.is_cancelled():
+                continue
+            if settling:
+                settling = False  # give the new stream one interval to ramp up
+                continue
+            streams = self.streams
+            if rate_before is not None:
+                per_stream = rate_before / max(streams - 1, 1)
+                if rate - rate_before < MIN_MARGINAL_GAIN * per_stream:
+                    growing = False
+                    continue
+            if streams >= self.max_streams:
+                growing = False
+                continue
+            rate_before = rate
+            growing = settling = self.add_stream()
@@ -0,0 +1,87 @@
+"""Transfer progress reported at a bounded rate, with a smoothed speed and an ETA.
+
+Transfers move data in pieces of a few KiB, and reporting every piece sends
+millions of Qt signals across threads for a large file; the GUI thread then
+falls behind the transfer it is showing. A ProgressReporter takes every
+update but passes on at most one per INTERVAL, plus the final one, so an
+update costs a clock read and a comparison.
+
+The speed is an exponentially weighted moving average of the rate between
+reports. A sample's weight halves every HALF_LIFE seconds, so the estimate
+follows a real change in throughput within a few seconds without jumping
+around with every short stall.
+"""
+import time
+
+INTERVAL = 0.1
+HALF_LIFE = 3.0
+
+
+class ProgressReporter:
+    """Calls ``callback(done, total, bytes_per_second, seconds_left)`` at most every ``interval`` seconds.
+
+    ``seconds_left`` is None until there is a speed to estimate it from.
+    """
+
+    def __init__(self, total, callback, initial=0, interval=INTERVAL, half_life=HALF_LIFE, clock=time.monotonic):
+        self.total = total
+        self.callback = callback
+        self.interval = interval
+        self.half_life = half_life
+        self.clock = clock
+        self.initial = self.done = initial
+        self.speed = 0.0
+        self.started = self.sample_time = clock()
+        self.sample_done = initial
+        self.sampled = False
+        self.next_report = self.started + interval
+
+    def update(self, done):
+        """Record that ``done`` bytes are through; reports if one is due or the transfer is complete."""
+        self.done = done
+        now = self.clock()
+        if now >= self.next_report or done >= self.total:
+            self.report(now)
+
+    def advance(self, size):
+        self.update(self.done + size)
+
+    def report(self, now=None):
+        now = self.clock() if now is None else now
+        elapsed = now - self.sample_time
+        if elapsed > 0:
+            rate = max(self.done - self.sample_done, 0) / elapsed  # a retry can step back
+            if self.sampled:
+                weight = 0.5 ** (elapsed / self.half_life)
+                self.speed = weight * self.speed + (1 - weight) * rate
+            else:
+                self.speed = rate
+                self.sampled = True
+            self.sample_time, self.sample_done = now, self.done
+        self.next_report = now + self.interval
+        self.callback(self.done, self.total, self.speed, self.eta)
+
+    @property
+    def eta(self):
+        if self.speed <= 0:
+            return None
+        return max(self.total - self.done, 0) / self.speed
+
+    def average_speed(self):
+        """Bytes per second over the whole transfer so far."""
+        elapsed = self.clock() - self.started
+        return (self.done - self.initial) / elapsed if elapsed > 0 else 0.0
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+def format_progress(done, total, bytes_per_second, seconds_left):
+    """One line such as ``42.0% 12.50 MB/s ETA 1:07`` for a terminal or a label."""
+    percent = 100.0 * done / total if total else 100.0
+    return f"{percent:5.1f}% {bytes_per_second / (1024 * 1024):.2f} MB/s ETA {format_duration(seconds_left)}"
@@ -0,0 +1,182 @@
+import struct
+
+# Version 1 is the original text protocol: bare "COMMAND:args" strings and
+# replies read with a single recv(). Version 2 wraps every message in a fixed
+# binary header so commands, replies and file bodies can never run together.
+PROTOCOL_VERSION = 2
+
+# A client opts in by sending "HELLO:2" as plain text right after connecting.
+# A v2 server answers "HELLO:2" and both sides switch to frames; an older
+# server answers "Unknown command: ..." and the client stays on version 1.
+HELLO_COMMAND = f"HELLO:{PROTOCOL_VERSION}"
+
+# version, frame type, request id, payload length
+FRAME_HEADER = struct.Struct('!BBIQ')
+
+FRAME_COMMAND = 1
+FRAME_REPLY = 2
+FRAME_DATA = 3
+# Sent unprompted by the server on a connection that has sent SUBSCRIBE
+FRAME_EVENT = 4
+
+# Commands and replies are small; anything bigger travels as a DATA frame
+# whose payload is streamed by the caller.
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if not n:
+            raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+        received += n
+    return bytes(buffer)
+
+
+class Channel:
+    """One end of a connection, speaking frames once version 2 is agreed.
+
+    Until then every call falls back to the version 1 text behaviour, so the
+    same code path talks to old and new peers.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.version = 1
+        self.request_id = 0
+
+    @property
+    def framed(self):
+        return self.version >= 2
+
+    def negotiate(self):
+        """Client side: offer version 2 and fall back to text if refused."""
+        self.sock.sendall(HELLO_COMMAND.encode('utf-8'))
+        if self.sock.recv(1024).decode('utf-8', errors='ignore') == HELLO_COMMAND:
+            self.version = PROTOCOL_VERSION
+        return self.version
+
+    def accept_hello(self, args):
+        """Server side: answer a HELLO and switch to frames if we can."""
+        try:
+            offered = int(args.strip())
+        except ValueError:
+            offered = 1
+        if offered < PROTOCOL_VERSION:
+            self.sock.sendall(f"Error: Unsupported protocol version {args.strip()}".encode('utf-8'))
+            return
+        self.sock.sendall(HELLO_COMMAND.encode('utf-8'))
+        self.version = PROTOCOL_VERSION
+
+    def frame(self, frame_type, payload=b''):
+        """A whole frame as bytes, for callers that send it themselves."""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        return FRAME_HEADER.pack(self.version, frame_type, self.request_id, len(payload)) + payload
+
+    def send_frame(self, frame_type, payload=b''):
+        self.sock.sendall(self.frame(frame_type, payload))
+
+    def recv_frame_header(self):
+        version, frame_type, request_id, length = FRAME_HEADER.unpack(recv_exact(self.sock, FRAME_HEADER.size))
+        if version != self.version:
+            raise ProtocolError(f"Unexpected frame version {version}")
+        return frame_type, request_id, length
+
+    def recv_frame(self, expected_type):
+        frame_type, request_id, length = self.recv_frame_header()
+        if frame_type != expected_type:
+            raise ProtocolError(f"Expected frame type {expected_type}, got {frame_type}")
+        if length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"Frame of {length} bytes exceeds message limit")
+        self.request_id = request_id
+        return recv_exact(self.sock, length)
+
+    def send_command(self, command):
+        if self.framed:
+            self.request_id = (self.request_id + 1) & 0xFFFFFFFF
+            self.send_frame(FRAME_COMMAND, command)
+        else:
+            self.sock.send(command.encode('utf-8'))
+
+    def recv_command(self):
+        """Return the next command string, or '' when the peer has gone."""
+        if not self.framed:
+            return self.sock.recv(1024).decode('utf-8', errors='ignore')
+        try:
+            return self.recv_frame(FRAME_COMMAND).decode('utf-8', errors='ignore')
+        except ConnectionError:
+            return ''
+
+    def reply(self, message):
+        if self.framed:
+            self.send_frame(FRAME_REPLY, message)
+        else:
+            self.sock.sendall(message.encode('utf-8'))
+
+    def recv_reply(self, bufsize=4096):
+        if self.framed:
+            return self.recv_frame(FRAME_REPLY).decode('utf-8')
+        return self.sock.recv(bufsize).decode('utf-8')
+
+    def recv_event(self):
+        return self.recv_frame(FRAME_EVENT).decode('utf-8')
+
+    def request(self, command, bufsize=4096):
+        self.send_command(command)
+        return self.recv_reply(bufsize)
+
+    def send_data_header(self, length):
+        """Announce a body of ``length`` bytes; the caller streams it after."""
+        if self.framed:
+            self.sock.sendall(FRAME_HEADER.pack(self.version, FRAME_DATA, self.request_id, length))
+
+    def recv_data_header(self, expected_length):
+        """Consume the DATA frame header in front of a body, if framed."""
+        if not self.framed:
+            return expected_length
+        frame_type, _, length = self.recv_frame_header()
+        if frame_type != FRAME_DATA:
+            raise ProtocolError(f"Expected data frame, got type {frame_type}")
+        if length != expected_length:
+            raise ProtocolError(f"Data frame of {length} bytes, expected {expected_length}")
+        return length
+
+    def send_file_header(self, header):
+        """Send a FILE_SIZE header ahead of a download body."""
+        if self.framed:
+            self.reply(header)
+        else:
+            self.sock.sendall(f"{header}\n".encode('utf-8'))
+
+    def recv_file_header(self):
+        """Return (header, leftover body bytes) for a download.
+
+        Version 1 servers send the header as a newline-terminated line that
+        may arrive glued to stale replies or the start of the body, so we
+        have to scan for it. Version 2 replies are exact.
+        """
+        if self.framed:
+            return self.recv_reply(), b''
+
+        buffer = b""
+        while b"\n" not in buffer:
+            chunk = self.sock.recv(1024)
+            if not chunk:
+                raise ConnectionError("Server closed connection unexpectedly")
+            buffer += chunk
+            if buffer.startswith(b"Error:"):
+                return buffer.decode('utf-8', errors='ignore').strip(), b''
+
+        index = buffer.find(b"FILE_SIZE:")
+        if index > 0:
+            buffer = buffer[index:]
+        header_line, remaining = buffer.split(b"\n", 1)
+        return header_line.decode('utf-8', errors='ignore').strip(), remaining
@@ -0,0 +1,354 @@
+"""Socket options and I/O sizes for transfer connections.
+
+Profiles (FT_NET_PROFILE):
+
+``lan``
+    TCP_NODELAY, so a command or reply frame goes out at once instead of
+    waiting on the peer's delayed ACK. Buffers are left to the kernel, which
+    autotunes them; on Linux setting SO_RCVBUF turns that off, and a short
+    fast link needs no more than autotuning gives.
+``wan``
+    TCP_NODELAY and SO_KEEPALIVE, with SO_SNDBUF/SO_RCVBUF raised to
+    WAN_BUFFER_SIZE so a long round trip doesn't cap throughput at buffer
+    size / RTT. The kernel clamps the request to net.core.[rw]mem_max.
+``auto`` (default)
+    ``lan`` for loopback, private and link-local peers, ``wan`` otherwise.
+
+Transfer loops read and write through one preallocated buffer per transfer
+instead of a fresh bytes object per 4 KiB. A ChunkSizer picks the size of
+each call: it starts at MIN_CHUNK_SIZE and doubles toward MAX_CHUNK_SIZE
+while the link keeps up, so a fast link moves a megabyte per system call and
+a slow one still finishes each chunk quickly enough for progress and
+cancellation to stay responsive.
+
+receive_into() copies a body into a file with no allocation per chunk:
+f.write() gets views of the reused buffer. For a plain file on Linux it uses
+splice() through a pipe, so the bytes never reach Python at all; a writer
+that has to see them, such as a HashingWriter, always gets the buffer.
+send_file() is the sending side: socket.sendfile() when nothing needs to see
+the bytes, and a memory map when something does. send_within() bounds how
+long a message to a peer that has stopped reading may block the sender.
+"""
+import ipaddress
+import mmap
+import os
+import select
+import socket
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+PROFILES = ('auto', 'lan', 'wan')
+NET_PROFILE = os.environ.get('FT_NET_PROFILE', 'auto')
+# Covers 1 Gbit/s at a 64 ms round trip
+WAN_BUFFER_SIZE = 8 * 1024 * 1024
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+# A chunk sent in less than this is too small; one taking four times as long is too big
+SEND_TARGET = 0.01
+
+# os.splice exists on Linux from Python 3.10; FT_SPLICE=0 turns it off
+SPLICE = hasattr(os, 'splice') and os.environ.get('FT_SPLICE', '1') != '0'
+SPLICE_PIPE_SIZE = 1024 * 1024
+
+# send_within() sends at most this much per call, once select() says the socket
+# is writable: little enough for any platform's send buffer to take at once
+SEND_WITHIN_PIECE = 4096
+
+
+def profile_for(host):
+    """The profile ``auto`` picks for a peer address."""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        try:
+            address = ipaddress.ip_address(socket.gethostbyname(host))
+        except (OSError, ValueError):
+            return 'wan'
+    if address.is_loopback or address.is_private or address.is_link_local:
+        return 'lan'
+    return 'wan'
+
+
+def apply_profile(sock, host=None, profile=None):
+    """Set the profile's options on a TCP socket; returns the profile applied.
+
+    ``host`` is the peer, needed for ``auto`` before the socket is connected.
+    Call it before connect() where possible: the receive buffer in place at
+    the handshake decides the window scale some systems offer.
+    """
+    profile = profile or NET_PROFILE
+    if profile not in PROFILES:
+        profile = 'auto'
+    if profile == 'auto':
+        if host is None:
+            try:
+                host = sock.getpeername()[0]
+            except OSError:
+                host = 'localhost'
+        profile = profile_for(host)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if profile == 'wan':
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, WAN_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, WAN_BUFFER_SIZE)
+    except OSError:
+        pass  # not TCP (a socketpair in tests), or an option the platform lacks
+    return profile
+
+
+class ChunkSizer:
+    """The size for the next read or write, adjusted from how the last ones went."""
+
+    def __init__(self, minimum=MIN_CHUNK_SIZE, maximum=MAX_CHUNK_SIZE):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = minimum
+
+    def received(self, count):
+        # A recv that fills the whole buffer means more was already waiting
+        if count >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+
+    def sent(self, count, seconds):
+        if count < self.size:
+            return  # a short tail says nothing about the link
+        if seconds < SEND_TARGET:
+            self.size = min(self.size * 2, self.maximum)
+        elif seconds > 4 * SEND_TARGET:
+            self.size = max(self.size // 2, self.minimum)
+
+
+class ReceiveBuffer:
+    """recv_into() one reusable buffer, grown as the ChunkSizer asks."""
+
+    def __init__(self, sizer=None):
+        self.sizer = sizer or ChunkSizer()
+        self.resize(self.sizer.size)
+
+    def resize(self, size):
+        # A new buffer rather than an in-place resize, which fails while a
+        # view handed out by recv() is still alive
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def recv(self, sock, limit):
+        """Up to ``limit`` bytes from ``sock`` as a view into the buffer, valid until the next call.
+
+        An empty view means the peer closed the connection.
+        """
+        size = min(self.sizer.size, limit)
+        if size > len(self.buffer):
+            self.resize(self.sizer.size)
+        count = sock.recv_into(self.view, size)
+        if count == size:
+            self.sizer.received(count)
+        return self.view[:count]
+
+
+def read_chunks(f, count, sizer=None):
+    """Yield up to ``count`` bytes of ``f`` from its current position, as views into one reused buffer.
+
+    Each view is only valid until the next is requested. The time the caller
+    takes with a chunk, typically sending it, sizes the ones after it.
+    """
+    sizer = sizer or ChunkSizer()
+    buffer = bytearray(sizer.size)
+    while count > 0:
+        size = min(sizer.size, count)
+        if size > len(buffer):
+            buffer = bytearray(sizer.size)
+        read = f.readinto(memoryview(buffer)[:size])
+        if not read:
+            return
+        started = time.monotonic()
+        yield memoryview(buffer)[:read]
+        sizer.sent(read, time.monotonic() - started)
+        count -= read
+
+
+def receive_into(sock, f, length, on_progress=None, buffer=None):
+    """Copy ``length`` bytes from ``sock`` into the writable ``f``; returns how many arrived.
+
+    Fewer than ``length`` means the peer closed the connection. ``on_progress``
+    is called with the running total after every chunk. ``buffer``, a
+    ReceiveBuffer, lets consecutive bodies share one.
+    """
+    received = 0
+    if can_splice(sock, f):
+        received = splice_into(sock, f, length, on_progress)
+        if received is not None:
+            return received
+        received = 0
+    buffer = buffer or ReceiveBuffer()
+    while received < length:
+        data = buffer.recv(sock, length - received)
+        if not data:
+            break
+        f.write(data)
+        received += len(data)
+        if on_progress:
+            on_progress(received)
+    return received
+
+
+def can_splice(sock, f):
+    if not SPLICE or fcntl is None or sock.gettimeout() is not None:
+        return False  # a socket with a timeout is non-blocking underneath
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False  # wrappers that must see the bytes have no fileno()
+    # splice() refuses files opened for appending
+    return not fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND
+
+
+def splice_into(sock, f, length, on_progress=None):
+    """receive_into() by splice(); returns None if the kernel refused before any byte moved."""
+    f.flush()
+    read_end, write_end = os.pipe()
+    received = 0
+    try:
+        try:
+            fcntl.fcntl(write_end, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass  # the default 64 KiB pipe still works
+        while received < length:
+            try:
+                count = os.splice(sock.fileno(), write_end, min(SPLICE_PIPE_SIZE, length - received))
+            except OSError:
+                if received:
+                    raise
+                return None
+            if not count:
+                break
+            moved = 0
+            while moved < count:
+                moved += os.splice(read_end, f.fileno(), count - moved)
+            received += count
+            if on_progress:
+                on_progress(received)
+    finally:
+        os.close(read_end)
+        os.close(write_end)
+        f.seek(0, os.SEEK_CUR)  # the file object's idea of its position is stale
+    return received
+
+
+def send_file(sock, f, offset, count, on_data=None, on_progress=None):
+    """Send ``count`` bytes of the open file ``f`` from ``offset``; returns how many were sent.
+
+    Without ``on_data`` the kernel sends straight from the page cache with
+    socket.sendfile(). With it, the range is memory-mapped and
+    ``on_data(position, view)`` sees every piece before it goes out, still
+    without a copy into a Python object. A mapped file must not shrink while
+    it is sent (that raises SIGBUS), so map only files nobody else writes,
+    such as our own temporary zips. Files that can be neither, like a
+    ChunkReader, go through read_chunks(). ``on_progress(sent)`` follows
+    every piece. Fewer than ``count`` bytes sent means the file shrank.
+    """
+    if on_data is None and hasattr(f, 'fileno'):
+        return sendfile_range(sock, f, offset, count, on_progress)
+    try:
+        mapped, skip = map_range(f, offset, count)
+    except (AttributeError, OSError, ValueError):
+        mapped = None  # no fileno, too short to map, or a filesystem without mmap
+    if mapped is None:
+        f.seek(offset)
+        pieces = read_chunks(f, count)
+    else:
+        pieces = iter_views(mapped, skip, count)
+    sent = 0
+    piece = None
+    try:
+        for piece in pieces:
+            if on_data:
+                on_data(offset + sent, piece)
+            sock.sendall(piece)
+            sent += len(piece)
+            if on_progress:
+                on_progress(sent)
+    finally:
+        if mapped is not None:
+            # The map can only close once no view of it is left
+            piece = None
+            pieces.close()
+            close_map(mapped)
+    return sent
+
+
+def sendfile_range(sock, f, offset, count, on_progress=None):
+    sizer = ChunkSizer()
+    sent = 0
+    while sent < count:
+        size = min(sizer.size, count - sent)
+        started = time.monotonic()
+        done = sock.sendfile(f, offset + sent, size)
+        if not done:
+            break
+        sizer.sent(done, time.monotonic() - started)
+        sent += done
+        if on_progress:
+            on_progress(sent)
+    return sent
+
+
+def map_range(f, offset, count):
+    """Map ``count`` bytes of ``f`` from ``offset``; returns (mmap, start of the range within it)."""
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    return mmap.mmap(f.fileno(), offset - start + count, access=mmap.ACCESS_READ, offset=start), offset - start
+
+
+def iter_views(mapped, skip, count):
+    sizer = ChunkSizer()
+    view = memoryview(mapped)
+    position = skip
+    end = skip + count
+    while position < end:
+        size = min(sizer.size, end - position)
+        piece = view[position:position + size]
+        started = time.monotonic()
+        yield piece
+        sizer.sent(size, time.monotonic() - started)
+        position += size
+
+
+def close_map(mapped):
+    try:
+        mapped.close()
+    except BufferError:
+        pass  # a caller still holds a view; the map goes when that does
+
+
+def send_within(sock, data, timeout):
+    """sendall() that gives up after ``timeout`` seconds; returns how many bytes went out.
+
+    The socket stays in blocking mode, so a thread blocked in recv() on it
+    is not disturbed. Instead every send waits for select() to report room
+    and passes no more than SEND_WITHIN_PIECE, on every platform; Windows
+    has no MSG_DONTWAIT to fall back on. Fewer than len(data) bytes means
+    the peer stopped reading, and a partly sent message has broken the
+    stream.
+    """
+    view = memoryview(data)
+    deadline = time.monotonic() + timeout
+    sent = 0
+    while sent < len(view):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([], [sock], [], remaining)[1]:
+            break
+        try:
+            sent += sock.send(view[sent:sent + SEND_WITHIN_PIECE])
+        except (BlockingIOError, InterruptedError):
+            pass
+    return sent
+
+
+def writable(sock):
+    """Whether ``sock`` has room in its send buffer right now."""
+    return bool(select.select([], [sock], [], 0)[1])
@@ -12,6 +12,10 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QH
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer, QPropertyAnimation, QEasingCurve
 from PyQt5.QtGui import QPalette, QColor, QFont, QIcon, QPainter, QBrush
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from progress import ProgressReporter
+from transport import send_file
+
 # --- Modern Stylesheet (QSS) ---
 STYLESHEET = """
 QWidget {{
@@ -224,6 +228,7 @@ class FileTransferThread(QThread):
                 is_zip = len(parts) > 2 and parts[2] == 'ZIP'
                 path = os.path.join(self.download_dir, name + ('.zip' if is_zip else ''))
                 recvd = 0
+                progress = ProgressReporter(size, lambda done, total, *_: self.transfer_progress.emit(name, done, total))
                 try:
                     with open(path, 'wb') as f:
                         while recvd < size:
@@ -231,7 +236,7 @@ class FileTransferThread(QThread):
                             if not chunk: break
                             f.write(chunk)
                             recvd += len(chunk)
-                            self.transfer_progress.emit(name, recvd, size)
+                            progress.update(recvd)
                     if is_zip:
                         shutil.unpack_archive(path, os.path.join(self.download_dir, name), 'zip')
                         os.remove(path)
@@ -246,12 +251,9 @@ class FileTransferThread(QThread):
             try:
                 size = os.path.getsize(src)
                 self.client_socket.send(f"UPLOAD:{name}:{size}:{1 if is_private else 0}:{1 if is_folder else 0}".encode('utf-8'))
+                progress = ProgressReporter(size, lambda done, total, *_: self.transfer_progress.emit(name, done, total))
                 with open(src, 'rb') as f:
-                    sent = 0
-                    while chunk := f.read(4096):
-                        self.client_socket.sendall(chunk)
-                        sent += len(chunk)
-                        self.transfer_progress.emit(name, sent, size)
+                    send_file(self.client_socket, f, 0, size, on_progress=progress.update)
                 resp = self.client_socket.recv(1024).decode('utf-8')
                 if not resp.startswith("Error"):
                     if self.enable_notifications: self.notification.emit(f"Uploaded: {name}")
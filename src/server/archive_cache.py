@@ -0,0 +1,122 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class ArchiveCache:
+    """Built folder zips, reused while the folder's recorded contents are unchanged.
+
+    Entries are keyed by folder name plus a fingerprint of that folder's rows
+    in the files table, so any upload or delete under the folder yields a new
+    key; invalidate() just frees the stale archive early. Archives are evicted
+    least recently used first once the cache holds more than ``max_bytes``,
+    except while a download is still sending them. Concurrent requests for
+    an archive that is being built wait for that one build.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> [path, size, readers, stale]
+        self.building = {}  # key -> threading.Event
+        self.total_bytes = 0
+        # Archives from a previous run are not indexed; start clean
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(folder_name, fingerprint):
+        return f"{folder_name}\0{fingerprint}"
+
+    def path_for(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.zip')
+
+    @contextmanager
+    def archive(self, folder_name, folder_path, fingerprint):
+        """Yield the path of a zip of ``folder_path``, building it at most once per fingerprint."""
+        key = self.key(folder_name, fingerprint)
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry:
+                    entry[2] += 1
+                    self.entries.move_to_end(key)
+                    break
+                event = self.building.get(key)
+                if event is None:
+                    event = self.building[key] = threading.Event()
+                    builder = True
+                else:
+                    builder = False
+            if not builder:
+                event.wait()
+                continue
+            try:
+                entry = self.build(key, folder_path)
+            finally:
+                with self.lock:
+                    del self.building[key]
+                event.set()
+            break
+        try:
+            yield entry[0]
+        finally:
+            with self.lock:
+                entry[2] -= 1
+                if entry[3]:
+                    self.drop(key)
+                self.evict()
+
+    def build(self, key, folder_path):
+        path = self.path_for(key)
+        base = path[:-len('.zip')] + f".{threading.get_ident()}.building"
+        built = shutil.make_archive(base, 'zip', folder_path)
+        os.replace(built, path)
+        entry = [path, os.path.getsize(path), 1, False]
+        with self.lock:
+            self.entries[key] = entry
+            self.total_bytes += entry[1]
+            self.evict()
+        return entry
+
+    def evict(self):
+        """Drop idle archives, oldest use first, until within budget. Call with the lock held."""
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if not self.entries[key][2]:
+                self.drop(key)
+
+    def drop(self, key):
+        """Delete an archive now, or once its last reader is done. Call with the lock held."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        path, size, readers, _ = entry
+        if readers:
+            entry[3] = True
+            return
+        del self.entries[key]
+        self.total_bytes -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def invalidate(self, file_name):
+        """Forget archives of every cached folder that contains ``file_name`` (or is it)."""
+        with self.lock:
+            for key in list(self.entries):
+                folder_name = key.split('\0', 1)[0]
+                if file_name == folder_name or file_name.startswith(folder_name.rstrip('/' + os.sep) + os.sep) \
+                        or folder_name.startswith(file_name.rstrip('/' + os.sep) + os.sep):
+                    self.drop(key)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self.drop(key)
@@ -0,0 +1,1883 @@
+import os
+import sys
+import json
+import logging
+import threading
+import time
+import socket
+import sqlite3
+import shutil
+import uuid
+import zipfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from protocol import FRAME_DATA, FRAME_EVENT, MAX_MESSAGE_SIZE, Channel, HELLO_COMMAND
+from folder_stream import build_manifest, stream_size, send_stream, extract_stream, safe_join
+from checksum import (ALGORITHMS, DEFAULT_ALGORITHM, BlockChecksums, HashingWriter, file_block_checksums,
+                      file_checksum, format_checksum, new_hash, parse_checksum)
+from chunking import CHUNK_ALGORITHM, file_chunks, format_manifest, parse_manifest
+from transport import apply_profile, read_chunks, receive_into, send_within, writable
+from selector_engine import SelectorEngine
+from store import LIST_PAGE_SIZE, SEARCH_PAGE_SIZE, MetadataStore
+from archive_cache import ArchiveCache
+
+logger = logging.getLogger('ftserver')
+
+SERVER_FILES_DIR = 'server_files'
+os.makedirs(SERVER_FILES_DIR, exist_ok=True)
+
+# Content-addressed blobs, one per distinct checksum at
+# blobs/<algorithm>/<xx>/<hex>. Every stored file under SERVER_FILES_DIR is a
+# hard link to its blob, so equal uploads share their bytes. Blobs no file
+# refers to are deleted BLOB_GC_DELAY seconds after the last reference goes.
+BLOBS_DIR = 'blobs'
+os.makedirs(BLOBS_DIR, exist_ok=True)
+BLOB_GC_DELAY = float(os.environ.get('FT_BLOB_GC_DELAY', '30'))
+
+# Partial resumable uploads, one <upload_id>.tmp per session (plus
+# <upload_id>.delta holding the manifest of a delta upload). Sessions with no
+# chunk for UPLOAD_SESSION_TTL seconds are discarded.
+UPLOAD_SESSIONS_DIR = 'upload_sessions'
+os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+UPLOAD_SESSION_TTL = float(os.environ.get('FT_UPLOAD_TTL', str(24 * 3600)))
+
+# Zips served for folder DOWNLOADs are kept and reused until the folder
+# changes, up to ARCHIVE_CACHE_BYTES on disk.
+ARCHIVE_CACHE_DIR = 'archive_cache'
+ARCHIVE_CACHE_BYTES = int(os.environ.get('FT_ARCHIVE_CACHE_MB', '1024')) * 1024 * 1024
+
+# Checksum recorded for every stored file, computed while the upload arrives
+CHECKSUM_ALGORITHM = os.environ.get('FT_CHECKSUM', DEFAULT_ALGORITHM)
+
+# How download bodies are written to the socket: 'sendfile' hands the copy to
+# the kernel (socket.sendfile falls back to send() where the OS lacks it),
+# 'buffered' reads the file through Python in adaptively sized blocks.
+TRANSMIT_MODES = ('sendfile', 'buffered')
+TRANSMIT_MODE = os.environ.get('FT_TRANSMIT_MODE', 'sendfile')
+
+# 'threaded' runs one thread per connection; 'selector' parks idle
+# connections in a selector and runs commands on a pool of SELECTOR_WORKERS,
+# except transfers, which get a thread each (FileServer.TRANSFER_COMMANDS).
+SERVER_ENGINES = ('threaded', 'selector')
+SERVER_ENGINE = os.environ.get('FT_SERVER_ENGINE', 'threaded')
+SELECTOR_WORKERS = int(os.environ.get('FT_SELECTOR_WORKERS', '16'))
+
+# Transfers only mark statistics dirty; they are recomputed and published at
+# most once per STATS_PUBLISH_INTERVAL seconds.
+STATS_PUBLISH_INTERVAL = float(os.environ.get('FT_STATS_INTERVAL', '1.0'))
+
+# Subscribed sessions get at most one change event per EVENT_INTERVAL seconds,
+# holding every change since the last. One still reading an earlier event is
+# skipped until it catches up; one that can't take an event within
+# EVENT_SEND_TIMEOUT is disconnected and resyncs with LIST_CHANGES.
+EVENT_INTERVAL = float(os.environ.get('FT_EVENT_INTERVAL', '0.25'))
+EVENT_SEND_TIMEOUT = 5.0
+# Changes made by other writers to the database, such as the legacy GUI
+# server, are picked up this often
+EVENT_POLL_INTERVAL = 1.0
+
+# Names accepted in one DOWNLOAD_BATCH; clients split longer lists. Files
+# of up to BATCH_COALESCE_BYTES are read into memory and sent several to a
+# send() call, up to that many bytes, rather than each with its own sendfile.
+DOWNLOAD_BATCH_MAX_FILES = 10000
+BATCH_COALESCE_BYTES = 256 * 1024
+
+class ClientSession(Channel):
+    def __init__(self, sock, address):
+        super().__init__(sock)
+        self.address = address
+        self.user_id = None
+        # Set by LOGIN:<user>:<password>:VERSION and by LIST_PAGE/LIST_CHANGES:
+        # replies that used to carry the whole listing carry the catalog version
+        self.incremental_listing = False
+        self.events_version = None  # after SUBSCRIBE, the catalog version its events have reached
+
+class FileServer:
+    """Protocol and storage engine, free of any GUI dependency.
+
+    Frontends observe it through plain callbacks; every log line also goes
+    to the ``ftserver`` logger.
+    """
+
+    def __init__(self, on_log=None, on_files_changed=None, on_stats=None, on_users_changed=None):
+        self.on_log = on_log
+        self.on_files_changed = on_files_changed
+        self.on_stats = on_stats
+        self.on_users_changed = on_users_changed
+        self.server_socket = None
+        self.running = False
+        self.host = '0.0.0.0'  # Listen on all interfaces
+        self.port = 1253
+        self.active_connections = 0
+        self.connections_lock = threading.Lock()
+        self.engine = SERVER_ENGINE if SERVER_ENGINE in SERVER_ENGINES else 'threaded'
+        self.selector_engine = None
+        self.transmit_mode = TRANSMIT_MODE if TRANSMIT_MODE in TRANSMIT_MODES else 'sendfile'
+        self.store = MetadataStore()
+        self.archive_cache = ArchiveCache(ARCHIVE_CACHE_DIR, ARCHIVE_CACHE_BYTES)
+        self.checksum_algorithm = CHECKSUM_ALGORITHM if CHECKSUM_ALGORITHM in ALGORITHMS else DEFAULT_ALGORITHM
+        self.upload_hashes = {}  # upload_id -> [file hash, BlockChecksums] of the bytes appended so far
+        self.blob_lock = threading.Lock()  # held while linking to or deleting blobs
+        self.gc_timer = None
+        self.gc_lock = threading.Lock()
+        self.stats_timeframe = 'month'
+        self.stats_timer = None
+        self.stats_lock = threading.Lock()
+        self.subscribers = set()  # sessions that sent SUBSCRIBE
+        self.subscribers_lock = threading.Lock()
+        self.files_changed = threading.Event()
+
+    def log(self, message):
+        logger.info(message)
+        if self.on_log:
+            self.on_log(message)
+
+    # The publish_* helpers skip the queries entirely when nobody listens
+
+    def publish_files(self, user_id):
+        self.wake_subscribers()
+        if self.on_files_changed:
+            self.on_files_changed(self.list_server_files(user_id))
+
+    def wake_subscribers(self):
+        if self.subscribers:
+            self.files_changed.set()
+
+    def send_events(self):
+        """Push the changes each subscriber hasn't seen, coalesced per EVENT_INTERVAL."""
+        while self.running:
+            self.files_changed.wait(EVENT_POLL_INTERVAL)
+            self.files_changed.clear()
+            with self.subscribers_lock:
+                subscribers = list(self.subscribers)
+            if subscribers:
+                try:
+                    version = self.store.catalog_version()
+                    for session in subscribers:
+                        if session.events_version < version:
+                            try:
+                                self.send_event(session)
+                            except (OSError, ValueError):
+                                self.unsubscribe(session)  # closed while we were at it
+                except Exception as e:
+                    self.log(f"Error sending change events: {str(e)}")
+            time.sleep(EVENT_INTERVAL)
+
+    def send_event(self, session):
+        if not writable(session.sock):
+            return  # still reading an earlier event; this one will hold both
+        changes = self.store.changes_since(session.user_id, session.events_version)
+        if changes is None:
+            event = "RESET"
+            session.events_version = self.store.catalog_version()
+        else:
+            rows, version, has_more = changes
+            session.events_version = version
+            if has_more:
+                self.files_changed.set()
+            if not rows:
+                return
+            removed = [name for name, public, private in rows if not public and not private]
+            event = f"VERSION:{version}|" + self.format_listing(rows) + f"|REMOVED:{','.join(removed)}"
+        frame = session.frame(FRAME_EVENT, event)
+        if send_within(session.sock, frame, EVENT_SEND_TIMEOUT) < len(frame):
+            self.log(f"Dropping change subscriber {session.address}: not reading events")
+            self.unsubscribe(session)
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)  # its connection thread or worker closes it
+            except OSError:
+                pass
+
+    def unsubscribe(self, session):
+        with self.subscribers_lock:
+            self.subscribers.discard(session)
+
+    def publish_stats(self, immediate=False):
+        if not self.on_stats:
+            return
+        if immediate:
+            self.on_stats(self.get_stats(self.stats_timeframe))
+            return
+        with self.stats_lock:
+            if self.stats_timer is None:
+                self.stats_timer = threading.Timer(STATS_PUBLISH_INTERVAL, self.flush_stats)
+                self.stats_timer.daemon = True
+                self.stats_timer.start()
+
+    def flush_stats(self):
+        with self.stats_lock:
+            self.stats_timer = None
+        if self.running:
+            self.publish_stats(immediate=True)
+
+    def publish_users(self):
+        if self.on_users_changed:
+            self.on_users_changed(self.get_users())
+
+    def schedule_blob_gc(self):
+        """Collect unreferenced blobs a little later, once for any number of calls."""
+        with self.gc_lock:
+            if self.gc_timer is None:
+                self.gc_timer = threading.Timer(BLOB_GC_DELAY, self.collect_blobs)
+                self.gc_timer.daemon = True
+                self.gc_timer.start()
+
+    def collect_blobs(self):
+        """Delete every blob that no file refers to any more."""
+        with self.gc_lock:
+            self.gc_timer = None
+        removed = 0
+        try:
+            with self.blob_lock:
+                for checksum in self.store.unreferenced_blobs():
+                    if self.store.delete_blob(checksum):
+                        try:
+                            os.remove(self.blob_path(checksum))
+                        except FileNotFoundError:
+                            pass
+                        removed += 1
+        except Exception as e:
+            self.log(f"Error collecting blobs: {str(e)}")
+        if removed:
+            self.log(f"Removed {removed} unreferenced blob(s)")
+
+    def blob_path(self, checksum):
+        algorithm, digest = parse_checksum(checksum)
+        return os.path.join(BLOBS_DIR, algorithm, digest[:2], digest)
+
+    def find_blob(self, checksum):
+        """The stored blob for ``checksum``, or None. Call with blob_lock held.
+
+        Files stored before the blob store existed become blobs the first time
+        their content is asked for.
+        """
+        path = self.blob_path(checksum)
+        if os.path.exists(path):
+            return path
+        for file_name in self.store.files_with_checksum(checksum):
+            file_path = os.path.join(SERVER_FILES_DIR, file_name)
+            if os.path.isfile(file_path):
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.link(file_path, path)
+                    return path
+                except OSError:
+                    return None
+        return None
+
+    def link_file(self, source, file_path):
+        """Point ``file_path`` at the bytes of ``source``, replacing whatever is there."""
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.link"
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)  # no hard links here (e.g. another filesystem)
+        os.replace(temp_path, file_path)
+
+    def ingest_blob(self, path, checksum):
+        """Make the received file at ``path`` share its blob.
+
+        New content becomes the blob itself. Content the server already holds
+        replaces ``path`` with a link to the existing blob, freeing the copy.
+        """
+        self.ingest_blobs([(path, checksum)])
+
+    def ingest_blobs(self, files):
+        """ingest_blob() for many (path, checksum) pairs, registering the blobs in one transaction."""
+        with self.blob_lock:
+            self.store.add_blobs([(checksum, os.path.getsize(path)) for path, checksum in files])
+            for path, checksum in files:
+                blob = self.find_blob(checksum)
+                try:
+                    if blob:
+                        self.link_file(blob, path)
+                    else:
+                        os.makedirs(os.path.dirname(self.blob_path(checksum)), exist_ok=True)
+                        os.link(path, self.blob_path(checksum))
+                except OSError as e:
+                    self.log(f"Could not add '{path}' to the blob store: {str(e)}")
+
+    def index_blob(self, checksum):
+        """The content-defined chunks of a stored blob, chunking and recording them on first use."""
+        chunks = self.store.blob_chunks(checksum)
+        if chunks:
+            return chunks
+        with self.blob_lock:
+            path = self.find_blob(checksum)
+        if path is None:
+            return []
+        try:
+            _, chunks = file_chunks(path)
+        except OSError:
+            return []  # collected in the meantime
+        self.store.put_blob_chunks(checksum, chunks)
+        return chunks
+
+    def calculate_checksum(self, file_path):
+        return file_checksum(file_path, self.checksum_algorithm)
+
+    def record_blocks(self, file_name, checksum, blocks):
+        """Keep the per-block checksums computed while ``file_name`` arrived."""
+        if blocks and parse_checksum(checksum)[0] == blocks.algorithm:
+            self.store.put_block_checksums(file_name, checksum, blocks.algorithm, blocks.block_size,
+                                           blocks.hexdigests())
+
+    def verify_checksum(self, file_name, expected, computed=None, path=None):
+        """Raise if a client-sent checksum does not match the bytes received.
+
+        ``computed`` is used when it is in the client's algorithm; otherwise
+        the received file at ``path`` is hashed again in that algorithm.
+        """
+        algorithm, digest = parse_checksum(expected)
+        if not computed or parse_checksum(computed)[0] != algorithm:
+            computed = file_checksum(path, algorithm)
+        if parse_checksum(computed)[1] != digest:
+            raise Exception(f"Checksum mismatch for '{file_name}': received {computed}, client sent {expected}")
+
+    def list_server_files(self, user_id):
+        try:
+            return self.store.visible_files(user_id)
+        except Exception as e:
+            self.log(f"Error listing files: {str(e)}")
+            return []
+
+    def get_public_and_private_files(self, user_id):
+        try:
+            return self.store.public_and_private_files(user_id)
+        except Exception as e:
+            self.log(f"Error listing files: {str(e)}")
+            return [], []
+
+    def search_files(self, user_id, query, offset=0, limit=SEARCH_PAGE_SIZE):
+        """One ranked page of matches as (public_files, private_files, has_more)."""
+        try:
+            rows, has_more = self.store.search_files(user_id, query, offset, limit)
+            public_files = [name for name, owned_private in rows if not owned_private]
+            private_files = [name for name, owned_private in rows if owned_private]
+            return public_files, private_files, has_more
+        except Exception as e:
+            self.log(f"Error searching files: {str(e)}")
+            return [], [], False
+
+    def get_stats(self, timeframe='month'):
+        stats = {
+            'downloads': 0,
+            'total_days_with_downloads': 0,
+            'total_files': 0,
+            'total_storage_gb': 0.0,
+            'files_per_user': {},
+            'downloads_per_user': {},
+            'active_connections': self.active_connections,
+            'average_speed': 0.0
+        }
+        
+        if timeframe == 'day':
+            start_date = datetime.now() - timedelta(days=1)
+        elif timeframe == 'week':
+            start_date = datetime.now() - timedelta(days=7)
+        elif timeframe == 'year':
+            start_date = datetime.now() - timedelta(days=365)
+        else:  # month
+            start_date = datetime.now() - timedelta(days=30)
+        
+        try:
+            stats.update(self.store.stats_since(start_date))
+        except sqlite3.Error as e:
+            self.log(f"Database error getting stats: {str(e)}")
+            
+        return stats
+
+    def delete_user(self, username):
+        """Delete ``username`` with their files and shares, from a client or the server GUI."""
+        for file_name in self.store.delete_user(username):
+            file_path = os.path.join(SERVER_FILES_DIR, file_name)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        self.archive_cache.clear()
+        self.schedule_blob_gc()
+        self.publish_users()
+        self.publish_files(None)
+
+    def get_users(self):
+        try:
+            return [f"{username} ({display_name})" if display_name else username
+                    for username, display_name in self.store.users()]
+        except Exception as e:
+            self.log(f"Error listing users: {str(e)}")
+            return []
+
+    def send_file_to_client(self, session, file_name, offset=0, end=None, folder_format='zip'):
+        """Send ``file_name`` from ``offset`` up to ``end`` (exclusive, default EOF).
+
+        The header always carries the full file size, so a client asking for a
+        range knows both the body length and how big the whole file is.
+        Folders go as a zip archive, or with ``folder_format='stream'`` as a
+        folder stream generated while sending.
+        """
+        file_path = os.path.join(SERVER_FILES_DIR, file_name)
+        client_address, user_id = session.address, session.user_id
+        
+        if not os.path.exists(file_path):
+            session.reply(f"Error: File '{file_name}' not found.\n")
+            self.log(f"Error: File '{file_name}' not found for {client_address}")
+            return
+            
+        if end is not None and os.path.isdir(file_path):
+            session.reply(f"Error: Range downloads are not supported for folders ('{file_name}').\n")
+            return
+            
+        try:
+            if os.path.isdir(file_path):
+                has_access = self.store.can_access_folder(file_name, user_id)
+            else:
+                has_access = self.store.can_access(file_name, user_id)
+            if has_access:
+                start_time = datetime.now()
+                if os.path.isdir(file_path) and folder_format == 'stream':
+                    manifest = build_manifest(file_path)
+                    file_size = stream_size(manifest)
+                    header = f"FILE_SIZE:{file_size}:STREAM"
+                    session.send_file_header(header)
+                    session.send_data_header(file_size)
+                    self.log(f"Sending header: {header} for {file_name}")
+                    sent = send_stream(session.sock, manifest, self.transmit_mode == 'sendfile')
+                elif os.path.isdir(file_path):
+                    fingerprint = self.store.folder_fingerprint(file_name)
+                    with self.archive_cache.archive(file_name, file_path, fingerprint) as zip_path:
+                        file_size = os.path.getsize(zip_path)
+                        header = f"FILE_SIZE:{file_size}:ZIP"
+                        session.send_file_header(header)
+                        session.send_data_header(max(file_size - offset, 0))
+                        self.log(f"Sending header: {header} for {file_name}")
+                        sent = self.transmit_file(session.sock, zip_path, offset)
+                else:
+                    file_size = os.path.getsize(file_path)
+                    stop = file_size if end is None else min(end, file_size)
+                    header = f"FILE_SIZE:{file_size}"
+                    # v1 clients parse everything after FILE_SIZE: as the size
+                    checksum = session.framed and self.store.file_checksum(file_name)
+                    if checksum:
+                        header += ":RAW:%s:%s" % parse_checksum(checksum)
+                    session.send_file_header(header)
+                    session.send_data_header(max(stop - offset, 0))
+                    self.log(f"Sending header: {header} for {file_name}"
+                             + (f" (range {offset}-{stop})" if end is not None else ""))
+                    sent = self.transmit_file(session.sock, file_path, offset, stop)
+                
+                transfer_time = (datetime.now() - start_time).total_seconds()
+                speed = (sent / (1024 * 1024)) / transfer_time if transfer_time > 0 else 0  # MB/s
+                
+                self.log(f"Sent '{file_name}' to {client_address} (Speed: {speed:.2f} MB/s, {self.transmit_mode})")
+                
+                # A segmented download is counted once, by its first range
+                if end is None or offset == 0:
+                    self.store.record_download(file_name, client_address, user_id, speed)
+                    self.publish_stats()
+            else:
+                session.reply(f"Error: Access denied for file '{file_name}'\n")
+                self.log(f"Access denied for '{file_name}' to {client_address}")
+                
+        except Exception as e:
+            self.log(f"Error sending file '{file_name}': {str(e)}")
+            try:
+                session.reply(f"Error: {str(e)}\n")
+            except:
+                pass
+
+    def transmit_file(self, sock, file_path, offset=0, end=None):
+        """Write ``file_path`` from ``offset`` up to ``end`` onto ``sock``; returns bytes sent."""
+        file_size = os.path.getsize(file_path)
+        count = max((file_size if end is None else min(end, file_size)) - offset, 0)
+        with open(file_path, 'rb') as f:
+            if self.transmit_mode == 'sendfile':
+                try:
+                    return sock.sendfile(f, offset, count) if count else 0
+                except OSError as e:
+                    # socket.sendfile only moves the file position once bytes went out
+                    if f.tell() != 0:
+                        raise
+                    self.log(f"sendfile unavailable ({e}), using buffered transmit")
+            f.seek(offset)
+            sent = 0
+            for data in read_chunks(f, count):
+                sock.sendall(data)
+                sent += len(data)
+            return sent
+
+    def receive_body(self, sock, f, length):
+        """Copy ``length`` bytes from ``sock`` into ``f``; returns how many arrived."""
+        return receive_into(sock, f, length)
+
+    def store_upload(self, user_id, file_name, temp_path, file_size, is_private, is_folder,
+                     checksum=None, blocks=None):
+        """Move a completely received upload into place and record it.
+
+        ``temp_path`` holds the file itself, or for a folder its zip archive.
+        ``checksum`` and ``blocks`` (a BlockChecksums) are the file's checksums
+        if they were computed on the way in.
+        """
+        file_path = os.path.join(SERVER_FILES_DIR, file_name)
+        if is_folder:
+            os.makedirs(file_path, exist_ok=True)
+            checksums = self.unpack_folder(temp_path, file_path)
+            os.remove(temp_path)
+            self.record_folder(user_id, file_path, is_private, checksums)
+        else:
+            if not checksum or parse_checksum(checksum)[0] != self.checksum_algorithm:
+                checksum, blocks = self.calculate_checksum(temp_path), None
+            self.ingest_blob(temp_path, checksum)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            os.rename(temp_path, file_path)
+            
+            self.store.put_files([(file_name, user_id, is_private, file_size, checksum)])
+            self.record_blocks(file_name, checksum, blocks)
+            self.archive_cache.invalidate(file_name)
+            self.schedule_blob_gc()
+
+    def unpack_folder(self, zip_path, file_path):
+        """Extract an uploaded folder archive, hashing each file as it is written.
+
+        Returns the checksums by file name, as recorded in the files table.
+        """
+        checksums = {}
+        with zipfile.ZipFile(zip_path) as archive:
+            for member in archive.infolist():
+                target = safe_join(file_path, member.filename.rstrip('/'))
+                if member.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if os.path.lexists(target):
+                    os.remove(target)  # never write through a link into a shared blob
+                hash_ = new_hash(self.checksum_algorithm)
+                with archive.open(member) as source, open(target, 'wb') as f:
+                    shutil.copyfileobj(source, HashingWriter(f, hash_), 1024 * 1024)
+                checksums[os.path.relpath(target, SERVER_FILES_DIR)] = format_checksum(hash_)
+                self.ingest_blob(target, checksums[os.path.relpath(target, SERVER_FILES_DIR)])
+        return checksums
+
+    def record_folder(self, user_id, file_path, is_private, checksums=None):
+        """Record every file under an uploaded folder, in one transaction.
+
+        Files not in ``checksums`` (the ones just received) keep their recorded
+        checksum and are only read back if they have none.
+        """
+        checksums = dict(checksums or {})
+        for rel_path, checksum in self.store.folder_checksums(os.path.relpath(file_path, SERVER_FILES_DIR)).items():
+            checksums.setdefault(rel_path, checksum)
+        rows = []
+        for root, _, files in os.walk(file_path):
+            for fname in files:
+                rel_path = os.path.relpath(os.path.join(root, fname), SERVER_FILES_DIR)
+                full_path = os.path.join(root, fname)
+                checksum = checksums.get(rel_path) or self.calculate_checksum(full_path)
+                rows.append((rel_path, user_id, is_private, os.path.getsize(full_path), checksum))
+        self.store.put_files(rows)
+        self.archive_cache.invalidate(os.path.relpath(file_path, SERVER_FILES_DIR))
+        self.schedule_blob_gc()
+
+    def receive_folder_stream(self, session, file_name, stream_length, is_private):
+        """Unpack a folder stream from the client as it arrives.
+
+        Files land in a private staging folder first and are moved into place
+        once the whole stream is in, so a failed upload leaves the existing
+        folder untouched.
+        """
+        file_path = os.path.join(SERVER_FILES_DIR, file_name)
+        staging_path = f"{file_path}.{uuid.uuid4().hex}.partial"
+        try:
+            session.recv_data_header(stream_length)
+            start_time = datetime.now()
+            received = {}
+            extract_stream(session.sock, staging_path, stream_length,
+                           checksums=received, algorithm=self.checksum_algorithm)
+            self.ingest_blobs([(safe_join(staging_path, rel_path), checksum) for rel_path, checksum in received.items()])
+            transfer_time = (datetime.now() - start_time).total_seconds()
+            speed = (stream_length / (1024 * 1024)) / transfer_time if transfer_time > 0 else 0  # MB/s
+            
+            if not os.path.exists(file_path):
+                os.rename(staging_path, file_path)
+            else:
+                for root, _, files in os.walk(staging_path):
+                    target_dir = os.path.join(file_path, os.path.relpath(root, staging_path))
+                    os.makedirs(target_dir, exist_ok=True)
+                    for fname in files:
+                        os.replace(os.path.join(root, fname), os.path.join(target_dir, fname))
+                shutil.rmtree(staging_path)
+            checksums = {os.path.relpath(safe_join(file_path, rel_path), SERVER_FILES_DIR): checksum
+                         for rel_path, checksum in received.items()}
+            self.record_folder(session.user_id, file_path, is_private, checksums)
+            
+            session.reply(f"File '{file_name}' uploaded successfully (Speed: {speed:.2f} MB/s).")
+            self.log(f"Received folder '{file_name}' from {session.address} as a stream (Speed: {speed:.2f} MB/s)")
+            self.publish_files(session.user_id)
+            self.publish_stats()
+        except Exception as e:
+            self.log(f"Error receiving folder '{file_name}': {str(e)}")
+            if os.path.exists(staging_path):
+                shutil.rmtree(staging_path)
+            try:
+                session.reply(f"Error: {str(e)}")
+            except:
+                pass
+
+    def receive_upload_batch(self, session, stream_length, is_private):
+        """Receive many top-level files as one folder stream and record them in one transaction.
+
+        Like a streamed folder, the files are staged until the whole stream
+        is in, so a failed batch stores none of them.
+        """
+        staging_path = os.path.join(SERVER_FILES_DIR, f".batch.{uuid.uuid4().hex}.partial")
+        try:
+            session.recv_data_header(stream_length)
+            start_time = datetime.now()
+            received = {}
+            extract_stream(session.sock, staging_path, stream_length,
+                           checksums=received, algorithm=self.checksum_algorithm)
+            if len(os.listdir(staging_path)) != len(received) or any('/' in name for name in received):
+                raise Exception("A batch holds files only; upload folders on their own.")
+            folders = [name for name in received if os.path.isdir(os.path.join(SERVER_FILES_DIR, name))]
+            if folders:
+                raise Exception(f"'{folders[0]}' is a folder on the server.")
+            transfer_time = (datetime.now() - start_time).total_seconds()
+            speed = (stream_length / (1024 * 1024)) / transfer_time if transfer_time > 0 else 0  # MB/s
+
+            self.ingest_blobs([(os.path.join(staging_path, name), checksum) for name, checksum in received.items()])
+            rows = []
+            for name, checksum in received.items():
+                staged = os.path.join(staging_path, name)
+                rows.append((name, session.user_id, is_private, os.path.getsize(staged), checksum))
+                os.replace(staged, os.path.join(SERVER_FILES_DIR, name))
+            self.store.put_files(rows)
+            # No archive cache to invalidate: none of the names is, or is inside, a folder
+            self.schedule_blob_gc()
+            shutil.rmtree(staging_path)
+
+            session.reply(f"Uploaded {len(rows)} files successfully (Speed: {speed:.2f} MB/s).")
+            self.log(f"Received {len(rows)} files from {session.address} in a batch (Speed: {speed:.2f} MB/s)")
+            self.publish_files(session.user_id)
+            self.publish_stats()
+        except Exception as e:
+            self.log(f"Error receiving an upload batch: {str(e)}")
+            if os.path.exists(staging_path):
+                shutil.rmtree(staging_path)
+            try:
+                session.reply(f"Error: {str(e)}")
+            except:
+                pass
+
+    def receive_file_from_client(self, session, file_name, file_size, is_private, is_folder, expected=None):
+        file_path = os.path.join(SERVER_FILES_DIR, file_name)
+        temp_path = file_path + '.tmp'
+        client_socket, client_address, user_id = session.sock, session.address, session.user_id
+        
+        try:
+            session.recv_data_header(file_size)
+            receive_path = temp_path + '.zip' if is_folder else temp_path
+            start_time = datetime.now()
+            file_hash = new_hash(self.checksum_algorithm)
+            blocks = None if is_folder else BlockChecksums(self.checksum_algorithm)
+            client_hash = file_hash
+            if expected and parse_checksum(expected)[0] != self.checksum_algorithm:
+                client_hash = new_hash(parse_checksum(expected)[0])
+            hashes = [file_hash] + [extra for extra in (client_hash, blocks) if extra not in (None, file_hash)]
+            if os.path.lexists(receive_path):
+                os.remove(receive_path)  # a leftover may already be linked to a blob
+            with open(receive_path, 'wb') as f:
+                received_size = self.receive_body(client_socket, HashingWriter(f, *hashes), file_size)
+            
+            if received_size != file_size:
+                kind = "folder" if is_folder else "file"
+                raise Exception(f"Incomplete {kind} transfer. Expected {file_size} bytes, received {received_size}")
+            
+            transfer_time = (datetime.now() - start_time).total_seconds()
+            speed = (file_size / (1024 * 1024)) / transfer_time if transfer_time > 0 else 0  # MB/s
+            
+            if expected:
+                self.verify_checksum(file_name, expected, format_checksum(client_hash))
+            self.store_upload(user_id, file_name, receive_path, file_size, is_private, is_folder,
+                              format_checksum(file_hash), blocks)
+            
+            session.reply(f"File '{file_name}' uploaded successfully (Speed: {speed:.2f} MB/s).")
+            self.log(f"Received '{file_name}' from {client_address} (Speed: {speed:.2f} MB/s)")
+            
+            self.publish_files(user_id)
+            self.publish_stats()
+                
+        except Exception as e:
+            self.log(f"Error receiving file '{file_name}': {str(e)}")
+            for path in [temp_path, file_path, temp_path + '.zip']:
+                if os.path.exists(path):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+            try:
+                session.reply(f"Error: {str(e)}")
+            except:
+                pass
+
+    def upload_session_path(self, upload_id):
+        return os.path.join(UPLOAD_SESSIONS_DIR, f"{upload_id}.tmp")
+
+    def delta_path(self, upload_id):
+        return os.path.join(UPLOAD_SESSIONS_DIR, f"{upload_id}.delta")
+
+    def load_delta(self, upload_id):
+        """The manifest and needed chunks of a delta upload session, or None for a plain one."""
+        try:
+            with open(self.delta_path(upload_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def assemble_delta(self, upload_id, delta, user_id, client_algorithm):
+        """Rebuild a delta upload's file from the chunks received and the chunks already stored.
+
+        Every chunk is checked against the manifest on the way. Returns the
+        path of the rebuilt file, its checksum, its BlockChecksums and its
+        checksum in ``client_algorithm``.
+        """
+        chunks = parse_manifest(delta['manifest'])
+        needed = set(delta['needed'])
+        path = os.path.join(UPLOAD_SESSIONS_DIR, f"{upload_id}.file")
+        file_hash = new_hash(self.checksum_algorithm)
+        blocks = BlockChecksums(self.checksum_algorithm)
+        client_hash = file_hash if client_algorithm == self.checksum_algorithm else new_hash(client_algorithm)
+        hashes = [file_hash, blocks] + ([client_hash] if client_hash is not file_hash else [])
+        written = {}  # chunk checksum -> offset of its first copy in the rebuilt file
+        sources = {}  # blob checksum -> open blob
+        try:
+            with open(self.upload_session_path(upload_id), 'rb') as received, open(path, 'w+b') as out:
+                sink = HashingWriter(out, *hashes)
+                for index, (offset, size, chunk) in enumerate(chunks):
+                    if index in needed:
+                        data = received.read(size)
+                    elif chunk in written:
+                        out.seek(written[chunk])
+                        data = out.read(size)
+                        out.seek(0, os.SEEK_END)
+                    else:
+                        location = self.store.readable_chunk(chunk, user_id)
+                        blob = location and location[0]
+                        if blob and blob not in sources:
+                            with self.blob_lock:
+                                blob_path = self.find_blob(blob)
+                                sources[blob] = blob_path and open(blob_path, 'rb')
+                        if not blob or not sources[blob]:
+                            raise Exception(f"Chunk {index} is no longer stored on the server")
+                        sources[blob].seek(location[1])
+                        data = sources[blob].read(size)
+                    chunk_hash = new_hash(CHUNK_ALGORITHM)
+                    chunk_hash.update(data)
+                    if len(data) != size or format_checksum(chunk_hash) != chunk:
+                        raise Exception(f"Chunk {index} does not match its checksum")
+                    written.setdefault(chunk, offset)
+                    sink.write(data)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        finally:
+            for source in sources.values():
+                if source:
+                    source.close()
+        return path, format_checksum(file_hash), blocks, format_checksum(client_hash)
+
+    def expire_upload_sessions(self):
+        """Drop sessions idle for longer than the TTL, and files left without a session."""
+        try:
+            idle_since = datetime.now() - timedelta(seconds=UPLOAD_SESSION_TTL)
+            for upload_id in self.store.upload_session_ids(idle_since):
+                self.store.delete_upload_session(upload_id)
+                self.upload_hashes.pop(upload_id, None)
+                self.log(f"Upload session {upload_id} expired")
+            live = set(self.store.upload_session_ids())
+            for name in os.listdir(UPLOAD_SESSIONS_DIR):
+                if name.split('.', 1)[0] not in live:
+                    os.remove(os.path.join(UPLOAD_SESSIONS_DIR, name))
+        except Exception as e:
+            self.log(f"Error expiring upload sessions: {str(e)}")
+
+    def owned_upload_session(self, session, upload_id):
+        """The session row if it exists and belongs to this user, else reply with an error."""
+        upload = self.store.upload_session(upload_id)
+        if not upload or upload[0] != session.user_id:
+            session.reply(f"Error: Unknown upload session '{upload_id}'.")
+            return None
+        return upload
+
+    def open_session(self, client_socket, client_address):
+        with self.connections_lock:
+            self.active_connections += 1
+        self.log(f"[ACTIVE CONNECTIONS] {self.active_connections}")
+        self.log(f"New connection from {client_address}")
+        apply_profile(client_socket, client_address[0])
+        return ClientSession(client_socket, client_address)
+
+    def close_session(self, session):
+        self.unsubscribe(session)
+        try:
+            session.sock.close()
+        except OSError:
+            pass
+        with self.connections_lock:
+            self.active_connections -= 1
+        self.log(f"Connection closed with {session.address}")
+        self.log(f"[ACTIVE CONNECTIONS] {self.active_connections}")
+
+    def handle_client_connection(self, client_socket, client_address):
+        session = self.open_session(client_socket, client_address)
+        try:
+            while self.running:
+                if not self.serve_command(session):
+                    break
+        finally:
+            self.close_session(session)
+
+    def serve_command(self, session, data=None, offload=None):
+        """Read and handle one command. Returns False once the connection is done.
+
+        ``data`` is a command already read from the session. Given ``offload``,
+        a command in TRANSFER_COMMANDS is passed to offload(data) instead of
+        being run here, and None is returned.
+        """
+        client_address = session.address
+        try:
+            if data is None:
+                data = session.recv_command()
+                if not data or session.events_version is not None:
+                    return False  # gone, or a subscription, which takes no further commands
+
+                self.log(f"Received from {client_address}: {data[:100]}...")
+            
+            command, _, args = data.partition(':')
+            if offload and command in self.TRANSFER_COMMANDS:
+                offload(data)
+                return None
+            handler = self.COMMANDS.get(command)
+            if handler:
+                getattr(self, handler)(session, args)
+            else:
+                session.reply(f"Unknown command: {data[:100]}")
+            return True
+                
+        except ConnectionResetError:
+            self.log(f"Connection reset by {client_address}")
+            return False
+        except Exception as e:
+            self.log(f"Error with {client_address}: {str(e)}")
+            try:
+                session.reply(f"Error: {str(e)}")
+            except:
+                return False
+            return True
+
+    COMMANDS = {
+        'HELLO': 'handle_hello',
+        'LOGIN': 'handle_login',
+        'LOGOUT': 'handle_logout',
+        'LIST': 'handle_list_request',
+        'LIST_PAGE': 'handle_list_page',
+        'LIST_CHANGES': 'handle_list_changes',
+        'SUBSCRIBE': 'handle_subscribe',
+        'DOWNLOAD': 'handle_download',
+        'DOWNLOAD_RESUME': 'handle_download_resume',
+        'DOWNLOAD_RANGE': 'handle_download_range',
+        'DOWNLOAD_STREAM': 'handle_download_stream',
+        'DOWNLOAD_BATCH': 'handle_download_batch',
+        'CHECKSUMS': 'handle_checksums',
+        'UPLOAD': 'handle_upload',
+        'UPLOAD_STREAM': 'handle_upload_stream',
+        'UPLOAD_BATCH': 'handle_upload_batch',
+        'UPLOAD_INIT': 'handle_upload_init',
+        'UPLOAD_STATUS': 'handle_upload_status',
+        'UPLOAD_CHUNK': 'handle_upload_chunk',
+        'UPLOAD_COMMIT': 'handle_upload_commit',
+        'UPLOAD_ABORT': 'handle_upload_abort',
+        'UPLOAD_LINK': 'handle_upload_link',
+        'UPLOAD_DELTA': 'handle_upload_delta',
+        'CHUNKS': 'handle_chunks',
+        'HAVE': 'handle_have',
+        'SHARE': 'handle_share',
+        'CHANGE_PASSWORD': 'handle_password_change',
+        'DELETE_ACCOUNT': 'handle_delete_account',
+        'SEARCH': 'handle_search',
+        'SEARCH_PAGE': 'handle_search_page',
+        'DELETE_FILE': 'handle_delete_file',
+        'GET_DISPLAY_NAME': 'handle_get_display_name',
+        'UPDATE_DISPLAY_NAME': 'handle_update_display_name',
+    }
+
+    # Commands that move file bodies or read whole files, and so can take as
+    # long as a transfer. The selector engine gives each its own thread
+    # rather than letting it hold a worker the short commands need.
+    TRANSFER_COMMANDS = frozenset({
+        'DOWNLOAD', 'DOWNLOAD_RESUME', 'DOWNLOAD_RANGE', 'DOWNLOAD_STREAM', 'DOWNLOAD_BATCH',
+        'UPLOAD', 'UPLOAD_STREAM', 'UPLOAD_BATCH', 'UPLOAD_CHUNK', 'UPLOAD_COMMIT', 'UPLOAD_DELTA',
+        'CHECKSUMS', 'CHUNKS',
+    })
+
+    def handle_hello(self, session, data):
+        if session.framed:
+            session.reply(HELLO_COMMAND)
+            return
+        session.accept_hello(data)
+        if session.framed:
+            self.log(f"{session.address} switched to protocol v{session.version}")
+
+    def handle_login(self, session, data):
+        parts = data.split(':')
+        if len(parts) == 3 and parts[2] == "VERSION":
+            session.incremental_listing = True
+            parts = parts[:2]
+        if len(parts) != 2:
+            session.reply("Error: Invalid format. Use 'username:password'")
+            return
+            
+        username, password = parts
+        client_address = session.address
+        
+        try:
+            stored_password = self.store.password_for(username)
+            if stored_password is not None and stored_password == password:
+                session.user_id = username
+                session.reply("Login successful.")
+                self.log(f"User '{username}' logged in from {client_address}")
+                
+                self.reply_listing(session)
+            else:
+                session.user_id = None
+                session.reply("Error: Invalid username or password.")
+                
+        except Exception as e:
+            session.user_id = None
+            session.reply(f"Error: {str(e)}")
+
+    def handle_logout(self, session, data):
+        session.user_id = None
+        session.reply("Logout successful.")
+        self.log(f"User logged out from {session.address}")
+
+    def handle_list_request(self, session, data):
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        public_files, private_files = self.get_public_and_private_files(session.user_id)
+        session.reply(f"PUBLIC:{','.join(public_files)}|PRIVATE:{','.join(private_files)}")
+
+    def handle_list_page(self, session, data):
+        """LIST_PAGE:<limit>:<after> -> VERSION:<n>|PUBLIC:...|PRIVATE:...[|NEXT:<last name>]
+
+        Pages through the listing in name order; NEXT is the ``after`` of the
+        following page. VERSION is the catalog version when the page was read.
+        Keep the one from the first page and catch up with LIST_CHANGES from it.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        parts = data.split(':', 1)
+        try:
+            limit, after = int(parts[0]), parts[1] if len(parts) > 1 else ''
+        except ValueError:
+            session.reply("Error: Invalid format. Use 'LIST_PAGE:<limit>:<after>'")
+            return
+        if limit <= 0:
+            session.reply("Error: Invalid limit.")
+            return
+        session.incremental_listing = True
+        try:
+            version = self.store.catalog_version()
+            rows, has_more = self.store.list_page(session.user_id, after, min(limit, LIST_PAGE_SIZE))
+        except Exception as e:
+            session.reply(f"Error: {str(e)}")
+            return
+        reply = f"VERSION:{version}|" + self.format_listing(rows)
+        if has_more:
+            reply += f"|NEXT:{rows[-1][0]}"
+        session.reply(reply)
+
+    def handle_list_changes(self, session, data):
+        """LIST_CHANGES:<since>[:<limit>] -> VERSION:<n>|PUBLIC:...|PRIVATE:...|REMOVED:...[|NEXT], or RESET
+
+        The names whose place in the user's lists changed after version
+        ``since``, each listed where it belongs now. With NEXT, ask again
+        from the returned version. RESET means the log no longer reaches
+        back that far: start over with LIST_PAGE.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        parts = data.split(':')
+        try:
+            since = int(parts[0])
+            limit = int(parts[1]) if len(parts) > 1 else LIST_PAGE_SIZE
+        except ValueError:
+            session.reply("Error: Invalid format. Use 'LIST_CHANGES:<since>:<limit>'")
+            return
+        if limit <= 0:
+            session.reply("Error: Invalid limit.")
+            return
+        session.incremental_listing = True
+        try:
+            changes = self.store.changes_since(session.user_id, since, min(limit, LIST_PAGE_SIZE))
+        except Exception as e:
+            session.reply(f"Error: {str(e)}")
+            return
+        if changes is None:
+            session.reply("RESET")
+            return
+        rows, version, has_more = changes
+        removed = [name for name, public, private in rows if not public and not private]
+        reply = f"VERSION:{version}|" + self.format_listing(rows) + f"|REMOVED:{','.join(removed)}"
+        if has_more:
+            reply += "|NEXT"
+        session.reply(reply)
+
+    def handle_subscribe(self, session, data):
+        """SUBSCRIBE[:<since>] -> SUBSCRIBED:<version>, then EVENT frames until the connection closes.
+
+        Each event is a LIST_CHANGES reply, or RESET, for everything since
+        the previous one (or since ``since``, default the current version).
+        The connection carries nothing else: any further command ends it.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        if not session.framed:
+            session.reply("Error: SUBSCRIBE needs protocol v2.")
+            return
+        try:
+            version = self.store.catalog_version()
+            since = int(data) if data.strip() else version
+        except ValueError:
+            session.reply("Error: Invalid format. Use 'SUBSCRIBE:<since>'")
+            return
+        except Exception as e:
+            session.reply(f"Error: {str(e)}")
+            return
+        session.reply(f"SUBSCRIBED:{version}")
+        session.events_version = since
+        with self.subscribers_lock:
+            self.subscribers.add(session)
+        self.files_changed.set()
+        self.log(f"{session.address} subscribed to changes for '{session.user_id}'")
+
+    @staticmethod
+    def format_listing(rows):
+        public_files = [name for name, public, _ in rows if public]
+        private_files = [name for name, _, private in rows if private]
+        return f"PUBLIC:{','.join(public_files)}|PRIVATE:{','.join(private_files)}"
+
+    def reply_listing(self, session):
+        """Follow a login or upload with the listing, or only the catalog version if the client keeps its own."""
+        if session.incremental_listing:
+            try:
+                session.reply(f"VERSION:{self.store.catalog_version()}")
+            except Exception as e:
+                session.reply(f"Error: {str(e)}")
+            return
+        public_files, private_files = self.get_public_and_private_files(session.user_id)
+        session.reply(f"PUBLIC:{','.join(public_files)}|PRIVATE:{','.join(private_files)}")
+
+    def handle_download(self, session, data):
+        if not session.user_id:
+            session.reply("Error: Authentication required.\n")
+            self.log(f"Download failed: Authentication required for {session.address}")
+            return
+            
+        file_name = data.strip()
+        self.log(f"Handling download request for '{file_name}' from {session.address}")
+        self.send_file_to_client(session, file_name)
+
+    def handle_download_resume(self, session, data):
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+            
+        parts = data.split(':')
+        if len(parts) != 2:
+            session.reply("Error: Invalid format. Use 'filename:offset'")
+            return
+            
+        file_name, offset = parts
+        offset = int(offset)
+        self.send_file_to_client(session, file_name, offset)
+
+    def handle_download_stream(self, session, data):
+        """Like DOWNLOAD, but folders come as a folder stream instead of a zip."""
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        file_name = data.strip()
+        self.log(f"Handling download request for '{file_name}' from {session.address}")
+        self.send_file_to_client(session, file_name, folder_format='stream')
+
+    def handle_download_batch(self, session, data):
+        """DOWNLOAD_BATCH:<max_size>:<name>\n<name>... -> a manifest, then the files back to back.
+
+        The manifest is one reply, ``BATCH:<files>:<bytes>`` and a line per
+        name in the order asked: ``FILE:<size>:<algorithm>:<hex>:<name>``,
+        ``SKIP:<folder|large>:<name>`` for folders and files over
+        ``max_size``, which the client fetches on their own, or
+        ``ERROR:<message>:<name>``. A DATA frame per FILE line follows.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        if not session.framed:
+            session.reply("Error: DOWNLOAD_BATCH needs protocol v2.")
+            return
+        max_size, _, names = data.partition(':')
+        names = [name for name in names.split('\n') if name]
+        try:
+            max_size = int(max_size)
+        except ValueError:
+            names = []
+        if not names:
+            session.reply("Error: Invalid format. Use 'DOWNLOAD_BATCH:<max_size>:<name>\\n<name>...'")
+            return
+        if len(names) > DOWNLOAD_BATCH_MAX_FILES:
+            session.reply(f"Error: At most {DOWNLOAD_BATCH_MAX_FILES} files per batch.")
+            return
+
+        checksums = self.store.accessible_checksums(names, session.user_id)
+        manifest, files = [], []
+        for name in names:
+            file_path = os.path.join(SERVER_FILES_DIR, name)
+            if os.path.isdir(file_path):
+                manifest.append(f"SKIP:folder:{name}")
+            elif not os.path.isfile(file_path):
+                manifest.append(f"ERROR:File not found:{name}")
+            elif name not in checksums:
+                manifest.append(f"ERROR:Access denied:{name}")
+            else:
+                size = os.path.getsize(file_path)
+                if size > max_size:
+                    manifest.append(f"SKIP:large:{name}")
+                    continue
+                checksum = "%s:%s" % parse_checksum(checksums[name]) if checksums[name] else ":"
+                manifest.append(f"FILE:{size}:{checksum}:{name}")
+                files.append((name, file_path, size))
+        total = sum(size for _, _, size in files)
+        session.reply(f"BATCH:{len(files)}:{total}\n" + '\n'.join(manifest))
+
+        start_time = datetime.now()
+        frames, framed_bytes = [], 0
+        for name, file_path, size in files:
+            if size <= BATCH_COALESCE_BYTES:
+                try:
+                    with open(file_path, 'rb') as f:
+                        data = f.read(size)
+                except FileNotFoundError:
+                    data = b''  # deleted since the manifest
+                # Changed since the manifest: pad it out so the next file still
+                # starts where the client expects; its checksum will not match
+                frames.append(session.frame(FRAME_DATA, data.ljust(size, b'\0')))
+                framed_bytes += size
+                if framed_bytes >= BATCH_COALESCE_BYTES:
+                    session.sock.sendall(b''.join(frames))
+                    frames, framed_bytes = [], 0
+                continue
+            if frames:
+                session.sock.sendall(b''.join(frames))
+                frames, framed_bytes = [], 0
+            session.send_data_header(size)
+            try:
+                sent = self.transmit_file(session.sock, file_path, 0, size)
+            except FileNotFoundError:
+                sent = 0
+            if sent < size:
+                session.sock.sendall(bytes(size - sent))
+        if frames:
+            session.sock.sendall(b''.join(frames))
+        transfer_time = (datetime.now() - start_time).total_seconds()
+        speed = (total / (1024 * 1024)) / transfer_time if transfer_time > 0 else 0  # MB/s
+        self.log(f"Sent {len(files)} files ({total} bytes) in a batch to {session.address} (Speed: {speed:.2f} MB/s)")
+        if files:
+            self.store.record_downloads([name for name, _, _ in files], session.address, session.user_id, speed)
+            self.publish_stats()
+
+    def handle_checksums(self, session, data):
+        """CHECKSUMS:filename -> CHECKSUMS:block_size:algorithm:hex,hex,...
+
+        Block checksums are recorded when a file is uploaded; for older files
+        they are computed on the first request and kept.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        file_name = data.strip()
+        file_path = os.path.join(SERVER_FILES_DIR, file_name)
+        if not os.path.isfile(file_path):
+            session.reply(f"Error: File '{file_name}' not found.")
+            return
+        try:
+            if not self.store.can_access(file_name, session.user_id):
+                session.reply(f"Error: Access denied for file '{file_name}'")
+                return
+            blocks = self.store.block_checksums(file_name)
+            if blocks is None:
+                computed = file_block_checksums(file_path, self.checksum_algorithm)
+                blocks = computed.algorithm, computed.block_size, computed.hexdigests()
+                checksum = self.store.file_checksum(file_name)
+                if checksum:
+                    self.store.put_block_checksums(file_name, checksum, *blocks)
+            algorithm, block_size, digests = blocks
+            session.reply(f"CHECKSUMS:{block_size}:{algorithm}:{','.join(digests)}")
+        except Exception as e:
+            self.log(f"Error computing checksums of '{file_name}': {str(e)}")
+            session.reply(f"Error: {str(e)}")
+
+    def handle_download_range(self, session, data):
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+            
+        parts = data.rsplit(':', 2)
+        try:
+            file_name, start, end = parts[0], int(parts[1]), int(parts[2])
+        except (IndexError, ValueError):
+            session.reply("Error: Invalid format. Use 'filename:start:end'")
+            return
+        if start < 0 or end < start:
+            session.reply("Error: Invalid range.")
+            return
+        self.send_file_to_client(session, file_name, start, end)
+
+    def handle_upload(self, session, data):
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+            
+        parts = data.split(':')
+        if len(parts) not in (4, 6):
+            session.reply("Error: Invalid format. Use 'filename:size:is_private:is_folder[:algorithm:checksum]'")
+            return
+            
+        file_name = parts[0].strip()
+        expected = ':'.join(parts[4:]).strip() or None
+        try:
+            file_size = int(parts[1].strip())
+            is_private = int(parts[2].strip())
+            is_folder = int(parts[3].strip())
+        except ValueError:
+            session.reply("Error: Invalid file size, privacy, or folder setting.")
+            return
+        if expected and parse_checksum(expected)[0] not in ALGORITHMS:
+            session.reply(f"Error: Unsupported checksum algorithm '{parse_checksum(expected)[0]}'.")
+            return
+            
+        self.receive_file_from_client(session, file_name, file_size, is_private, is_folder, expected)
+        
+        self.reply_listing(session)
+
+    def handle_upload_stream(self, session, data):
+        """UPLOAD_STREAM:foldername:stream_length:is_private -> READY, then the stream.
+
+        The client waits for READY before sending, so older servers can turn
+        the command down before any body is on the wire.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+            
+        parts = data.split(':')
+        if len(parts) != 3:
+            session.reply("Error: Invalid format. Use 'foldername:stream_length:is_private'")
+            return
+        file_name = parts[0].strip()
+        try:
+            stream_length = int(parts[1].strip())
+            is_private = int(parts[2].strip())
+        except ValueError:
+            session.reply("Error: Invalid stream length or privacy setting.")
+            return
+            
+        session.reply("READY")
+        self.receive_folder_stream(session, file_name, stream_length, is_private)
+        
+        self.reply_listing(session)
+
+    def handle_upload_batch(self, session, data):
+        """UPLOAD_BATCH:stream_length:is_private -> READY, then many files as one folder stream.
+
+        Every entry is a file stored under its own name, as if sent with
+        UPLOAD, but the batch costs one round trip, one commit and one listing.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        if not session.framed:
+            session.reply("Error: UPLOAD_BATCH needs protocol v2.")
+            return
+
+        parts = data.split(':')
+        if len(parts) != 2:
+            session.reply("Error: Invalid format. Use 'stream_length:is_private'")
+            return
+        try:
+            stream_length = int(parts[0].strip())
+            is_private = int(parts[1].strip())
+        except ValueError:
+            session.reply("Error: Invalid stream length or privacy setting.")
+            return
+
+        session.reply("READY")
+        self.receive_upload_batch(session, stream_length, is_private)
+
+        self.reply_listing(session)
+
+    def handle_upload_init(self, session, data):
+        """UPLOAD_INIT:filename:size:is_private:is_folder[:fingerprint] -> UPLOAD_ID:id:offset
+
+        A client that sends the same fingerprint (any string identifying the
+        source file's contents) for the same file and size gets its earlier
+        session back, with the offset to continue from.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+            
+        parts = data.split(':')
+        if len(parts) not in (4, 5):
+            session.reply("Error: Invalid format. Use 'filename:size:is_private:is_folder[:fingerprint]'")
+            return
+        file_name = parts[0].strip()
+        fingerprint = parts[4].strip() if len(parts) == 5 else ''
+        try:
+            file_size = int(parts[1].strip())
+            is_private = int(parts[2].strip())
+            is_folder = int(parts[3].strip())
+        except ValueError:
+            session.reply("Error: Invalid file size, privacy, or folder setting.")
+            return
+            
+        self.expire_upload_sessions()
+        upload_id = fingerprint and self.store.find_upload_session(session.user_id, file_name, file_size, fingerprint)
+        if upload_id and os.path.exists(self.upload_session_path(upload_id)):
+            offset = os.path.getsize(self.upload_session_path(upload_id))
+            self.log(f"Resuming upload {upload_id} of '{file_name}' for '{session.user_id}' at {offset} bytes")
+        else:
+            upload_id = uuid.uuid4().hex
+            open(self.upload_session_path(upload_id), 'wb').close()
+            self.upload_hashes[upload_id] = [new_hash(self.checksum_algorithm), BlockChecksums(self.checksum_algorithm)]
+            self.store.create_upload_session(upload_id, session.user_id, file_name, file_size,
+                                             is_private, is_folder, fingerprint or None)
+            offset = 0
+            self.log(f"Upload session {upload_id} opened for '{file_name}' by '{session.user_id}'")
+        session.reply(f"UPLOAD_ID:{upload_id}:{offset}")
+
+    def handle_upload_status(self, session, data):
+        """UPLOAD_STATUS:id -> OFFSET:committed:size"""
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        upload = self.owned_upload_session(session, data.strip())
+        if upload:
+            session.reply(f"OFFSET:{os.path.getsize(self.upload_session_path(data.strip()))}:{upload[2]}")
+
+    def handle_upload_chunk(self, session, data):
+        """UPLOAD_CHUNK:id:offset:length, then the body -> OFFSET:committed:size
+
+        The body is appended only if ``offset`` is where the session currently
+        ends; otherwise it is read and dropped, and the reply names the
+        offset to continue from. Bytes received before a disconnect are kept.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        try:
+            upload_id, offset, length = data.split(':')
+            offset, length = int(offset), int(length)
+        except ValueError:
+            session.reply("Error: Invalid format. Use 'id:offset:length'")
+            return
+            
+        session.recv_data_header(length)
+        upload = self.store.upload_session(upload_id)
+        path = self.upload_session_path(upload_id)
+        if not upload or upload[0] != session.user_id or not os.path.exists(path):
+            error = f"Error: Unknown upload session '{upload_id}'."
+        elif offset != os.path.getsize(path) or offset + length > upload[2]:
+            error = f"Error: Chunk at {offset} does not continue the upload at {os.path.getsize(path)}."
+        else:
+            error = None
+        if error:
+            with open(os.devnull, 'wb') as sink:
+                self.receive_body(session.sock, sink, length)
+            session.reply(error)
+            return
+            
+        start_time = datetime.now()
+        upload_hashes = self.upload_hashes.get(upload_id)
+        try:
+            with open(path, 'ab') as f:
+                sink = HashingWriter(f, *upload_hashes) if upload_hashes else f
+                received_size = self.receive_body(session.sock, sink, length)
+        finally:
+            self.store.touch_upload_session(upload_id, (datetime.now() - start_time).total_seconds())
+        if received_size != length:
+            raise ConnectionError(f"Upload {upload_id} interrupted at {offset + received_size} bytes")
+        session.reply(f"OFFSET:{offset + received_size}:{upload[2]}")
+
+    def handle_upload_commit(self, session, data):
+        """UPLOAD_COMMIT:id[:algorithm:checksum] -> the UPLOAD result message, then the listing.
+
+        A checksum from the client is compared with the one computed while
+        the chunks arrived; on a mismatch the upload is discarded. A delta
+        upload's file is first rebuilt from its manifest.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        upload_id, _, expected = data.strip().partition(':')
+        if expected and parse_checksum(expected)[0] not in ALGORITHMS:
+            session.reply(f"Error: Unsupported checksum algorithm '{parse_checksum(expected)[0]}'.")
+            return
+        upload = self.owned_upload_session(session, upload_id)
+        if not upload:
+            return
+        user_id, file_name, file_size, is_private, is_folder, transfer_seconds = upload
+        path = self.upload_session_path(upload_id)
+        committed = os.path.getsize(path)
+        if committed != file_size:
+            session.reply(f"Error: Upload incomplete. OFFSET:{committed}:{file_size}")
+            return
+            
+        # Sessions resumed across a server restart have no running hash
+        upload_hash, blocks = self.upload_hashes.pop(upload_id, None) or (None, None)
+        checksum = format_checksum(upload_hash) if upload_hash else None
+        delta = self.load_delta(upload_id)
+        received = path
+        try:
+            if delta:
+                client_algorithm = parse_checksum(expected or delta['checksum'])[0]
+                path, checksum, blocks, client_checksum = self.assemble_delta(upload_id, delta, user_id,
+                                                                              client_algorithm)
+                file_size = delta['size']
+                self.verify_checksum(file_name, expected or delta['checksum'], client_checksum, path)
+            elif expected:
+                self.verify_checksum(file_name, expected, checksum, path)
+            if is_folder:
+                zip_path = path + '.zip'
+                os.rename(path, zip_path)
+                path = zip_path
+            self.store_upload(user_id, file_name, path, file_size, is_private, is_folder, checksum, blocks)
+            if delta:
+                # The new version's chunks, for the next delta to match against
+                self.store.put_blob_chunks(checksum, parse_manifest(delta['manifest']))
+            self.store.delete_upload_session(upload_id)
+        except Exception as e:
+            self.log(f"Error committing upload '{file_name}': {str(e)}")
+            self.store.delete_upload_session(upload_id)
+            if os.path.exists(path):
+                os.remove(path)
+            session.reply(f"Error: {str(e)}")
+            return
+        finally:
+            for leftover in (received, self.delta_path(upload_id)) if delta else ():
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            
+        speed = (committed / (1024 * 1024)) / transfer_seconds if transfer_seconds > 0 else 0  # MB/s
+        sent = f"{committed} of {file_size} bytes sent, " if delta else ""
+        session.reply(f"File '{file_name}' uploaded successfully ({sent}Speed: {speed:.2f} MB/s).")
+        self.log(f"Received '{file_name}' from {session.address} via upload {upload_id} ({sent}Speed: {speed:.2f} MB/s)")
+        self.publish_files(user_id)
+        self.publish_stats()
+        
+        self.reply_listing(session)
+
+    def handle_upload_abort(self, session, data):
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        upload_id = data.strip()
+        if self.owned_upload_session(session, upload_id):
+            self.store.delete_upload_session(upload_id)
+            self.upload_hashes.pop(upload_id, None)
+            for path in (self.upload_session_path(upload_id), self.delta_path(upload_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+            session.reply(f"Upload {upload_id} aborted.")
+
+    def handle_have(self, session, data):
+        """HAVE:algorithm:hex -> HAVE:1 if content the user can read has this checksum, else HAVE:0"""
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        checksum = data.strip()
+        if parse_checksum(checksum)[0] not in ALGORITHMS:
+            session.reply(f"Error: Unsupported checksum algorithm '{parse_checksum(checksum)[0]}'.")
+            return
+        with self.blob_lock:
+            found = self.store.readable_checksum(checksum, session.user_id) and self.find_blob(checksum)
+        session.reply(f"HAVE:{int(bool(found))}")
+
+    def handle_upload_link(self, session, data):
+        """UPLOAD_LINK:filename:is_private:algorithm:hex -> the UPLOAD result and the listing, or MISSING
+
+        Stores ``filename`` as another name for content the server already
+        holds, so the client skips sending it. Only content the user can
+        already read is linked; otherwise knowing a checksum would be enough
+        to obtain someone's private file.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        parts = data.split(':')
+        if len(parts) != 4:
+            session.reply("Error: Invalid format. Use 'filename:is_private:algorithm:checksum'")
+            return
+        file_name = parts[0].strip()
+        checksum = ':'.join(parts[2:]).strip()
+        try:
+            is_private = int(parts[1].strip())
+        except ValueError:
+            session.reply("Error: Invalid privacy setting.")
+            return
+        if parse_checksum(checksum)[0] not in ALGORITHMS:
+            session.reply(f"Error: Unsupported checksum algorithm '{parse_checksum(checksum)[0]}'.")
+            return
+        file_path = os.path.join(SERVER_FILES_DIR, file_name)
+        if os.path.isdir(file_path):
+            session.reply(f"Error: '{file_name}' is a folder.")
+            return
+            
+        try:
+            with self.blob_lock:
+                blob = self.store.readable_checksum(checksum, session.user_id) and self.find_blob(checksum)
+                if blob:
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    self.link_file(blob, file_path)
+                    self.store.put_files([(file_name, session.user_id, is_private, os.path.getsize(blob), checksum)])
+        except Exception as e:
+            self.log(f"Error linking '{file_name}': {str(e)}")
+            session.reply(f"Error: {str(e)}")
+            return
+        if not blob:
+            session.reply("MISSING")
+            return
+            
+        self.archive_cache.invalidate(file_name)
+        self.schedule_blob_gc()
+        session.reply(f"File '{file_name}' uploaded successfully (already on server).")
+        self.log(f"Linked '{file_name}' for '{session.user_id}' to stored content {checksum}")
+        self.publish_files(session.user_id)
+        self.publish_stats()
+        
+        self.reply_listing(session)
+
+    def handle_upload_delta(self, session, data):
+        """UPLOAD_DELTA:filename:size:is_private:algorithm:hex, a newline and the chunk manifest
+        -> DELTA:id:offset:index,index,...
+
+        Opens an upload session for only the chunks, listed by their index in
+        the manifest, that the server holds nowhere the user can read. The
+        client sends those back to back with UPLOAD_CHUNK and finishes with
+        UPLOAD_COMMIT; the commit rebuilds the file from them and the chunks
+        already stored. Sending the same manifest again resumes the session.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        head, _, manifest = data.partition('\n')
+        parts = head.split(':')
+        if len(parts) != 5:
+            session.reply("Error: Invalid format. Use 'filename:size:is_private:algorithm:checksum', "
+                          "a newline and the manifest")
+            return
+        file_name = parts[0].strip()
+        checksum = ':'.join(parts[3:]).strip()
+        try:
+            file_size = int(parts[1].strip())
+            is_private = int(parts[2].strip())
+            chunks = parse_manifest(manifest)
+        except ValueError:
+            session.reply("Error: Invalid file size, privacy setting, or manifest.")
+            return
+        if parse_checksum(checksum)[0] not in ALGORITHMS:
+            session.reply(f"Error: Unsupported checksum algorithm '{parse_checksum(checksum)[0]}'.")
+            return
+        if sum(size for _, size, _ in chunks) != file_size or \
+                any(parse_checksum(chunk)[0] != CHUNK_ALGORITHM for _, _, chunk in chunks):
+            session.reply(f"Error: The manifest does not describe a file of {file_size} bytes.")
+            return
+        if os.path.isdir(os.path.join(SERVER_FILES_DIR, file_name)):
+            session.reply(f"Error: '{file_name}' is a folder.")
+            return
+            
+        try:
+            # The version being replaced is where unchanged chunks usually are
+            current = self.store.file_checksum(file_name)
+            if current and self.store.can_access(file_name, session.user_id):
+                self.index_blob(current)
+            needed, seen = [], set()
+            for index, (_, _, chunk) in enumerate(chunks):
+                # A chunk repeated within the file is sent once and copied
+                if chunk not in seen and not self.store.readable_chunk(chunk, session.user_id):
+                    needed.append(index)
+                seen.add(chunk)
+            length = sum(chunks[index][1] for index in needed)
+            
+            self.expire_upload_sessions()
+            fingerprint = f"delta:{checksum}"
+            upload_id = self.store.find_upload_session(session.user_id, file_name, length, fingerprint)
+            delta = upload_id and os.path.exists(self.upload_session_path(upload_id)) and self.load_delta(upload_id)
+            if delta:
+                needed = delta['needed']
+                offset = os.path.getsize(self.upload_session_path(upload_id))
+                self.log(f"Resuming delta upload {upload_id} of '{file_name}' for '{session.user_id}' at {offset} bytes")
+            else:
+                upload_id = uuid.uuid4().hex
+                open(self.upload_session_path(upload_id), 'wb').close()
+                with open(self.delta_path(upload_id), 'w') as f:
+                    json.dump({'checksum': checksum, 'size': file_size, 'needed': needed, 'manifest': manifest}, f)
+                self.store.create_upload_session(upload_id, session.user_id, file_name, length,
+                                                 is_private, 0, fingerprint)
+                offset = 0
+                self.log(f"Delta upload {upload_id} opened for '{file_name}' by '{session.user_id}': "
+                         f"{len(needed)} of {len(chunks)} chunks, {length} of {file_size} bytes to send")
+        except Exception as e:
+            self.log(f"Error opening delta upload of '{file_name}': {str(e)}")
+            session.reply(f"Error: {str(e)}")
+            return
+        session.reply(f"DELTA:{upload_id}:{offset}:{','.join(map(str, needed))}")
+
+    def handle_chunks(self, session, data):
+        """CHUNKS:filename -> CHUNKS:algorithm:hex, a newline and the file's chunk manifest
+
+        A client holding an older copy chunks it the same way and downloads
+        only the ranges whose chunks it lacks.
+        """
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        file_name = data.strip()
+        if not os.path.isfile(os.path.join(SERVER_FILES_DIR, file_name)):
+            session.reply(f"Error: File '{file_name}' not found.")
+            return
+        try:
+            if not self.store.can_access(file_name, session.user_id):
+                session.reply(f"Error: Access denied for file '{file_name}'")
+                return
+            checksum = self.store.file_checksum(file_name)
+            if not checksum:
+                session.reply(f"Error: No checksum recorded for '{file_name}'.")
+                return
+            reply = f"CHUNKS:{checksum}\n{format_manifest(self.index_blob(checksum))}"
+        except Exception as e:
+            self.log(f"Error chunking '{file_name}': {str(e)}")
+            session.reply(f"Error: {str(e)}")
+            return
+        if len(reply.encode('utf-8')) > MAX_MESSAGE_SIZE:
+            session.reply(f"Error: '{file_name}' has too many chunks to list.")
+            return
+        session.reply(reply)
+
+    def handle_share(self, session, data):
+        user_id = session.user_id
+        if not user_id:
+            session.reply("Error: Authentication required.")
+            return
+            
+        parts = data.split(':')
+        if len(parts) != 2:
+            session.reply("Error: Invalid format. Use 'file_name:target_user'")
+            return
+            
+        file_name, target_user = parts
+        
+        try:
+            if self.store.file_owner(file_name, private_only=True) != user_id:
+                session.reply("Error: You can only share your private files.")
+                return
+                
+            if not self.store.user_exists(target_user):
+                session.reply("Error: Target user does not exist.")
+                return
+                
+            self.store.share_file(file_name, target_user)
+            session.reply(f"File '{file_name}' shared with '{target_user}'.")
+            self.log(f"User '{user_id}' shared '{file_name}' with '{target_user}'")
+            self.wake_subscribers()
+        except sqlite3.IntegrityError:
+            session.reply("Error: File already shared with this user.")
+        except Exception as e:
+            session.reply(f"Error: {str(e)}")
+
+    def handle_password_change(self, session, data):
+        user_id = session.user_id
+        if not user_id:
+            session.reply("Error: Authentication required.")
+            return
+            
+        new_password = data.strip()
+        try:
+            self.store.set_password(user_id, new_password)
+            session.reply("Password updated successfully.")
+            self.log(f"User '{user_id}' updated password")
+        except Exception as e:
+            session.reply(f"Error: {str(e)}")
+
+    def handle_delete_account(self, session, data):
+        if not data:
+            session.reply("Error: Username required.")
+            return
+            
+        username = data.strip()
+        try:
+            if not self.store.user_exists(username):
+                session.reply("Error: User does not exist.")
+                return
+            
+            self.delete_user(username)
+            session.reply("Account deleted successfully.")
+            self.log(f"User '{username}' deleted account from {session.address}")
+        except Exception as e:
+            session.reply(f"Error: {str(e)}")
+            self.log(f"Error deleting account '{username}': {str(e)}")
+
+    def handle_search(self, session, data):
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        self.reply_search_page(session, data.strip(), 0, SEARCH_PAGE_SIZE)
+
+    def handle_search_page(self, session, data):
+        if not session.user_id:
+            session.reply("Error: Authentication required.")
+            return
+        parts = data.split(':', 2)
+        try:
+            offset, limit, query = int(parts[0]), int(parts[1]), parts[2].strip()
+        except (IndexError, ValueError):
+            session.reply("Error: Invalid format. Use 'SEARCH_PAGE:<offset>:<limit>:<query>'")
+            return
+        if offset < 0 or limit <= 0:
+            session.reply("Error: Invalid offset or limit.")
+            return
+        self.reply_search_page(session, query, offset, min(limit, SEARCH_PAGE_SIZE))
+
+    def reply_search_page(self, session, query, offset, limit):
+        # NEXT is the offset of the following page, present only if there is one
+        public_files, private_files, has_more = self.search_files(session.user_id, query, offset, limit)
+        reply = f"PUBLIC:{','.join(public_files)}|PRIVATE:{','.join(private_files)}"
+        if has_more:
+            reply += f"|NEXT:{offset + limit}"
+        session.reply(reply)
+
+    def handle_delete_file(self, session, data):
+        user_id = session.user_id
+        if not user_id:
+            session.reply("Error: Authentication required.")
+            return
+            
+        file_name = data.strip()
+        try:
+            if self.store.file_owner(file_name) != user_id:
+                session.reply(f"Error: You can only delete files you uploaded ('{file_name}').")
+                return
+            
+            file_path = os.path.join(SERVER_FILES_DIR, file_name)
+            if os.path.exists(file_path):
+                if os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.remove(file_path)
+            
+            self.store.delete_file(file_name)
+            self.archive_cache.invalidate(file_name)
+            self.schedule_blob_gc()
+            
+            session.reply(f"File '{file_name}' deleted successfully.")
+            self.log(f"User '{user_id}' deleted file '{file_name}'")
+            self.publish_files(user_id)
+        except Exception as e:
+            session.reply(f"Error: {str(e)}")
+            self.log(f"Error deleting file '{file_name}': {str(e)}")
+
+    def handle_get_display_name(self, session, username):
+        try:
+            session.reply(self.store.display_name(username) or username)
+        except Exception as e:
+            session.reply(username)
+
+    def handle_update_display_name(self, session, data):
+        user_id = session.user_id
+        if not user_id:
+            session.reply("Error: Authentication required.")
+            return
+            
+        try:
+            self.store.set_display_name(user_id, data)
+            session.reply("Display name updated successfully.")
+            self.log(f"User '{user_id}' updated display name to '{data}'")
+            self.publish_users()
+        except Exception as e:
+            session.reply(f"Error: {str(e)}")
+
+    def serve_forever(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        
+        try:
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(socket.SOMAXCONN)
+            self.running = True
+            self.port = self.server_socket.getsockname()[1]
+            self.log(f"Server started on {self.host}:{self.port} ({self.engine} engine)")
+            self.expire_upload_sessions()
+            self.schedule_blob_gc()
+            self.publish_files(None)
+            self.publish_stats(immediate=True)
+            self.publish_users()
+            threading.Thread(target=self.send_events, daemon=True).start()
+            
+            if self.engine == 'selector':
+                self.selector_engine = SelectorEngine(self.server_socket, self.open_session, self.serve_command,
+                                                      self.close_session, workers=SELECTOR_WORKERS)
+                self.selector_engine.serve(lambda: self.running)
+            
+            while self.running and self.engine == 'threaded':
+                try:
+                    self.server_socket.settimeout(1)
+                    client_socket, client_address = self.server_socket.accept()
+                    threading.Thread(
+                        target=self.handle_client_connection,
+                        args=(client_socket, client_address),
+                        daemon=True
+                    ).start()
+                except socket.timeout:
+                    continue
+                except Exception as e:
+                    if self.running:
+                        self.log(f"Server accept error: {str(e)}")
+                        
+        except Exception as e:
+            self.log(f"Server error: {str(e)}")
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        self.files_changed.set()
+        with self.stats_lock:
+            if self.stats_timer:
+                self.stats_timer.cancel()
+                self.stats_timer = None
+        with self.gc_lock:
+            if self.gc_timer:
+                self.gc_timer.cancel()
+                self.gc_timer = None
+        if self.selector_engine:
+            self.selector_engine.wake()
+        if self.server_socket:
+            try:
+                self.server_socket.close()
+            except:
+                pass
+        self.log("Server stopped.")
@@ -0,0 +1,40 @@
+"""Run the file transfer server without a GUI.
+
+    python -m headless --port 1253 --engine selector
+
+Uses the same file_transfer.db and server_files/ in the working directory
+as the GUI server, and writes its activity to stderr through logging.
+"""
+import argparse
+import logging
+import signal
+
+from core import FileServer, SERVER_ENGINES, SERVER_ENGINE, TRANSMIT_MODES, TRANSMIT_MODE
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless file transfer server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=1253)
+    parser.add_argument('--engine', choices=SERVER_ENGINES, default=SERVER_ENGINE)
+    parser.add_argument('--transmit', choices=TRANSMIT_MODES, default=TRANSMIT_MODE)
+    parser.add_argument('--log-level', default='INFO')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(),
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    server = FileServer()
+    server.host, server.port = args.host, args.port
+    server.engine, server.transmit_mode = args.engine, args.transmit
+
+    signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import collections
+import selectors
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def raise_fd_limit():
+    """Lift the soft open-file limit to the hard limit so idle clients fit."""
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class SelectorEngine:
+    """Serve many mostly idle connections without a thread per client.
+
+    Idle sockets are parked in one selector. When a socket becomes readable
+    it is taken out of the selector and handed to a bounded worker pool,
+    which runs exactly one command on it with ordinary blocking I/O (so the
+    disk and SQLite work never touches the selector thread). The worker then
+    parks the socket again. A command that may run as long as a transfer is
+    passed back through ``offload`` and finishes on a thread of its own, so
+    slow transfers can't take every worker from LIST and LOGIN. Threads
+    scale with in-flight commands, memory with the number of sockets.
+    """
+
+    def __init__(self, server_socket, open_session, serve_command, close_session, workers=16):
+        self.server_socket = server_socket
+        self.open_session = open_session
+        self.serve_command = serve_command
+        self.close_session = close_session
+        self.workers = workers
+        self.selector = None
+        self.pool = None
+        self._parked = collections.deque()
+        self._closing = False
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+
+    def serve(self, is_running):
+        raise_fd_limit()
+        self.selector = selectors.DefaultSelector()
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ft-worker')
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, self._wake_r)
+        try:
+            while is_running():
+                for key, _ in self.selector.select(timeout=1):
+                    if key.data is None:
+                        self._accept()
+                    elif key.data is self._wake_r:
+                        self._drain_wakeups()
+                    else:
+                        self.selector.unregister(key.fileobj)
+                        self.pool.submit(self._run_command, key.data)
+        finally:
+            self._shutdown()
+
+    def wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client_socket.setblocking(True)
+            session = self.open_session(client_socket, client_address)
+            self.selector.register(client_socket, selectors.EVENT_READ, session)
+
+    def _drain_wakeups(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._parked:
+            session = self._parked.popleft()
+            try:
+                self.selector.register(session.sock, selectors.EVENT_READ, session)
+            except (ValueError, OSError):
+                self.close_session(session)
+
+    def _run_command(self, session, data=None):
+        try:
+            if data is None:
+                keep_open = self.serve_command(session, offload=lambda data: self._start_transfer(session, data))
+            else:
+                keep_open = self.serve_command(session, data)
+        except Exception:
+            keep_open = False
+        if keep_open is None:
+            return  # a transfer thread has the session now
+        if keep_open and not self._closing:
+            # Only the selector thread touches the selector
+            self._parked.append(session)
+            self.wake()
+        else:
+            self.close_session(session)
+
+    def _start_transfer(self, session, data):
+        threading.Thread(target=self._run_command, args=(session, data),
+                         name='ft-transfer', daemon=True).start()
+
+    def _shutdown(self):
+        self._closing = True
+        for key in list(self.selector.get_map().values()):
+            if key.data not in (None, self._wake_r):
+                self.close_session(key.data)
+        self.selector.close()
+        # Commands still running close their own sessions when they finish
+        self.pool.shutdown(wait=False)
+        while self._parked:
+            self.close_session(self._parked.popleft())
+        self._wake_r.close()
+        self._wake_w.close()
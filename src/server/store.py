@@ -0,0 +1,821 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+
+DB_PATH = 'file_transfer.db'
+SEARCH_PAGE_SIZE = 500
+LIST_PAGE_SIZE = 2000
+CHANGE_LOG_SIZE = 100000
+# Names per query when looking up many files at once, below SQLite's limit on parameters
+NAMES_PER_QUERY = 500
+
+def adapt_datetime(dt):
+    return dt.isoformat()
+sqlite3.register_adapter(datetime, adapt_datetime)
+
+def parse_datetime(s):
+    return datetime.fromisoformat(s)
+sqlite3.register_converter("DATETIME", parse_datetime)
+
+def escape_like(text):
+    """``text`` matched literally by LIKE ... ESCAPE '\\'."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# Schema migrations. Each one takes a connection inside an open transaction;
+# MIGRATIONS[n] upgrades a database from version n to n + 1. Only ever append.
+
+def _create_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS downloads
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     file_name TEXT NOT NULL,
+                     client_address TEXT,
+                     timestamp DATETIME NOT NULL,
+                     user_id TEXT,
+                     speed REAL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS files
+                    (file_name TEXT PRIMARY KEY,
+                     upload_date DATETIME NOT NULL,
+                     user_id TEXT,
+                     is_private INTEGER DEFAULT 0,
+                     size INTEGER,
+                     checksum TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                    (username TEXT PRIMARY KEY,
+                     password TEXT NOT NULL,
+                     display_name TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS file_shares
+                    (file_name TEXT,
+                     shared_with_user TEXT,
+                     PRIMARY KEY (file_name, shared_with_user),
+                     FOREIGN KEY (file_name) REFERENCES files(file_name))''')
+
+
+def _add_lookup_indexes(conn):
+    # "Shared with me" lookups in LIST/SEARCH, answered from the index alone
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_file_shares_user ON file_shares (shared_with_user, file_name)")
+    # Public listing and the owner side of the visibility OR, both index-only
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_private_user ON files (is_private, user_id, file_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_user ON files (user_id, file_name)")
+    # Statistics range scans; covers COUNT, per-user counts and AVG(speed).
+    # There is deliberately no downloads(user_id) index: the planner prefers
+    # it for GROUP BY user_id and walks the whole table in random order.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_time ON downloads (timestamp, user_id, speed)")
+    conn.execute("ANALYZE")
+
+
+def _add_stats_rollups(conn):
+    # Per-day, per-user download counters and per-user file totals, kept
+    # current by triggers so statistics never aggregate the raw tables.
+    conn.execute('''CREATE TABLE IF NOT EXISTS download_daily
+                    (day TEXT NOT NULL,
+                     user_id TEXT,
+                     downloads INTEGER NOT NULL DEFAULT 0,
+                     speed_sum REAL NOT NULL DEFAULT 0,
+                     PRIMARY KEY (day, user_id))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_file_totals
+                    (user_id TEXT PRIMARY KEY,
+                     files INTEGER NOT NULL DEFAULT 0,
+                     bytes INTEGER NOT NULL DEFAULT 0)''')
+
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS downloads_rollup_insert AFTER INSERT ON downloads BEGIN
+                        INSERT INTO download_daily (day, user_id, downloads, speed_sum)
+                        VALUES (DATE(NEW.timestamp), NEW.user_id, 1, IFNULL(NEW.speed, 0))
+                        ON CONFLICT (day, user_id) DO UPDATE SET
+                            downloads = downloads + 1, speed_sum = speed_sum + excluded.speed_sum;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS downloads_rollup_delete AFTER DELETE ON downloads BEGIN
+                        UPDATE download_daily SET downloads = downloads - 1, speed_sum = speed_sum - IFNULL(OLD.speed, 0)
+                        WHERE day = DATE(OLD.timestamp) AND user_id IS OLD.user_id;
+                        DELETE FROM download_daily
+                        WHERE day = DATE(OLD.timestamp) AND user_id IS OLD.user_id AND downloads <= 0;
+                    END''')
+
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_rollup_insert AFTER INSERT ON files BEGIN
+                        INSERT INTO user_file_totals (user_id, files, bytes) VALUES (NEW.user_id, 1, IFNULL(NEW.size, 0))
+                        ON CONFLICT (user_id) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_rollup_delete AFTER DELETE ON files BEGIN
+                        UPDATE user_file_totals SET files = files - 1, bytes = bytes - IFNULL(OLD.size, 0)
+                        WHERE user_id IS OLD.user_id;
+                        DELETE FROM user_file_totals WHERE user_id IS OLD.user_id AND files <= 0;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_rollup_update AFTER UPDATE OF user_id, size ON files BEGIN
+                        UPDATE user_file_totals SET files = files - 1, bytes = bytes - IFNULL(OLD.size, 0)
+                        WHERE user_id IS OLD.user_id;
+                        DELETE FROM user_file_totals WHERE user_id IS OLD.user_id AND files <= 0;
+                        INSERT INTO user_file_totals (user_id, files, bytes) VALUES (NEW.user_id, 1, IFNULL(NEW.size, 0))
+                        ON CONFLICT (user_id) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+                    END''')
+
+    conn.execute("DELETE FROM download_daily")
+    conn.execute('''INSERT INTO download_daily (day, user_id, downloads, speed_sum)
+                    SELECT DATE(timestamp), user_id, COUNT(*), IFNULL(SUM(speed), 0)
+                    FROM downloads GROUP BY DATE(timestamp), user_id''')
+    conn.execute("DELETE FROM user_file_totals")
+    conn.execute('''INSERT INTO user_file_totals (user_id, files, bytes)
+                    SELECT user_id, COUNT(*), IFNULL(SUM(size), 0) FROM files GROUP BY user_id''')
+
+
+def _add_upload_sessions(conn):
+    # Resumable uploads; the bytes received so far live in a .tmp file named
+    # after upload_id, whose size is the committed offset.
+    conn.execute('''CREATE TABLE IF NOT EXISTS upload_sessions
+                    (upload_id TEXT PRIMARY KEY,
+                     user_id TEXT NOT NULL,
+                     file_name TEXT NOT NULL,
+                     size INTEGER NOT NULL,
+                     is_private INTEGER DEFAULT 0,
+                     is_folder INTEGER DEFAULT 0,
+                     fingerprint TEXT,
+                     transfer_seconds REAL NOT NULL DEFAULT 0,
+                     created DATETIME NOT NULL,
+                     updated DATETIME NOT NULL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_owner ON upload_sessions (user_id, file_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions (updated)")
+
+
+def _add_block_checksums(conn):
+    # Per-block checksums of a file, valid while files.checksum still equals
+    # the checksum they were computed for. ``blocks`` is comma-separated hex.
+    conn.execute('''CREATE TABLE IF NOT EXISTS file_blocks
+                    (file_name TEXT PRIMARY KEY,
+                     checksum TEXT NOT NULL,
+                     algorithm TEXT NOT NULL,
+                     block_size INTEGER NOT NULL,
+                     blocks TEXT NOT NULL)''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_blocks_delete AFTER DELETE ON files BEGIN
+                        DELETE FROM file_blocks WHERE file_name = OLD.file_name;
+                    END''')
+
+
+def _add_blob_store(conn):
+    # Rows from before checksums named their algorithm hold bare MD5 hex;
+    # name it, so equal content always has the same checksum string
+    conn.execute("UPDATE files SET checksum = 'md5:' || checksum WHERE checksum NOT LIKE '%:%' AND checksum <> ''")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_checksum ON files (checksum)")
+    # One row per stored blob, keyed by checksum; refcount is the number of
+    # files rows naming it, kept by triggers. Blobs at refcount 0 await GC.
+    conn.execute('''CREATE TABLE IF NOT EXISTS blobs
+                    (checksum TEXT PRIMARY KEY,
+                     size INTEGER,
+                     refcount INTEGER NOT NULL DEFAULT 0)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (refcount) WHERE refcount <= 0")
+
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_blobs_insert AFTER INSERT ON files
+                    WHEN NEW.checksum IS NOT NULL BEGIN
+                        INSERT INTO blobs (checksum, size, refcount) VALUES (NEW.checksum, NEW.size, 1)
+                        ON CONFLICT (checksum) DO UPDATE SET refcount = refcount + 1;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_blobs_delete AFTER DELETE ON files
+                    WHEN OLD.checksum IS NOT NULL BEGIN
+                        UPDATE blobs SET refcount = refcount - 1 WHERE checksum = OLD.checksum;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_blobs_update AFTER UPDATE OF checksum ON files
+                    WHEN OLD.checksum IS NOT NEW.checksum BEGIN
+                        UPDATE blobs SET refcount = refcount - 1 WHERE checksum = OLD.checksum;
+                        INSERT INTO blobs (checksum, size, refcount) SELECT NEW.checksum, NEW.size, 1
+                        WHERE NEW.checksum IS NOT NULL
+                        ON CONFLICT (checksum) DO UPDATE SET refcount = refcount + 1;
+                    END''')
+
+    conn.execute("DELETE FROM blobs")
+    conn.execute('''INSERT INTO blobs (checksum, size, refcount)
+                    SELECT checksum, MAX(size), COUNT(*) FROM files WHERE checksum IS NOT NULL GROUP BY checksum''')
+
+def _add_chunk_index(conn):
+    # Content-defined chunks of stored blobs, so a delta upload can reuse the
+    # parts of a file the server already holds. A blob is indexed the first
+    # time a delta transfer touches it; its rows go when the blob does.
+    conn.execute('''CREATE TABLE IF NOT EXISTS blob_chunks
+                    (blob TEXT NOT NULL,
+                     start INTEGER NOT NULL,
+                     size INTEGER NOT NULL,
+                     checksum TEXT NOT NULL,
+                     PRIMARY KEY (blob, start))''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_blob_chunks_checksum ON blob_chunks (checksum)")
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS blobs_chunks_delete AFTER DELETE ON blobs BEGIN
+                        DELETE FROM blob_chunks WHERE blob = OLD.checksum;
+                    END''')
+
+
+def has_trigram_tokenizer(conn):
+    """Whether this SQLite has FTS5 and its trigram tokenizer (3.34 and later)."""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.trigram_probe USING fts5(x, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("DROP TABLE temp.trigram_probe")
+    return True
+
+
+def _add_search_index(conn):
+    # Trigram full-text index over file names, so SEARCH finds substrings
+    # without scanning files. It keeps no copy of the names (external
+    # content) and is keyed by files.rowid; triggers keep it in step. Names
+    # never change in place, so inserts and deletes are all there is to track.
+    # Superseded by _key_search_index_by_id.
+    if not has_trigram_tokenizer(conn):
+        return
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS files_search
+                    USING fts5(file_name, content='files', content_rowid='rowid', tokenize='trigram')''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_search_insert AFTER INSERT ON files BEGIN
+                        INSERT INTO files_search (rowid, file_name) VALUES (NEW.rowid, NEW.file_name);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_search_delete AFTER DELETE ON files BEGIN
+                        INSERT INTO files_search (files_search, rowid, file_name)
+                        VALUES ('delete', OLD.rowid, OLD.file_name);
+                    END''')
+    conn.execute("INSERT INTO files_search (files_search) VALUES ('rebuild')")
+
+
+def _add_change_log(conn):
+    # Every change to files and file_shares, numbered. The latest seq is the
+    # catalog version that LIST_CHANGES works from. A row carries the state
+    # that decides who could see the file at that point (the new state, and
+    # also the old one when visibility changed), so a user is only told about
+    # names they could see before or after. Only the newest CHANGE_LOG_SIZE
+    # rows are kept, pruned every thousandth insert.
+    conn.execute('''CREATE TABLE IF NOT EXISTS file_changes
+                    (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                     file_name TEXT NOT NULL,
+                     user_id TEXT,
+                     is_private INTEGER,
+                     shared_with_user TEXT)''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_changes_insert AFTER INSERT ON files BEGIN
+                        INSERT INTO file_changes (file_name, user_id, is_private) VALUES (NEW.file_name, NEW.user_id, NEW.is_private);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_changes_update AFTER UPDATE ON files BEGIN
+                        INSERT INTO file_changes (file_name, user_id, is_private)
+                        SELECT OLD.file_name, OLD.user_id, OLD.is_private
+                        WHERE OLD.is_private IS NOT NEW.is_private OR OLD.user_id IS NOT NEW.user_id;
+                        INSERT INTO file_changes (file_name, user_id, is_private) VALUES (NEW.file_name, NEW.user_id, NEW.is_private);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_changes_delete AFTER DELETE ON files BEGIN
+                        INSERT INTO file_changes (file_name, user_id, is_private) VALUES (OLD.file_name, OLD.user_id, OLD.is_private);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS shares_changes_insert AFTER INSERT ON file_shares BEGIN
+                        INSERT INTO file_changes (file_name, shared_with_user) VALUES (NEW.file_name, NEW.shared_with_user);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS shares_changes_delete AFTER DELETE ON file_shares BEGIN
+                        INSERT INTO file_changes (file_name, shared_with_user) VALUES (OLD.file_name, OLD.shared_with_user);
+                    END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS file_changes_prune AFTER INSERT ON file_changes
+                     WHEN NEW.seq % 1000 = 0 BEGIN
+                         DELETE FROM file_changes WHERE seq <= NEW.seq - {CHANGE_LOG_SIZE};
+                     END''')
+
+
+def _key_search_index_by_id(conn):
+    # files has a TEXT primary key, so its rowid is implicit and VACUUM may
+    # renumber it under the index. The index now covers search_names, whose
+    # id is an INTEGER PRIMARY KEY and never changes; files reach it by name.
+    # INSERT OR IGNORE keeps a name's entry when a writer replaces its files
+    # row without firing the delete trigger. Without the trigram tokenizer
+    # there is no index, and search_files() scans with LIKE.
+    conn.execute("DROP TRIGGER IF EXISTS files_search_insert")
+    conn.execute("DROP TRIGGER IF EXISTS files_search_delete")
+    conn.execute("DROP TABLE IF EXISTS files_search")
+    if not has_trigram_tokenizer(conn):
+        return
+    conn.execute('''CREATE TABLE IF NOT EXISTS search_names
+                    (id INTEGER PRIMARY KEY,
+                     file_name TEXT NOT NULL UNIQUE)''')
+    conn.execute("INSERT OR IGNORE INTO search_names (file_name) SELECT file_name FROM files")
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS files_search
+                    USING fts5(file_name, content='search_names', content_rowid='id', tokenize='trigram')''')
+    conn.execute("INSERT INTO files_search (files_search) VALUES ('rebuild')")
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS search_names_insert AFTER INSERT ON search_names BEGIN
+                        INSERT INTO files_search (rowid, file_name) VALUES (NEW.id, NEW.file_name);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS search_names_delete AFTER DELETE ON search_names BEGIN
+                        INSERT INTO files_search (files_search, rowid, file_name)
+                        VALUES ('delete', OLD.id, OLD.file_name);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_search_insert AFTER INSERT ON files BEGIN
+                        INSERT OR IGNORE INTO search_names (file_name) VALUES (NEW.file_name);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS files_search_delete AFTER DELETE ON files BEGIN
+                        DELETE FROM search_names WHERE file_name = OLD.file_name;
+                    END''')
+
+
+def _count_download_speeds(conn):
+    # download_daily.speeds counts the downloads with a recorded speed, which
+    # the average divides by; like AVG(speed), it leaves out NULL speeds
+    conn.execute("ALTER TABLE download_daily ADD COLUMN speeds INTEGER NOT NULL DEFAULT 0")
+    conn.execute("DROP TRIGGER IF EXISTS downloads_rollup_insert")
+    conn.execute("DROP TRIGGER IF EXISTS downloads_rollup_delete")
+    conn.execute('''CREATE TRIGGER downloads_rollup_insert AFTER INSERT ON downloads BEGIN
+                        INSERT INTO download_daily (day, user_id, downloads, speed_sum, speeds)
+                        VALUES (DATE(NEW.timestamp), NEW.user_id, 1, IFNULL(NEW.speed, 0), NEW.speed IS NOT NULL)
+                        ON CONFLICT (day, user_id) DO UPDATE SET
+                            downloads = downloads + 1, speed_sum = speed_sum + excluded.speed_sum,
+                            speeds = speeds + excluded.speeds;
+                    END''')
+    conn.execute('''CREATE TRIGGER downloads_rollup_delete AFTER DELETE ON downloads BEGIN
+                        UPDATE download_daily SET downloads = downloads - 1, speed_sum = speed_sum - IFNULL(OLD.speed, 0),
+                                                  speeds = speeds - (OLD.speed IS NOT NULL)
+                        WHERE day = DATE(OLD.timestamp) AND user_id IS OLD.user_id;
+                        DELETE FROM download_daily
+                        WHERE day = DATE(OLD.timestamp) AND user_id IS OLD.user_id AND downloads <= 0;
+                    END''')
+
+    conn.execute("DELETE FROM download_daily")
+    conn.execute('''INSERT INTO download_daily (day, user_id, downloads, speed_sum, speeds)
+                    SELECT DATE(timestamp), user_id, COUNT(*), IFNULL(SUM(speed), 0), COUNT(speed)
+                    FROM downloads GROUP BY DATE(timestamp), user_id''')
+
+
+MIGRATIONS = [
+    _create_tables,
+    _add_lookup_indexes,
+    _add_stats_rollups,
+    _add_upload_sessions,
+    _add_block_checksums,
+    _add_blob_store,
+    _add_chunk_index,
+    _add_search_index,
+    _add_change_log,
+    _key_search_index_by_id,
+    _count_download_speeds,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+
+class MetadataStore:
+    """All SQLite access for the server, over one pooled connection per thread.
+
+    Each worker thread opens its connection once, in WAL mode, so readers
+    never block behind the writer. Every query below is a fixed SQL string,
+    so after the first call it is served from the connection's statement
+    cache instead of being parsed again. Writes serialize on an in-process
+    lock and BEGIN IMMEDIATE, so concurrent writers queue here instead of
+    spinning on SQLITE_BUSY.
+    """
+
+    def __init__(self, path=DB_PATH, migrate=True):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._search_index = None
+        if migrate:
+            self.migrate()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES,
+                                   isolation_level=None, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA cache_size=-16384")  # 16 MiB
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close the calling thread's connection; the next call reopens it."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def query(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchone()
+
+    def migrate(self, target=None):
+        """Bring the database up to ``target`` (default: the latest) schema version.
+
+        The version lives in ``PRAGMA user_version``; databases created before
+        migrations existed report 0 and are upgraded in place.
+        """
+        target = SCHEMA_VERSION if target is None else target
+        with self.transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(f"{self.path} has schema version {version}, "
+                                   f"newer than this server supports ({SCHEMA_VERSION})")
+            for number in range(version, target):
+                MIGRATIONS[number](conn)
+                conn.execute(f"PRAGMA user_version = {number + 1}")
+        self._search_index = None
+        return max(version, target)
+
+    def has_search_index(self):
+        """Whether SEARCH can use the trigram index; SQLite before 3.34 has none."""
+        if self._search_index is None:
+            conn = self.connection()
+            self._search_index = (
+                conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_search'").fetchone() is not None
+                and has_trigram_tokenizer(conn))
+        return self._search_index
+
+    # Files
+
+    def visible_files(self, user_id):
+        rows = self.query("""
+            SELECT file_name FROM files
+            WHERE is_private = 0 OR user_id = ?
+            OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?)
+        """, (user_id, user_id))
+        return [row[0] for row in rows]
+
+    def public_and_private_files(self, user_id):
+        public_files = [row[0] for row in self.query("SELECT file_name FROM files WHERE is_private = 0")]
+        private_files = [row[0] for row in self.query("""
+            SELECT file_name FROM files WHERE is_private = 1 AND user_id = ?
+            UNION
+            SELECT file_name FROM file_shares WHERE shared_with_user = ?
+        """, (user_id, user_id))]
+        return public_files, private_files
+
+    def search_files(self, user_id, query, offset=0, limit=SEARCH_PAGE_SIZE):
+        """One page of the visible files whose name contains ``query``, best match first.
+
+        Returns ([(file_name, owned_private), ...], has_more). An exact name
+        ranks first, then names starting with the query, then shorter names
+        (which the query covers more of). FTS5's bm25 rank would order the
+        same way for single-column names and costs twice as much to compute
+        over a broad match. Queries of three characters or more are answered
+        from the trigram index; shorter ones can't be, and scan, as every
+        query does where SQLite has no trigram tokenizer.
+        """
+        like = '%' + escape_like(query) + '%'
+        prefix = escape_like(query) + '%'
+        if len(query) >= 3 and self.has_search_index():
+            # Entries are joined to files by name, so one a writer left behind
+            # finds no row. The LIKE re-check keeps matches the same as the
+            # scan's: trigram folds case beyond ASCII, LIKE does not
+            rows = self.query(r"""
+                SELECT f.file_name, f.is_private = 1 AND f.user_id IS ?
+                FROM files_search s JOIN search_names n ON n.id = s.rowid
+                JOIN files f ON f.file_name = n.file_name
+                WHERE files_search MATCH ? AND f.file_name LIKE ? ESCAPE '\'
+                AND (f.is_private = 0 OR f.user_id = ?
+                     OR f.file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?))
+                ORDER BY f.file_name = ? COLLATE NOCASE DESC, f.file_name LIKE ? ESCAPE '\' DESC,
+                         length(f.file_name), f.file_name
+                LIMIT ? OFFSET ?
+            """, (user_id, '"' + query.replace('"', '""') + '"', like, user_id, user_id,
+                  query, prefix, limit + 1, offset))
+        else:
+            rows = self.query(r"""
+                SELECT file_name, is_private = 1 AND user_id IS ? FROM files
+                WHERE file_name LIKE ? ESCAPE '\'
+                AND (is_private = 0 OR user_id = ?
+                     OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?))
+                ORDER BY file_name = ? COLLATE NOCASE DESC, file_name LIKE ? ESCAPE '\' DESC,
+                         length(file_name), file_name
+                LIMIT ? OFFSET ?
+            """, (user_id, like, user_id, user_id, query, prefix, limit + 1, offset))
+        return rows[:limit], len(rows) > limit
+
+    def catalog_version(self):
+        """The seq of the latest change to files or shares; 0 before the first."""
+        return self.query_one("SELECT IFNULL(MAX(seq), 0) FROM file_changes")[0]
+
+    def list_page(self, user_id, after='', limit=LIST_PAGE_SIZE):
+        """Visible files named after ``after``, in name order.
+
+        Returns ([(file_name, public, private), ...], has_more), where public
+        and private say which of the two LIST lists the name belongs in (a
+        public file shared with the user is in both).
+        """
+        rows = self.query("""
+            SELECT file_name, is_private = 0,
+                   (is_private = 1 AND user_id IS ?)
+                   OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?)
+            FROM files
+            WHERE file_name > ? AND (is_private = 0 OR user_id = ?
+                  OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?))
+            ORDER BY file_name LIMIT ?
+        """, (user_id, user_id, after, user_id, user_id, limit + 1))
+        return rows[:limit], len(rows) > limit
+
+    def changes_since(self, user_id, since, limit=LIST_PAGE_SIZE):
+        """Files whose visibility to the user may have changed after catalog version ``since``.
+
+        Returns ([(file_name, public, private), ...], version, has_more) with
+        each name's current state; neither flag set means it is gone from the
+        user's lists. ``version`` is where the next call should start: the
+        latest change covered. Names come in the order of their last change.
+        Returns None if ``since`` is older than the log goes back, or newer
+        than the catalog (a different database), and only a full listing will do.
+        """
+        oldest, latest = self.query_one("SELECT MIN(seq), IFNULL(MAX(seq), 0) FROM file_changes")
+        if since > latest or (oldest is not None and since < oldest - 1):
+            return None
+        rows = self.query("""
+            SELECT c.file_name, MAX(c.seq) AS last, IFNULL(f.is_private = 0, 0),
+                   IFNULL(f.is_private = 1 AND f.user_id IS ?, 0)
+                   OR EXISTS (SELECT 1 FROM file_shares s WHERE s.file_name = c.file_name AND s.shared_with_user = ?)
+            FROM file_changes c LEFT JOIN files f ON f.file_name = c.file_name
+            WHERE c.seq > ? AND (c.is_private = 0 OR c.user_id = ? OR c.shared_with_user = ?)
+            GROUP BY c.file_name ORDER BY last LIMIT ?
+        """, (user_id, user_id, since, user_id, user_id, limit + 1))
+        if len(rows) > limit:
+            return [(name, public, private) for name, _, public, private in rows[:limit]], rows[limit - 1][1], True
+        return [(name, public, private) for name, _, public, private in rows], latest, False
+
+    def can_access(self, file_name, user_id):
+        row = self.query_one("SELECT is_private, user_id FROM files WHERE file_name = ?", (file_name,))
+        if not row:
+            return False
+        if row[0] == 0 or row[1] == user_id:  # Public file or owner
+            return True
+        return self.query_one("SELECT 1 FROM file_shares WHERE file_name = ? AND shared_with_user = ?",
+                              (file_name, user_id)) is not None
+
+    def accessible_checksums(self, file_names, user_id):
+        """{file_name: checksum} for those of ``file_names`` the user may download."""
+        found = {}
+        for start in range(0, len(file_names), NAMES_PER_QUERY):
+            names = file_names[start:start + NAMES_PER_QUERY]
+            found.update(self.query(f"""
+                SELECT f.file_name, f.checksum FROM files f
+                WHERE f.file_name IN ({','.join('?' * len(names))})
+                AND (f.is_private = 0 OR f.user_id = ?
+                     OR EXISTS (SELECT 1 FROM file_shares s WHERE s.file_name = f.file_name AND s.shared_with_user = ?))
+            """, (*names, user_id, user_id)))
+        return found
+
+    @staticmethod
+    def folder_range(folder_name):
+        """The file_name bounds [low, high) of everything recorded under a folder."""
+        prefix = folder_name.rstrip('/' + os.sep) + os.sep
+        return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+    def can_access_folder(self, folder_name, user_id):
+        """A folder is accessible if it has recorded files and the user may read every one."""
+        total, allowed = self.query_one("""
+            SELECT COUNT(*), IFNULL(SUM(is_private = 0 OR user_id IS ?
+                OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?)), 0)
+            FROM files WHERE file_name >= ? AND file_name < ?
+        """, (user_id, user_id) + self.folder_range(folder_name))
+        return total > 0 and total == allowed
+
+    def folder_fingerprint(self, folder_name):
+        """A digest of the name, size, checksum and upload time of every file under a folder."""
+        digest = hashlib.sha1()
+        for row in self.query("""
+            SELECT file_name, size, checksum, CAST(upload_date AS TEXT) FROM files
+            WHERE file_name >= ? AND file_name < ? ORDER BY file_name
+        """, self.folder_range(folder_name)):
+            digest.update(repr(row).encode('utf-8'))
+        return digest.hexdigest()
+
+    def folder_checksums(self, folder_name):
+        """Recorded checksum of every file under a folder, by file name."""
+        return dict(self.query("SELECT file_name, checksum FROM files WHERE file_name >= ? AND file_name < ?",
+                               self.folder_range(folder_name)))
+
+    def file_owner(self, file_name, private_only=False):
+        sql = ("SELECT user_id FROM files WHERE file_name = ? AND is_private = 1" if private_only
+               else "SELECT user_id FROM files WHERE file_name = ?")
+        row = self.query_one(sql, (file_name,))
+        return row[0] if row else None
+
+    def file_checksum(self, file_name):
+        row = self.query_one("SELECT checksum FROM files WHERE file_name = ?", (file_name,))
+        return row[0] if row else None
+
+    def block_checksums(self, file_name):
+        """(algorithm, block_size, [hex, ...]) for the file's current contents, or None if not recorded."""
+        row = self.query_one("""
+            SELECT b.algorithm, b.block_size, b.blocks FROM file_blocks b JOIN files f USING (file_name)
+            WHERE b.file_name = ? AND b.checksum = f.checksum
+        """, (file_name,))
+        return (row[0], row[1], row[2].split(',') if row[2] else []) if row else None
+
+    def put_block_checksums(self, file_name, checksum, algorithm, block_size, blocks):
+        with self.transaction() as conn:
+            conn.execute("""INSERT OR REPLACE INTO file_blocks (file_name, checksum, algorithm, block_size, blocks)
+                            VALUES (?, ?, ?, ?, ?)""", (file_name, checksum, algorithm, block_size, ','.join(blocks)))
+
+    def readable_checksum(self, checksum, user_id):
+        """Whether some file the user may read has this checksum."""
+        return self.query_one("""
+            SELECT 1 FROM files WHERE checksum = ? AND (is_private = 0 OR user_id IS ?
+                OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?))
+            LIMIT 1
+        """, (checksum, user_id, user_id)) is not None
+
+    def files_with_checksum(self, checksum):
+        return [row[0] for row in self.query("SELECT file_name FROM files WHERE checksum = ?", (checksum,))]
+
+    def add_blob(self, checksum, size):
+        """Register a blob before any file refers to it, so an interrupted upload leaves it to GC."""
+        self.add_blobs([(checksum, size)])
+
+    def add_blobs(self, rows):
+        """add_blob() for many (checksum, size) rows, in one transaction."""
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO blobs (checksum, size, refcount) VALUES (?, ?, 0)", rows)
+
+    def unreferenced_blobs(self):
+        return [row[0] for row in self.query("SELECT checksum FROM blobs WHERE refcount <= 0")]
+
+    def delete_blob(self, checksum):
+        """Forget a blob if it is still unreferenced; returns whether it was."""
+        with self.transaction() as conn:
+            return conn.execute("DELETE FROM blobs WHERE checksum = ? AND refcount <= 0", (checksum,)).rowcount > 0
+
+    def blob_chunks(self, blob):
+        """[(start, size, checksum), ...] of an indexed blob, in order; empty if it is not indexed."""
+        return self.query("SELECT start, size, checksum FROM blob_chunks WHERE blob = ? ORDER BY start", (blob,))
+
+    def put_blob_chunks(self, blob, chunks):
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO blob_chunks (blob, start, size, checksum) VALUES (?, ?, ?, ?)",
+                             [(blob, start, size, checksum) for start, size, checksum in chunks])
+
+    def readable_chunk(self, checksum, user_id):
+        """(blob, start) of a chunk with this checksum inside content the user may read, or None."""
+        return self.query_one("""
+            SELECT c.blob, c.start FROM blob_chunks c WHERE c.checksum = ? AND EXISTS (
+                SELECT 1 FROM files WHERE checksum = c.blob AND (is_private = 0 OR user_id IS ?
+                    OR file_name IN (SELECT file_name FROM file_shares WHERE shared_with_user = ?)))
+            LIMIT 1
+        """, (checksum, user_id, user_id))
+
+    def put_files(self, rows):
+        """Insert or replace (file_name, user_id, is_private, size, checksum) rows in one transaction."""
+        now = datetime.now()
+        with self.transaction() as conn:
+            # An upsert rather than INSERT OR REPLACE: REPLACE deletes the old
+            # row without firing delete triggers, which would skew the rollups
+            conn.executemany("""
+                INSERT INTO files (file_name, upload_date, user_id, is_private, size, checksum)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (file_name) DO UPDATE SET
+                    upload_date = excluded.upload_date, user_id = excluded.user_id,
+                    is_private = excluded.is_private, size = excluded.size, checksum = excluded.checksum
+            """, [(name, now, user_id, is_private, size, checksum)
+                  for name, user_id, is_private, size, checksum in rows])
+
+    def delete_file(self, file_name):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM files WHERE file_name = ?", (file_name,))
+            conn.execute("DELETE FROM file_shares WHERE file_name = ?", (file_name,))
+
+    def share_file(self, file_name, target_user):
+        """Raises sqlite3.IntegrityError if the file is already shared with the user."""
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO file_shares (file_name, shared_with_user) VALUES (?, ?)",
+                         (file_name, target_user))
+
+    # Downloads and statistics
+
+    def record_download(self, file_name, client_address, user_id, speed):
+        self.record_downloads([file_name], client_address, user_id, speed)
+
+    def record_downloads(self, file_names, client_address, user_id, speed):
+        """Record a download of each of ``file_names`` in one transaction."""
+        now = datetime.now()
+        with self.transaction() as conn:
+            conn.executemany("""
+                INSERT INTO downloads (file_name, client_address, timestamp, user_id, speed)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(file_name, str(client_address), now, user_id, speed) for file_name in file_names])
+
+    def stats_since(self, start_date):
+        """Download and storage statistics from the rollup tables.
+
+        Whole days after ``start_date`` come from download_daily; the partial
+        first day is counted exactly from the downloads timestamp index.
+        """
+        next_day = datetime.combine(start_date.date() + timedelta(days=1), time.min)
+        per_user = {}
+        for user_id, count, speed_sum, speeds in self.query("""
+            SELECT user_id, COUNT(*), IFNULL(SUM(speed), 0), COUNT(speed) FROM downloads
+            WHERE timestamp >= ? AND timestamp < ? GROUP BY user_id
+            UNION ALL
+            SELECT user_id, SUM(downloads), SUM(speed_sum), SUM(speeds) FROM download_daily
+            WHERE day >= ? GROUP BY user_id
+        """, (start_date, next_day, next_day.date().isoformat())):
+            totals = per_user.setdefault(user_id, [0, 0.0, 0])
+            totals[0] += count
+            totals[1] += speed_sum
+            totals[2] += speeds
+        downloads = sum(count for count, _, _ in per_user.values())
+        speeds = sum(speeds for _, _, speeds in per_user.values())
+
+        stats = {}
+        stats['downloads'] = downloads
+        stats['total_days_with_downloads'] = self.query_one("SELECT COUNT(DISTINCT day) FROM download_daily")[0]
+        files_per_user = dict(self.query("SELECT user_id, files FROM user_file_totals"))
+        stats['total_files'] = sum(files_per_user.values())
+        stats['total_storage_gb'] = (self.query_one("SELECT SUM(bytes) FROM user_file_totals")[0] or 0) / (1024**3)
+        stats['files_per_user'] = files_per_user
+        stats['downloads_per_user'] = {user_id: count for user_id, (count, _, _) in per_user.items()}
+        stats['average_speed'] = sum(speed for _, speed, _ in per_user.values()) / speeds if speeds else 0
+        return stats
+
+    # Upload sessions
+
+    def create_upload_session(self, upload_id, user_id, file_name, size, is_private, is_folder, fingerprint):
+        now = datetime.now()
+        with self.transaction() as conn:
+            conn.execute("""
+                INSERT INTO upload_sessions
+                (upload_id, user_id, file_name, size, is_private, is_folder, fingerprint, created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (upload_id, user_id, file_name, size, is_private, is_folder, fingerprint, now, now))
+
+    def find_upload_session(self, user_id, file_name, size, fingerprint):
+        """The open session for the same source file, if the client is starting over."""
+        row = self.query_one("""
+            SELECT upload_id FROM upload_sessions
+            WHERE user_id = ? AND file_name = ? AND size = ? AND fingerprint = ?
+            ORDER BY updated DESC LIMIT 1
+        """, (user_id, file_name, size, fingerprint))
+        return row[0] if row else None
+
+    def upload_session(self, upload_id):
+        """(user_id, file_name, size, is_private, is_folder, transfer_seconds) or None."""
+        return self.query_one("""
+            SELECT user_id, file_name, size, is_private, is_folder, transfer_seconds
+            FROM upload_sessions WHERE upload_id = ?
+        """, (upload_id,))
+
+    def touch_upload_session(self, upload_id, transfer_seconds):
+        with self.transaction() as conn:
+            conn.execute("""
+                UPDATE upload_sessions SET updated = ?, transfer_seconds = transfer_seconds + ?
+                WHERE upload_id = ?
+            """, (datetime.now(), transfer_seconds, upload_id))
+
+    def delete_upload_session(self, upload_id):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM upload_sessions WHERE upload_id = ?", (upload_id,))
+
+    def upload_session_ids(self, idle_since=None):
+        """All session ids, or only those without a chunk since ``idle_since``."""
+        if idle_since is None:
+            return [row[0] for row in self.query("SELECT upload_id FROM upload_sessions")]
+        return [row[0] for row in self.query("SELECT upload_id FROM upload_sessions WHERE updated < ?",
+                                             (idle_since,))]
+
+    # Users
+
+    def password_for(self, username):
+        row = self.query_one("SELECT password FROM users WHERE username = ?", (username,))
+        return row[0] if row else None
+
+    def user_exists(self, username):
+        return self.query_one("SELECT 1 FROM users WHERE username = ?", (username,)) is not None
+
+    def users(self):
+        return self.query("SELECT username, display_name FROM users")
+
+    def display_name(self, username):
+        row = self.query_one("SELECT display_name FROM users WHERE username = ?", (username,))
+        return row[0] if row else None
+
+    def add_user(self, username, password, display_name=None):
+        """Raises sqlite3.IntegrityError if the username is taken."""
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO users (username, password, display_name) VALUES (?, ?, ?)",
+                         (username, password, display_name))
+
+    def set_password(self, username, password):
+        with self.transaction() as conn:
+            conn.execute("UPDATE users SET password = ? WHERE username = ?", (password, username))
+
+    def set_display_name(self, username, display_name):
+        with self.transaction() as conn:
+            conn.execute("UPDATE users SET display_name = ? WHERE username = ?", (display_name, username))
+
+    def delete_user(self, username):
+        """Remove a user with their files, shares of those files and download history.
+
+        Returns the names of the files that were removed.
+        """
+        with self.transaction() as conn:
+            file_names = [row[0] for row in conn.execute("SELECT file_name FROM files WHERE user_id = ?", (username,))]
+            conn.execute("DELETE FROM file_shares WHERE file_name IN (SELECT file_name FROM files WHERE user_id = ?)", (username,))
+            conn.execute("DELETE FROM files WHERE user_id = ?", (username,))
+            conn.execute("DELETE FROM downloads WHERE user_id = ?", (username,))
+            conn.execute("DELETE FROM users WHERE username = ?", (username,))
+        return file_names